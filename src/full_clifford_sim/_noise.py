@@ -2,8 +2,11 @@ from typing import Optional, Dict, Set, List, Iterator, Union, AbstractSet, Defa
 
 import collections
 
+import numpy as np
 import stim
 
+from full_clifford_sim.circuit_text import CircuitText
+
 
 ### This file is lifted from the original MSC paper's Zenodo repository ###
 
@@ -133,12 +136,12 @@ class NoiseRule:
     def append_noisy_version_of(self,
                                 *,
                                 split_op: stim.CircuitInstruction,
-                                out_during_moment: stim.Circuit,
-                                after_moments: DefaultDict[Any, stim.Circuit],
+                                targets: List[stim.GateTarget],
+                                out_during_moment: CircuitText,
+                                after_moments: DefaultDict[Any, List[int]],
                                 immune_qubits: AbstractSet[int]) -> None:
-        targets = split_op.targets_copy()
         if immune_qubits and any((t.is_qubit_target or t.is_x_target or t.is_y_target or t.is_z_target) and t.value in immune_qubits for t in targets):
-            out_during_moment.append(split_op)
+            out_during_moment.append_text(str(split_op))
             return
 
         args = split_op.gate_args_copy()
@@ -148,10 +151,10 @@ class NoiseRule:
             assert len(args) == 0
             args = [self.flip_result]
 
-        out_during_moment.append(split_op.name, targets, args)
+        out_during_moment.append(split_op.name, _targets_text(split_op), args)
         raw_targets = [t.value for t in targets if not t.is_combiner]
         for op_name, arg in self.after.items():
-            after_moments[(op_name, arg)].append(op_name, raw_targets, arg)
+            after_moments[(op_name, arg)].extend(raw_targets)
 
 
 class GidneyNoiseModel:
@@ -313,77 +316,132 @@ class GidneyNoiseModel:
 
         raise ValueError(f"No noise (or lack of noise) specified for {split_op=}.")
 
+    def _noise_rule_for(self, split_op: stim.CircuitInstruction, rules: Dict[Any, Optional[NoiseRule]]) -> Optional[NoiseRule]:
+        """Looks up the rule of an operation, remembering it by gate and measured basis.
+
+        Only two qubit gates can be classical control or not depending on
+        their targets, so those are not remembered.
+        """
+        if OP_TYPES[split_op.name] == CLIFFORD_2Q:
+            return self._noise_rule_for_split_operation(split_op=split_op)
+        key = (split_op.name, _measure_basis(split_op=split_op))
+        if key not in rules:
+            rules[key] = self._noise_rule_for_split_operation(split_op=split_op)
+        return rules[key]
+
     def _append_idle_error(self,
                            *,
                            moment_split_ops: List[stim.CircuitInstruction],
-                           out: stim.Circuit,
-                           system_qubits: AbstractSet[int],
-                           immune_qubits: AbstractSet[int],
+                           collapse_qubits: List[int],
+                           clifford_qubits: List[int],
+                           out: CircuitText,
+                           system_mask: np.ndarray,
+                           immune_mask: np.ndarray,
                            ) -> None:
-        collapse_qubits = []
-        clifford_qubits = []
-        for split_op in moment_split_ops:
-            if occurs_in_classical_control_system(split_op):
-                continue
-            if split_op.name in COLLAPSING_OPS:
-                qubits_out = collapse_qubits
-            else:
-                qubits_out = clifford_qubits
-            for target in split_op.targets_copy():
-                if not target.is_combiner:
-                    qubits_out.append(target.value)
+        collapse = np.array(collapse_qubits, dtype=np.int64)
+        clifford = np.array(clifford_qubits, dtype=np.int64)
 
         # Safety check for operation collisions.
-        usage_counts = collections.Counter(collapse_qubits + clifford_qubits)
-        qubits_used_multiple_times = {q for q, c in usage_counts.items() if c != 1}
-        if qubits_used_multiple_times:
+        usage_counts = np.bincount(np.concatenate([collapse, clifford]), minlength=len(system_mask))
+        if np.any(usage_counts > 1):
             moment = stim.Circuit()
             for op in moment_split_ops:
                 moment.append(op)
             raise ValueError(f"Qubits were operated on multiple times without a TICK in between:\n"
-                             f"multiple uses: {sorted(qubits_used_multiple_times)}\n"
+                             f"multiple uses: {np.flatnonzero(usage_counts > 1).tolist()}\n"
                              f"moment:\n"
                              f"{moment}")
 
-        collapse_qubits_set = set(collapse_qubits)
-        clifford_qubits_set = set(clifford_qubits)
-        idle = sorted(system_qubits - collapse_qubits_set - clifford_qubits_set - immune_qubits)
-        if idle and self.idle_depolarization:
-            out.append('DEPOLARIZE1', idle, self.idle_depolarization)
+        collapse_mask = np.zeros_like(system_mask)
+        collapse_mask[collapse] = True
+        waiting_for_mr = system_mask & ~collapse_mask & ~immune_mask
+        idle_mask = waiting_for_mr.copy()
+        idle_mask[clifford] = False
+        idle = np.flatnonzero(idle_mask)
+        if len(idle) and self.idle_depolarization:
+            out.append('DEPOLARIZE1', idle, [self.idle_depolarization])
 
-        waiting_for_mr = sorted(system_qubits - collapse_qubits_set - immune_qubits)
-        if collapse_qubits_set and waiting_for_mr and self.additional_depolarization_waiting_for_m_or_r:
-            out.append('DEPOLARIZE1', idle, self.additional_depolarization_waiting_for_m_or_r)
+        if len(collapse) and waiting_for_mr.any() and self.additional_depolarization_waiting_for_m_or_r:
+            out.append('DEPOLARIZE1', idle, [self.additional_depolarization_waiting_for_m_or_r])
 
     def _append_noisy_moment(self,
                              *,
                              moment_split_ops: List[stim.CircuitInstruction],
-                             out: stim.Circuit,
-                             system_qubits: AbstractSet[int],
+                             out: CircuitText,
+                             rules: Dict[Any, Optional[NoiseRule]],
+                             system_mask: np.ndarray,
                              immune_qubits: AbstractSet[int],
+                             immune_mask: np.ndarray,
                              ) -> None:
-        after = collections.defaultdict(stim.Circuit)
+        after = collections.defaultdict(list)
+        collapse_qubits = []
+        clifford_qubits = []
         for split_op in moment_split_ops:
-            rule = self._noise_rule_for_split_operation(split_op=split_op)
+            rule = self._noise_rule_for(split_op, rules)
             if rule is None:
-                out.append(split_op)
-            else:
-                rule.append_noisy_version_of(
-                    split_op=split_op,
-                    out_during_moment=out,
-                    after_moments=after,
-                    immune_qubits=immune_qubits,
-                )
-        for k in sorted(after.keys()):
-            out += after[k]
+                out.append_text(str(split_op))
+                continue
+            targets = split_op.targets_copy()
+            qubits_out = collapse_qubits if split_op.name in COLLAPSING_OPS else clifford_qubits
+            qubits_out.extend(t.value for t in targets if not t.is_combiner)
+            rule.append_noisy_version_of(
+                split_op=split_op,
+                targets=targets,
+                out_during_moment=out,
+                after_moments=after,
+                immune_qubits=immune_qubits,
+            )
+        for op_name, arg in sorted(after.keys()):
+            out.append(op_name, after[(op_name, arg)], [arg])
 
         self._append_idle_error(
             moment_split_ops=moment_split_ops,
+            collapse_qubits=collapse_qubits,
+            clifford_qubits=clifford_qubits,
             out=out,
-            system_qubits=system_qubits,
-            immune_qubits=immune_qubits,
+            system_mask=system_mask,
+            immune_mask=immune_mask,
         )
 
+    def _append_noisy_lines(self,
+                            circuit: stim.Circuit,
+                            *,
+                            out: CircuitText,
+                            rules: Dict[Any, Optional[NoiseRule]],
+                            system_mask: np.ndarray,
+                            immune_qubits: AbstractSet[int],
+                            immune_mask: np.ndarray,
+                            ) -> None:
+        first = True
+        after_repeat = False
+        for moment_split_ops in _iter_split_op_moments(circuit, immune_qubits=immune_qubits):
+            if first:
+                first = False
+            elif not after_repeat:
+                out.append('TICK')
+            after_repeat = isinstance(moment_split_ops, stim.CircuitRepeatBlock)
+            if after_repeat:
+                out.append_text(f'REPEAT {moment_split_ops.repeat_count} {{')
+                self._append_noisy_lines(
+                    moment_split_ops.body_copy(),
+                    out=out,
+                    rules=rules,
+                    system_mask=system_mask,
+                    immune_qubits=immune_qubits,
+                    immune_mask=immune_mask,
+                )
+                out.append('TICK')
+                out.append_text('}')
+            else:
+                self._append_noisy_moment(
+                    moment_split_ops=moment_split_ops,
+                    out=out,
+                    rules=rules,
+                    system_mask=system_mask,
+                    immune_qubits=immune_qubits,
+                    immune_mask=immune_mask,
+                )
+
     def noisy_circuit(self,
                       circuit: stim.Circuit,
                       *,
@@ -392,6 +450,11 @@ class GidneyNoiseModel:
                       ) -> stim.Circuit:
         """Returns a noisy version of the given circuit, by applying the receiving noise model.
 
+        The noisy circuit is written out as text and parsed once, because
+        appending instructions with many targets to a stim.Circuit one at a
+        time is slow. Qubit usage within a moment is tracked with boolean
+        masks over the qubit indices.
+
         Args:
             circuit: The circuit to layer noise over.
             system_qubits: All qubits used by the circuit. These are the qubits eligible for idling noise.
@@ -400,38 +463,47 @@ class GidneyNoiseModel:
         Returns:
             The noisy version of the circuit.
         """
+        out = CircuitText()
+        self.append_noisy_lines(circuit, out, system_qubits=system_qubits, immune_qubits=immune_qubits)
+        return out.to_circuit()
+
+    def append_noisy_lines(self,
+                           circuit: stim.Circuit,
+                           out: CircuitText,
+                           *,
+                           system_qubits: Optional[AbstractSet[int]] = None,
+                           immune_qubits: Optional[AbstractSet[int]] = None,
+                           ) -> None:
+        """Appends the lines of noisy_circuit's text to out, without parsing them.
+
+        Lets several noisy pieces be joined into one circuit that is parsed once.
+        """
         if system_qubits is None:
             system_qubits = set(range(circuit.num_qubits))
         if immune_qubits is None:
             immune_qubits = set()
 
-        result = stim.Circuit()
+        num_qubits = max([circuit.num_qubits, *system_qubits, *immune_qubits], default=-1) + 1
+        system_mask = np.zeros(num_qubits, dtype=np.bool_)
+        system_mask[list(system_qubits)] = True
+        immune_mask = np.zeros(num_qubits, dtype=np.bool_)
+        immune_mask[list(immune_qubits)] = True
+
+        self._append_noisy_lines(
+            circuit,
+            out=out,
+            rules={},
+            system_mask=system_mask,
+            immune_qubits=immune_qubits,
+            immune_mask=immune_mask,
+        )
 
-        first = True
-        for moment_split_ops in _iter_split_op_moments(circuit, immune_qubits=immune_qubits):
-            if first:
-                first = False
-            elif result and isinstance(result[-1], stim.CircuitRepeatBlock):
-                pass
-            else:
-                result.append('TICK')
-            if isinstance(moment_split_ops, stim.CircuitRepeatBlock):
-                noisy_body = self.noisy_circuit(
-                    moment_split_ops.body_copy(),
-                    system_qubits=system_qubits,
-                    immune_qubits=immune_qubits,
-                )
-                noisy_body.append('TICK')
-                result.append(stim.CircuitRepeatBlock(repeat_count=moment_split_ops.repeat_count, body=noisy_body))
-            else:
-                self._append_noisy_moment(
-                    moment_split_ops=moment_split_ops,
-                    out=result,
-                    system_qubits=system_qubits,
-                    immune_qubits=immune_qubits,
-                )
 
-        return result
+def _targets_text(op: stim.CircuitInstruction) -> str:
+    "The targets of an instruction as they are written in a circuit"
+    text = str(op)
+    k = text.find(' ', text.find(')') + 1 if '(' in text else 0)
+    return '' if k < 0 else text[k + 1:]
 
 
 def occurs_in_classical_control_system(op: stim.CircuitInstruction) -> bool:
@@ -0,0 +1,129 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import pathlib
+import zipfile
+from typing import Any, Callable
+
+import numpy as np
+
+
+class ArtifactCache:
+    """A content addressed directory of npz files, shared between processes.
+
+    Entries are written atomically under a per-key file lock, so when several
+    workers ask for the same missing key only one of them builds it and the
+    rest wait and then read it. Once the directory holds more than max_bytes
+    of entries, the least recently used ones are deleted.
+    """
+
+    def __init__(self, directory: str | pathlib.Path, *, max_bytes: int = 1 << 30):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(**parts: Any) -> str:
+        "Hashes JSON serializable parts into a key"
+        text = json.dumps(parts, sort_keys=True)
+        return hashlib.sha256(text.encode('utf8')).hexdigest()
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.directory / f'{key}.npz'
+
+    @contextlib.contextmanager
+    def _lock(self, name: str):
+        with open(self._lock_path(name), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _lock_path(self, name: str) -> pathlib.Path:
+        return self.directory / f'.{name}.lock'
+
+    def _load(self, path: pathlib.Path) -> dict[str, np.ndarray] | None:
+        # Eviction removes lock files with their entries, so a process that
+        # opened the old lock file can still see an entry vanish. That is a miss.
+        try:
+            with np.load(path) as data:
+                result = dict(data)
+            os.utime(path)
+        except (FileNotFoundError, zipfile.BadZipFile):
+            return None
+        self.hits += 1
+        return result
+
+    def get(self, key: str) -> dict[str, np.ndarray] | None:
+        "Returns the entry for key, or None if it is missing"
+        with self._lock(key):
+            return self._load(self._path(key))
+
+    def get_or_build(self,
+                     key: str,
+                     build: Callable[[], dict[str, Any]]) -> dict[str, np.ndarray]:
+        """Returns the entry for key, calling build to create it if it is missing.
+
+        build returns a dict of arrays, strings and numbers. Strings and
+        numbers come back as 0-d arrays.
+        """
+        path = self._path(key)
+        with self._lock(key):
+            result = self._load(path)
+            if result is not None:
+                return result
+            self.misses += 1
+            result = {k: np.asarray(v) for k, v in build().items()}
+            tmp = self.directory / f'.{key}.{os.getpid()}.npz'
+            np.savez_compressed(tmp, **result)
+            os.replace(tmp, path)
+        self._evict(keep=path)
+        return result
+
+    def _evict(self, *, keep: pathlib.Path) -> None:
+        with self._lock('evict'):
+            entries = []
+            for p in self.directory.glob('*.npz'):
+                # Skip the temp files of entries that are still being written.
+                if p.name.startswith('.'):
+                    continue
+                with contextlib.suppress(FileNotFoundError):
+                    st = p.stat()
+                    entries.append((st.st_mtime, st.st_size, p))
+            total = sum(size for _, size, _ in entries)
+            for _, size, p in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if p == keep:
+                    continue
+                self._remove(p.stem)
+                total -= size
+
+            # Lock files of keys that were looked up but never built. Keys
+            # whose lock is held are being built right now, so they are left.
+            for lock in self.directory.glob('.*.lock'):
+                key = lock.name[1:-len('.lock')]
+                if key == 'evict' or self._path(key).exists():
+                    continue
+                with open(lock, 'a') as f:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+                    if not self._path(key).exists():
+                        with contextlib.suppress(FileNotFoundError):
+                            lock.unlink()
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _remove(self, key: str) -> None:
+        "Deletes an entry and its lock file, waiting for anyone using the entry"
+        with self._lock(key):
+            with contextlib.suppress(FileNotFoundError):
+                self._path(key).unlink()
+            with contextlib.suppress(FileNotFoundError):
+                self._lock_path(key).unlink()
@@ -0,0 +1,51 @@
+import concurrent.futures
+
+import numpy as np
+
+from full_clifford_sim.artifact_cache import ArtifactCache
+
+
+def _entry(k: int) -> dict:
+    "About 8kB that doesn't compress, starting with k"
+    data = np.random.default_rng(k).integers(1 << 62, size=1000)
+    data[0] = k
+    return {'data': data}
+
+
+def test_get_or_build_round_trip(tmp_path):
+    cache = ArtifactCache(tmp_path)
+    key = ArtifactCache.key(kind='test', k=1)
+    assert cache.get(key) is None
+    np.testing.assert_array_equal(cache.get_or_build(key, lambda: _entry(1))['data'], _entry(1)['data'])
+    np.testing.assert_array_equal(cache.get(key)['data'], _entry(1)['data'])
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_eviction_removes_locks_and_spares_temp_files(tmp_path):
+    cache = ArtifactCache(tmp_path, max_bytes=1)
+    in_flight = tmp_path / '.somekey.12345.npz'
+    np.savez(in_flight, data=np.zeros(10))
+    cache.get(ArtifactCache.key(kind='test', k=-1))
+    for k in range(5):
+        cache.get_or_build(ArtifactCache.key(kind='test', k=k), lambda: _entry(k))
+
+    assert in_flight.exists()
+    last = ArtifactCache.key(kind='test', k=4)
+    assert sorted(p.name for p in tmp_path.glob('[!.]*')) == [f'{last}.npz']
+    assert sorted(p.name for p in tmp_path.glob('.*.lock')) == sorted(['.evict.lock', f'.{last}.lock'])
+
+
+def _hammer(directory: str, worker: int) -> int:
+    cache = ArtifactCache(directory, max_bytes=20_000)
+    rng = np.random.default_rng(worker)
+    for k in rng.integers(10, size=200).tolist():
+        entry = cache.get_or_build(ArtifactCache.key(kind='test', k=k), lambda: _entry(k))
+        assert entry['data'][0] == k
+    return cache.misses
+
+
+def test_concurrent_workers_with_eviction(tmp_path):
+    with concurrent.futures.ProcessPoolExecutor(4) as executor:
+        misses = list(executor.map(_hammer, [str(tmp_path)] * 4, range(4)))
+    # Entries were evicted and rebuilt.
+    assert sum(misses) > 40
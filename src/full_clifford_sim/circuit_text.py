@@ -0,0 +1,49 @@
+from typing import Iterable
+
+import numpy as np
+import stim
+
+
+class CircuitText:
+    """Writes instructions out as lines of text, to be parsed into a stim circuit in one go.
+
+    stim.Circuit.append costs tens of microseconds per target, and every
+    small circuit parsed and added with += is another copy, which adds up for
+    gates spanning a large surface code. Appending here only formats the
+    instruction as a line, and to_circuit parses all the lines at once.
+    """
+
+    def __init__(self):
+        self.lines: list[str] = []
+
+    def append(self,
+               name: str,
+               targets: Iterable[int | str] | int | str = (),
+               args: Iterable[float] = ()) -> None:
+        """Adds an instruction, like stim.Circuit.append(name, targets, args).
+
+        Targets are qubit indices or target strings like 'rec[-1]'. A single
+        string is taken to be all the targets, already written out.
+        """
+        if isinstance(targets, str):
+            targets_text = targets
+        else:
+            if isinstance(targets, np.ndarray):
+                targets = targets.ravel().tolist()
+            elif isinstance(targets, (int, np.integer)):
+                targets = [int(targets)]
+            targets_text = ' '.join(map(str, targets))
+        args = list(args)
+        if args:
+            name = f'{name}({", ".join(map(repr, args))})'
+        self.lines.append(f'{name} {targets_text}' if targets_text else name)
+
+    def append_text(self, text: str) -> None:
+        "Adds lines that are already circuit text, e.g. str(instruction)"
+        self.lines.append(text)
+
+    def to_text(self) -> str:
+        return '\n'.join(self.lines)
+
+    def to_circuit(self) -> stim.Circuit:
+        return stim.Circuit(self.to_text())
@@ -2,6 +2,7 @@ from dataclasses import dataclass
 import stim
 import numpy as np
 from typing import Tuple, List
+from full_clifford_sim.circuit_text import CircuitText
 
 @dataclass
 class RotSurfCodeCoords:
@@ -62,6 +63,31 @@ class RotSurfCodeCoords:
         return int(qsc * self.no1SCQubits + 2*scA +1)
 
 
+    def valid_ancilla_mask(self, a: np.ndarray, d_rest: int = None) -> np.ndarray:
+        "is_valid_ancilla of every entry of an integer array"
+        a = np.asarray(a)
+        if d_rest is None:
+            dx, dy = self.dx, self.dy
+        else:
+            dx, dy = d_rest, d_rest
+
+        xind = (a // 2) % (self.dx + 1)
+        yind = (a // 2) // (self.dx + 1)
+
+        return ((a >= 0)
+                & ~((yind == 0) & (xind % 2 == 1)) # top
+                & ~((xind == 0) & (yind % 2 == 0)) # left
+                & ~((yind == dy) & (xind % 2 == 0)) # bottom
+                & ~((xind == dx) & (yind % 2 == 1)) # right
+                & (xind <= dx) & (yind <= dy))
+
+
+    def Xstab_mask(self, a: np.ndarray) -> np.ndarray:
+        "is_Xstab of every entry of an integer array"
+        a = (np.asarray(a) % self.no1SCQubits) // 2
+        return (a % (self.dx + 1) + a // (self.dx + 1)) % 2 == 0
+
+
     def __post_init__(self):
         "Initialize qubit and gate arrays"
         dx = self.dx
@@ -73,67 +99,69 @@ class RotSurfCodeCoords:
         
         roughAncillas = 2*np.arange((dx+1)*(dy+1))+ 1 
         
-        self.ancillaQubits = np.array([a for a in roughAncillas 
-                                       if self.is_valid_ancilla(a)])
+        validAncilla = self.valid_ancilla_mask(roughAncillas)
+        self.ancillaQubits = roughAncillas[validAncilla]
         
-        self.XancillaQubits = np.array([a for a in self.ancillaQubits
-                                       if self.is_Xstab(a)])
+        isX = self.Xstab_mask(self.ancillaQubits)
+        self.XancillaQubits = self.ancillaQubits[isX]
         
-        self.ZancillaQubits = np.array([a for a in self.ancillaQubits
-                                       if not self.is_Xstab(a)])
-
-        self.allQubits = np.array(list(self.ancillaQubits) 
-                                  + list(self.dataQubits))
-
-        #use a CNOT-only gateset
-        stepGates = [[],[],[],[]]
-
-        for q in self.dataQubits:
-            nwA = self.nw_ancilla(q)
-            swA = nwA + 2*(self.dx+1)
-            neA = nwA + 2
-            seA = swA + 2
-
-            parityOrder = [[swA,seA,nwA,neA],[swA,nwA,seA,neA]]
-            qOrder = self.q_parity(q)
-
-            for step in range(4):
-                stepA = parityOrder[qOrder][step]
-                if stepA in self.ancillaQubits:
-                    if self.is_Xstab(stepA):
-                        stepGates[step] += [stepA,q]
-                    elif not self.is_Xstab(stepA):
-                        stepGates[step] += [q, stepA]
-
+        self.ZancillaQubits = self.ancillaQubits[~isX]
+
+        self.allQubits = np.concatenate([self.ancillaQubits, self.dataQubits])
+
+        #use a CNOT-only gateset, data qubits in order, each with the
+        #ancillas around it in an order set by its parity
+        q = self.dataQubits
+        qx = (q // 2) % dx
+        qy = (q // 2) // dx
+        nwA = 2*((dx+1)*qy + qx) + 1
+        swA = nwA + 2*(dx+1)
+        neA = nwA + 2
+        seA = swA + 2
+        qOrder = (qx + qy) % 2 == 1
+        parityOrder = [
+            swA,
+            np.where(qOrder, nwA, seA),
+            np.where(qOrder, seA, nwA),
+            neA,
+        ]
+
+        inSC = np.zeros(self.no1SCQubits, dtype=np.bool_)
+        inSC[self.allQubits] = True
+
+        stepGates = []
+        idleQubits = []
+        for stepA in parityOrder:
+            #every candidate is a rough ancilla, which is in the code if valid
+            inCode = validAncilla[stepA // 2]
+            a = stepA[inCode]
+            d = q[inCode]
+            aIsX = self.Xstab_mask(a)
+            pairs = np.stack([np.where(aIsX, a, d), np.where(aIsX, d, a)], axis=1)
+            stepGates.append(pairs.ravel())
+
+            busy = np.zeros(self.no1SCQubits, dtype=np.bool_)
+            busy[pairs.ravel()] = True
+            idleQubits.append(np.flatnonzero(inSC & ~busy).tolist())
 
         self.stepGates = np.array(stepGates)
-
-        idleQubits = [[],[],[],[]]
-        for step in range(4):
-            idleQubits[step] = list(set(self.allQubits) 
-                                    - (set(stepGates[step])))
         self.idleQubits = idleQubits
 
     
     def layout_coords(self) -> stim.Circuit:
         "Initialize a stim circuit with the qubits in SC config"
 
-        scCirc = stim.Circuit()
+        dq = self.dataQubits // 2
+        aq = self.ancillaQubits // 2
+        qubits = np.concatenate([self.dataQubits, self.ancillaQubits])
+        qc_x = np.concatenate([dq % self.dx, aq % (self.dx+1) - 0.5])
+        qc_y = np.concatenate([dq // self.dx, aq // (self.dx+1) - 0.5])
 
-        for dq in self.dataQubits:
-            qc = dq/2
-            qc_x = qc % self.dx 
-            qc_y = qc //self.dx 
-            scCirc.append("QUBIT_COORDS",  
-                dq, (qc_x, qc_y,0))
-
-        for aq in self.ancillaQubits:
-            scCirc.append(
-               "QUBIT_COORDS", 
-                aq, 
-                self.ancilla_coords(aq))
-
-        return scCirc
+        #one parse is much faster than appending qubit by qubit
+        coords = CircuitText()
+        for q, x, y in zip(qubits.tolist(), qc_x.tolist(), qc_y.tolist()):
+            coords.append('QUBIT_COORDS', q, (x, y, 0))
+        return coords.to_circuit()
 
     def ancilla_coords(self, aq: int) -> Tuple:
         "Returns a tuple of ancilla coordinates"
@@ -150,22 +178,16 @@ class RotSurfCodeCoords:
         filtered_step_gates =[]
 
         for this_step_gates in self.stepGates:
-            edited_sg = []
-            for i in range(len(this_step_gates)// 2):
-                q1 = this_step_gates[2*i]
-                q2 = this_step_gates[2*i +1]
-                dq = q1 if q1 % 2 == 0 else q2
-                aq = q1 if q1 % 2 != 0 else q2
-
-                dq_x = (dq / 2) % self.dx 
-                dq_y = (dq / 2) //self.dx 
-
-                if (dq_x < d_rest and dq_y < d_rest):
-                    if self.is_valid_ancilla(aq, d_rest=d_rest):
-                        edited_sg.extend([q1, q2])
-
-            filtered_step_gates.append(edited_sg)
+            pairs = this_step_gates.reshape(-1, 2)
+            firstIsData = pairs[:, 0] % 2 == 0
+            dq = np.where(firstIsData, pairs[:, 0], pairs[:, 1])
+            aq = np.where(firstIsData, pairs[:, 1], pairs[:, 0])
 
-        return filtered_step_gates    
+            dq_x = (dq // 2) % self.dx 
+            dq_y = (dq // 2) //self.dx 
 
+            keep = ((dq_x < d_rest) & (dq_y < d_rest)
+                    & self.valid_ancilla_mask(aq, d_rest=d_rest))
+            filtered_step_gates.append(pairs[keep].ravel())
 
+        return filtered_step_gates
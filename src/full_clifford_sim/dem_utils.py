@@ -1,11 +1,15 @@
 import collections
+import concurrent.futures
 import dataclasses
-import itertools
+import functools
+import heapq
+import re
 from typing import Callable, DefaultDict, Any, TypeVar, Iterable
 
-import sinter
 import stim
 
+from full_clifford_sim.parallel import process_pool
+
 TItem = TypeVar("TItem")
 
 
@@ -42,23 +46,32 @@ def xor_sorted(
 
 @dataclasses.dataclass(frozen=True)
 class Symptom:
+    """The detectors and observables flipped by an error.
+
+    dets is a bitmask over detector ids and obs_mask a bitmask over observable
+    ids, so combining symptoms is an xor of two ints.
+    """
     obs_mask: int = 0
-    dets: frozenset[int] = frozenset()
+    dets: int = 0
 
     @staticmethod
     def from_dem_targets(targets: list[stim.DemTarget]) -> 'Symptom':
         obs_mask = 0
-        dets = []
+        dets = 0
         for t in targets:
             if t.is_separator():
                 pass
             elif t.is_relative_detector_id():
-                dets.append(t.val)
+                dets ^= 1 << t.val
             elif t.is_logical_observable_id():
                 obs_mask ^= 1 << t.val
             else:
                 raise NotImplementedError(f'{t=}')
-        return Symptom(obs_mask=obs_mask, dets=frozenset(xor_sorted(dets)))
+        return Symptom(obs_mask=obs_mask, dets=dets)
+
+    @property
+    def num_dets(self) -> int:
+        return self.dets.bit_count()
 
     def __mul__(self, other: 'Symptom') -> 'Symptom':
         return Symptom(
@@ -71,76 +84,318 @@ def bernoulli_sum(p: float, q: float) -> float:
     return p * (1 - q) + q * (1 - p)
 
 
+def _bits(mask: int) -> list[int]:
+    "Positions of the set bits of mask, lowest first"
+    result = []
+    while mask:
+        low = mask & -mask
+        result.append(low.bit_length() - 1)
+        mask ^= low
+    return result
+
+
+def _one_bit_partners(left: list[int], right: list[int]) -> list[list[int]]:
+    """For each left mask, the sorted indices of right masks differing from it in one bit.
+
+    This is a hash join: right masks are indexed both as themselves and with
+    each of their bits removed.
+    """
+    exact = collections.defaultdict(list)
+    minus_one = collections.defaultdict(list)
+    for j, u in enumerate(right):
+        exact[u].append(j)
+        for b in _bits(u):
+            minus_one[u ^ (1 << b)].append(j)
+    result = []
+    for u in left:
+        partners = list(minus_one.get(u, ()))
+        for b in _bits(u):
+            partners.extend(exact.get(u ^ (1 << b), ()))
+        partners.sort()
+        result.append(partners)
+    return result
+
+
+def _compressed_components(error_items: list[tuple[tuple[int, int], float]], compressed_mask: int) -> dict[int, int]:
+    """Maps each compressed detector to a representative of its connected component.
+
+    Two compressed detectors are connected when an error flips both.
+    """
+    parent = {}
+
+    def find(b: int) -> int:
+        while parent.setdefault(b, b) != b:
+            parent[b] = parent[parent[b]]
+            b = parent[b]
+        return b
+
+    for (d, _), _ in error_items:
+        bits = _bits(d & compressed_mask)
+        for b in bits[1:]:
+            parent[find(b)] = find(bits[0])
+    return {b: find(b) for b in parent}
+
+
+def _shards(group_keys: list[int],
+            weights: list[int],
+            components: dict[int, int],
+            num_shards: int) -> list[list[int]]:
+    """Splits item indices into at most num_shards shards of roughly equal weight.
+
+    group_keys holds each item's compressed detector bitmask. Items of the same
+    connected component go to the same shard, unless the component outweighs a
+    fair share of the work, in which case it is split into its groups of items
+    with equal group_keys. Groups are never split. Each shard lists its items
+    in their original order.
+    """
+    if num_shards <= 1:
+        return [list(range(len(group_keys)))]
+    groups = collections.defaultdict(list)
+    for i, key in enumerate(group_keys):
+        groups[key].append(i)
+    by_component = collections.defaultdict(list)
+    for key, members in groups.items():
+        by_component[components.get((key & -key).bit_length() - 1, -1)].append(members)
+
+    target = sum(weights) / num_shards
+    units = []
+    for members in by_component.values():
+        unit = [i for group in members for i in group]
+        if sum(weights[i] for i in unit) > target:
+            units.extend(members)
+        else:
+            units.append(unit)
+
+    # Heaviest first, each onto the lightest shard so far.
+    unit_weights = [sum(weights[i] for i in unit) for unit in units]
+    shards = [(0, k, []) for k in range(num_shards)]
+    for u in sorted(range(len(units)), key=lambda u: -unit_weights[u]):
+        weight, k, shard = heapq.heappop(shards)
+        shard.extend(units[u])
+        heapq.heappush(shards, (weight + unit_weights[u], k, shard))
+    return [sorted(shard) for _, _, shard in sorted(shards, key=lambda e: e[1]) if shard]
+
+
+def _terms_per_item(fn: Callable[[list], Iterable], items: list) -> list[list]:
+    return [list(fn([item])) for item in items]
+
+
+def _ordered_terms(fn: Callable[[list], Iterable],
+                   items: list,
+                   shards: list[list[int]],
+                   executor: concurrent.futures.Executor | None) -> Iterable:
+    """Yields the terms fn yields for each item, in the order of items.
+
+    With an executor, each shard of item indices is handed to a worker and the
+    terms are put back in item order, so sums over them don't change.
+    """
+    if executor is None:
+        yield from fn(items)
+        return
+    terms = [None] * len(items)
+    shard_items = [[items[i] for i in shard] for shard in shards]
+    for shard, shard_terms in zip(shards, executor.map(_terms_per_item, [fn] * len(shards), shard_items)):
+        for i, item_terms in zip(shard, shard_terms):
+            terms[i] = item_terms
+    for item_terms in terms:
+        yield from item_terms
+
+
+def _extended_combinations(items: list[tuple[tuple[int, int], float]],
+                           *,
+                           error_items: list[tuple[tuple[int, int], float]],
+                           errors_by_size: dict[int, list[int]],
+                           errors_by_det: dict[int, list[int]],
+                           detection_event_cutoff: int,
+                           lvl: int) -> Iterable[tuple[tuple[int, int], float]]:
+    "Yields the terms of combining each of items with one more error"
+    for (d1, o1), p1 in items:
+        # Symptoms whose sizes add up past the cutoff must share a detector.
+        n1 = d1.bit_count()
+        candidates = set()
+        for n2 in range(detection_event_cutoff - n1 + 1):
+            candidates.update(errors_by_size.get(n2, ()))
+        for b in _bits(d1):
+            candidates.update(errors_by_det.get(b, ()))
+        for j in sorted(candidates):
+            (d2, o2), p2 = error_items[j]
+            d3 = d1 ^ d2
+            if d3.bit_count() <= detection_event_cutoff:
+                yield (d3, o1 ^ o2), p1 * p2 / lvl
+
+
+def _joined_combinations(pairs: list[tuple[list, list | None]],
+                         *,
+                         compressed_mask: int,
+                         divisor: float) -> Iterable[tuple[tuple[int, int], float]]:
+    """Yields the terms of joining groups of partial combinations into single detector errors.
+
+    pairs holds (matches1, matches2) groups sharing their compressed detectors.
+    When matches2 is None, matches1 is joined with itself, each unordered pair
+    once.
+    """
+    for matches1, matches2 in pairs:
+        rest1 = [d & ~compressed_mask for (d, _), _ in matches1]
+        if matches2 is None:
+            for i, partners in enumerate(_one_bit_partners(rest1, rest1)):
+                (d1, o1), p1 = matches1[i]
+                for j in partners:
+                    if j <= i:
+                        continue
+                    (d2, o2), p2 = matches1[j]
+                    yield (d1 ^ d2, o1 ^ o2), p1 * p2 / divisor
+        else:
+            partners = _one_bit_partners(rest1, [d & ~compressed_mask for (d, _), _ in matches2])
+            for ((d1, o1), p1), js in zip(matches1, partners):
+                for j in js:
+                    (d2, o2), p2 = matches2[j]
+                    yield (d1 ^ d2, o1 ^ o2), p1 * p2 / divisor
+
+
 def bernoulli_combo(*,
                     errors: dict[Symptom, float],
                     compressed_dets: frozenset[int],
                     max_errors: int,
                     error_size_cutoff: int,
-                    detection_event_cutoff: int) -> dict[int, tuple[int, float]]:
+                    detection_event_cutoff: int,
+                    epsilon: float = 0.0,
+                    best_path: dict[int, float] | None = None,
+                    report: dict[str, float] | None = None,
+                    num_workers: int = 1) -> dict[int, tuple[int, float]]:
+    """Folds combinations of up to max_errors errors into single detector errors.
+
+    Symptoms are (detector bitmask, observable bitmask) pairs. Pairs of
+    symptoms are only formed when they can pass the detection event cutoff (or,
+    past half of max_errors, when they reduce to a single detector), and are
+    visited in the same order as the plain nested loops would visit them, so
+    the floating point sums are unchanged.
+
+    With epsilon > 0, partial combinations of two or more errors are dropped
+    (along with everything that would extend them) when their probability is
+    below epsilon times the best path into the uncompressed detectors they
+    flip. The best path into a detector is its folded error probability when
+    at most two errors are combined, unless best_path says otherwise. Partial
+    combinations without a known best path are kept. If report is given,
+    'discarded_mass' and 'discarded_combinations' are added to it.
+
+    With num_workers > 1, extending partial combinations and joining the
+    groups that share compressed detectors are spread over a process pool,
+    sharded by connected component of the compressed detectors. The terms
+    each worker produces are added up in the serial order, so the result is
+    identical.
+    """
+    if report is not None:
+        report.setdefault('discarded_mass', 0.0)
+        report.setdefault('discarded_combinations', 0)
     if max_errors == 0:
         return {}
 
+    compressed_mask = 0
+    for d in compressed_dets:
+        compressed_mask |= 1 << d
+
+    if epsilon > 0 and best_path is None:
+        best_path = {
+            d: p
+            for d, (_, p) in bernoulli_combo(
+                errors=errors,
+                compressed_dets=compressed_dets,
+                max_errors=min(max_errors, 2),
+                error_size_cutoff=error_size_cutoff,
+                detection_event_cutoff=detection_event_cutoff,
+                num_workers=num_workers,
+            ).items()
+        }
+
     errors = {
-        k: v
+        (k.dets, k.obs_mask): v
         for k, v in errors.items()
-        if 1 <= len(k.dets) <= error_size_cutoff
-        if not k.dets.isdisjoint(compressed_dets)
+        if 1 <= k.num_dets <= error_size_cutoff
+        if k.dets & compressed_mask
     }
-
-    levels = [
-        {},
-        errors,
-    ]
-    while (len(levels) - 1) * 2 < max_errors:
-        lvl = len(levels) + 1
-        next_level: DefaultDict[Symptom, float] = collections.defaultdict(float)
-        for s1, p1 in levels[-1].items():
-            for s2, p2 in errors.items():
-                s3: Symptom = s1 * s2
-                p3: float = p1 * p2
-                if len(s3.dets) <= detection_event_cutoff:
-                    next_level[s3] += p3 / lvl
-        if Symptom() in next_level:
-            del next_level[Symptom()]
-        levels.append(next_level)
-    groups = [
-        sinter.group_by(level.items(), key=lambda e: e[0].dets & compressed_dets)
-        for level in levels
-    ]
-    while len(levels) <= max_errors:
-        lvl = len(levels)
-        next_level: DefaultDict[Symptom, float] = collections.defaultdict(float)
-        if lvl % 2 == 0:
-            g = groups[lvl // 2]
-            divisor = lvl * lvl / 4
-            for matches in g.values():
-                for (s1, p1), (s2, p2) in itertools.combinations(matches, 2):
-                    net_symptom = s1 * s2
-                    net_p = p1 * p2
-                    next_level[net_symptom] += net_p / divisor
-        else:
-            k1 = lvl // 2
-            k2 = lvl - lvl // 2
-            g1 = groups[k1]
-            g2 = groups[k2]
-            divisor = k1 * k2
-            for det_key, matches1 in g1.items():
-                matches2 = g2.get(det_key)
-                if matches2 is None:
-                    continue
-                for s1, p1 in matches1:
-                    for s2, p2 in matches2:
-                        net_symptom = s1 * s2
-                        net_p = p1 * p2
-                        next_level[net_symptom] += net_p / divisor
-        levels.append(next_level)
+    error_items = list(errors.items())
+
+    # Errors by size and by detector, to find the ones a symptom can combine with.
+    errors_by_size = collections.defaultdict(list)
+    errors_by_det = collections.defaultdict(list)
+    for j, ((d, _), _) in enumerate(error_items):
+        errors_by_size[d.bit_count()].append(j)
+        for b in _bits(d):
+            errors_by_det[b].append(j)
+
+    # Work is sharded by connected component of the compressed detectors (or,
+    # for components too big to balance, by group of partial combinations
+    # sharing compressed detectors). Terms are summed in the serial order, so
+    # the result does not depend on num_workers.
+    components = _compressed_components(error_items, compressed_mask)
+    num_shards = 1 if num_workers <= 1 else 4 * num_workers
+    with process_pool(num_workers) as executor:
+        levels = [
+            {},
+            errors,
+        ]
+        while (len(levels) - 1) * 2 < max_errors:
+            lvl = len(levels) + 1
+            next_level: DefaultDict[tuple[int, int], float] = collections.defaultdict(float)
+            extend = functools.partial(
+                _extended_combinations,
+                error_items=error_items,
+                errors_by_size=errors_by_size,
+                errors_by_det=errors_by_det,
+                detection_event_cutoff=detection_event_cutoff,
+                lvl=lvl,
+            )
+            items = list(levels[-1].items())
+            shards = None
+            if executor is not None:
+                shards = _shards([d & compressed_mask for (d, _), _ in items], [1] * len(items), components, num_shards)
+            for key, p in _ordered_terms(extend, items, shards, executor):
+                next_level[key] += p
+            if (0, 0) in next_level:
+                del next_level[(0, 0)]
+            if epsilon > 0:
+                next_level = _pruned_level(next_level, compressed_mask, epsilon, best_path, report)
+            levels.append(next_level)
+        groups = []
+        for level in levels:
+            group = collections.defaultdict(list)
+            for item in level.items():
+                group[item[0][0] & compressed_mask].append(item)
+            groups.append(group)
+
+        # Beyond this point only combinations that leave a single uncompressed
+        # detector contribute to the result. Within a group the compressed parts
+        # cancel, so those are the pairs whose uncompressed parts differ in one bit.
+        while len(levels) <= max_errors:
+            lvl = len(levels)
+            next_level: DefaultDict[tuple[int, int], float] = collections.defaultdict(float)
+            if lvl % 2 == 0:
+                divisor = lvl * lvl / 4
+                pairs = [(matches, None) for matches in groups[lvl // 2].values()]
+            else:
+                k1 = lvl // 2
+                k2 = lvl - lvl // 2
+                g2 = groups[k2]
+                divisor = k1 * k2
+                pairs = [
+                    (matches1, g2[det_key])
+                    for det_key, matches1 in groups[k1].items()
+                    if det_key in g2
+                ]
+            join = functools.partial(_joined_combinations, compressed_mask=compressed_mask, divisor=divisor)
+            shards = None
+            if executor is not None:
+                weights = [len(m1) + len(m2 or ()) for m1, m2 in pairs]
+                shards = _shards([m1[0][0][0] & compressed_mask for m1, _ in pairs], weights, components, num_shards)
+            for key, p in _ordered_terms(join, pairs, shards, executor):
+                next_level[key] += p
+            levels.append(next_level)
 
     total = collections.defaultdict(lambda: collections.defaultdict(float))
     for level in levels:
-        for s, p in level.items():
-            if len(s.dets) == 1 and s.dets.isdisjoint(compressed_dets):
-                d, = s.dets
-                total[d][s.obs_mask] += p
+        for (d, obs_mask), p in level.items():
+            if d.bit_count() == 1 and not d & compressed_mask:
+                total[d.bit_length() - 1][obs_mask] += p
 
     result = {}
     for d, obs_p in total.items():
@@ -150,15 +405,65 @@ def bernoulli_combo(*,
     return result
 
 
+def _pruned_level(level: dict[tuple[int, int], float],
+                  compressed_mask: int,
+                  epsilon: float,
+                  best_path: dict[int, float],
+                  report: dict[str, float] | None) -> dict[tuple[int, int], float]:
+    "Drops the symptoms of a level that are much less likely than the best path into their detectors"
+    kept = {}
+    discarded_mass = 0.0
+    discarded = 0
+    for (d, o), p in level.items():
+        reference = max((best_path.get(b, 0.0) for b in _bits(d & ~compressed_mask)), default=0.0)
+        if p < epsilon * reference:
+            discarded_mass += p
+            discarded += 1
+        else:
+            kept[(d, o)] = p
+    if report is not None:
+        report['discarded_mass'] += discarded_mass
+        report['discarded_combinations'] += discarded
+    return kept
+
+
+_DEM_INSTRUCTION = re.compile(r'^(([a-z_]+)(?:\[[^\]]*\])?(?:\([^)]*\))?)\s*(.*)$')
+
+
+def _parse_dem_error_line(head: str, rest: str) -> tuple[float, list[int], int]:
+    """Splits an 'error[tag](p) D0 D1 ^ L0' line into p, the detectors, and the observable mask.
+
+    head and rest are the instruction and target groups _DEM_INSTRUCTION matched.
+    """
+    p = float(head[head.rindex('(') + 1:-1])
+    dets = []
+    obs_mask = 0
+    for token in rest.split():
+        if token[0] == 'D':
+            dets.append(int(token[1:]))
+        elif token[0] == 'L':
+            obs_mask ^= 1 << int(token[1:])
+        elif token != '^':
+            raise NotImplementedError(f'{token=}')
+    return p, dets, obs_mask
+
+
 def dem_with_compressed_detectors(
         dem: stim.DetectorErrorModel,
         compressed_detector_predicate: Callable[[list[float]], bool],
         max_compressed_errors: int,
         error_size_cutoff: int,
         detection_event_cutoff: int,
+        epsilon: float = 0.0,
+        report: dict[str, float] | None = None,
+        num_workers: int = 1,
 ) -> stim.DetectorErrorModel:
+    """Replaces the errors touching compressed detectors by single detector errors.
+
+    See bernoulli_combo for max_compressed_errors, the cutoffs, epsilon,
+    report and num_workers.
+    """
     d2c = dem.get_detector_coordinates()
-    out_dem = stim.DetectorErrorModel()
     compressed_dets = frozenset(
         det
         for det in range(dem.num_detectors)
@@ -167,18 +472,25 @@ def dem_with_compressed_detectors(
     if not compressed_dets:
         return dem
 
-    dem = dem.flattened()
+    # Scanning the flattened DEM's text (which round trips exactly) is much
+    # faster than going through its instructions and targets one by one.
+    kept_lines = []
     error_sets: DefaultDict[Symptom, float] = collections.defaultdict(float)
-    for inst in dem:
-        if inst.type != 'error':
-            out_dem.append(inst)
+    for line in str(dem.flattened()).splitlines():
+        m = _DEM_INSTRUCTION.match(line)
+        if m is None or m.group(2) != 'error':
+            kept_lines.append(line)
             continue
-        targets = inst.targets_copy()
-        if not any(d.is_relative_detector_id() and d.val in compressed_dets for d in targets):
-            out_dem.append(inst)
+        p, dets, obs_mask = _parse_dem_error_line(m.group(1), m.group(3))
+        if compressed_dets.isdisjoint(dets):
+            kept_lines.append(line)
             continue
-        symptom = Symptom.from_dem_targets(targets)
-        error_sets[symptom] = bernoulli_sum(error_sets[symptom], inst.args_copy()[0])
+        det_mask = 0
+        for d in dets:
+            det_mask ^= 1 << d
+        symptom = Symptom(obs_mask=obs_mask, dets=det_mask)
+        error_sets[symptom] = bernoulli_sum(error_sets[symptom], p)
+    out_dem = stim.DetectorErrorModel('\n'.join(kept_lines))
 
     combos = bernoulli_combo(
         errors=error_sets,
@@ -186,6 +498,9 @@ def dem_with_compressed_detectors(
         max_errors=max_compressed_errors,
         error_size_cutoff=error_size_cutoff,
         detection_event_cutoff=detection_event_cutoff,
+        epsilon=epsilon,
+        report=report,
+        num_workers=num_workers,
     )
 
     for det, (obs, p) in combos.items():
@@ -206,39 +521,61 @@ def dem_with_replaced_targets(
         dem: stim.DetectorErrorModel,
         replacements: dict[stim.DemTarget, stim.DemTarget | None],
 ) -> stim.DetectorErrorModel:
-    new_dem = stim.DetectorErrorModel()
-
-    dem = dem.flattened()
-    for instruction in dem:
-        old_targets = instruction.targets_copy()
-        args = instruction.args_copy()
-        new_targets = [replacements.get(t, t) for t in old_targets]
-
-        # Delete targets mapped to None
-        if any(t is None for t in new_targets):
-            new_targets = [t for t in new_targets if t is not None]
-            # Fix separator issues created by removing the target.
-            while new_targets and new_targets[0].is_separator():
-                new_targets.pop(0)
-            while new_targets and new_targets[-1].is_separator():
-                new_targets.pop()
-            for k in range(len(new_targets) - 1)[::-1]:
-                if new_targets[k].is_separator() and new_targets[k + 1].is_separator():
-                    new_targets.pop(k + 1)
-            if old_targets and not new_targets:
+    """Replaces the targets of a DEM, deleting the ones mapped to None.
+
+    See dem_text_with_replaced_targets.
+    """
+    return stim.DetectorErrorModel(dem_text_with_replaced_targets(dem, replacements))
+
+
+def dem_text_with_replaced_targets(
+        dem: stim.DetectorErrorModel,
+        replacements: dict[stim.DemTarget, stim.DemTarget | None],
+) -> str:
+    """The text of the flattened DEM with its targets replaced.
+
+    Targets mapped to None are deleted, along with the separators that this
+    leaves at either end of an error or next to another separator, and with
+    the instructions left without targets. Detector instructions whose
+    targets become observables are split into a logical_observable and a
+    detector instruction.
+
+    Works line by line on the flattened DEM's text (which round trips
+    exactly), instead of copying the targets of every instruction.
+    """
+    replaced = {
+        str(k): None if v is None else str(v)
+        for k, v in replacements.items()
+    }
+    out = []
+    for line in str(dem.flattened()).splitlines():
+        m = _DEM_INSTRUCTION.match(line)
+        if m is None:
+            raise NotImplementedError(f'{line=}')
+        head, kind, rest = m.groups()
+        old_targets = rest.split()
+        targets = []
+        for t in old_targets:
+            t = replaced.get(t, t)
+            if t is None:
                 continue
+            if t == '^' and (not targets or targets[-1] == '^'):
+                continue
+            targets.append(t)
+        if targets and targets[-1] == '^':
+            targets.pop()
+        if old_targets and not targets:
+            continue
 
-        new_targets = [t for t in new_targets if t is not None]
-        if instruction.type == 'error':
-            new_dem.append(instruction.type, args, new_targets)
-        elif instruction.type == 'logical_observable' or instruction.type == 'detector':
-            obs = [t for t in new_targets if t.is_logical_observable_id()]
-            det = [t for t in new_targets if t.is_relative_detector_id()]
+        if kind == 'error':
+            out.append(f'{head} {" ".join(targets)}')
+        elif kind == 'logical_observable' or kind == 'detector':
+            obs = [t for t in targets if t[0] == 'L']
+            det = [t for t in targets if t[0] == 'D']
             if obs:
-                new_dem.append('logical_observable', [], obs)
+                out.append(f'logical_observable {" ".join(obs)}')
             if det:
-                new_dem.append('detector', args, det)
+                out.append(f'{head.replace("logical_observable", "detector", 1)} {" ".join(det)}')
         else:
-            raise NotImplementedError(f'{instruction=}')
-
-    return new_dem
+            raise NotImplementedError(f'{line=}')
+    return '\n'.join(out)
@@ -0,0 +1,44 @@
+import concurrent.futures
+import multiprocessing
+
+import stim
+
+from full_clifford_sim.dem_utils import dem_with_compressed_detectors
+from full_clifford_sim.gap_sampler import _COMPRESSION_PARAMS, is_postselected
+from full_clifford_sim.main_complied_fxns import full_circuit
+
+
+def _dem() -> stim.DetectorErrorModel:
+    circuit = full_circuit(0.001, 5, 'hookinj', verify=False)
+    return circuit.detector_error_model(approximate_disjoint_errors=True)
+
+
+def test_tagged_errors_are_compressed():
+    dem = _dem()
+    tagged = stim.DetectorErrorModel(str(dem.flattened()).replace('error(', 'error[tagged]('))
+    expected = dem_with_compressed_detectors(dem, is_postselected, **_COMPRESSION_PARAMS)
+    actual = dem_with_compressed_detectors(tagged, is_postselected, **_COMPRESSION_PARAMS)
+    assert str(actual).replace('[tagged]', '') == str(expected)
+
+
+def _compressed_text(num_workers: int) -> str:
+    params = {**_COMPRESSION_PARAMS, 'max_compressed_errors': 4, 'epsilon': 1e-3}
+    return str(dem_with_compressed_detectors(_dem(), is_postselected, num_workers=num_workers, **params))
+
+
+def _compressed_text_in_daemon(num_workers: int, queue: multiprocessing.Queue) -> None:
+    queue.put(_compressed_text(num_workers))
+
+
+def test_parallel_compression_matches_serial():
+    expected = _compressed_text(1)
+    assert _compressed_text(2) == expected
+    # From inside a pool worker, which starts its own pool.
+    with concurrent.futures.ProcessPoolExecutor(1) as executor:
+        assert executor.submit(_compressed_text, 2).result() == expected
+    # From inside a daemonic process, which can't.
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_compressed_text_in_daemon, args=(2, queue), daemon=True)
+    process.start()
+    assert queue.get(timeout=300) == expected
+    process.join()
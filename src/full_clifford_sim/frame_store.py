@@ -0,0 +1,382 @@
+import fcntl
+import hashlib
+import os
+import pathlib
+
+import numpy as np
+import stim
+
+from full_clifford_sim.qubit_map import relabeled_target
+from full_clifford_sim.two_stage_sampler import _measurement_lookback
+
+
+FORMAT_VERSION = 1
+
+
+def _without_qubit_coords(circuit: stim.Circuit) -> stim.Circuit:
+    "Drops top level QUBIT_COORDS, which do not affect sampling"
+    result = stim.Circuit()
+    for inst in circuit:
+        if isinstance(inst, stim.CircuitRepeatBlock) or inst.name != 'QUBIT_COORDS':
+            result.append(inst)
+    return result
+
+
+def _first_use_order(circuit: stim.Circuit) -> list[int]:
+    "Qubits of a circuit in the order they are first operated on"
+    order = {}
+    for inst in circuit.flattened():
+        for t in inst.targets_copy():
+            if t.is_qubit_target or t.is_x_target or t.is_y_target or t.is_z_target:
+                order.setdefault(t.value, len(order))
+    return list(order)
+
+
+def canonical_prefix(circuit: stim.Circuit,
+                     num_instructions: int,
+                     postselected: np.ndarray) -> tuple[stim.Circuit, np.ndarray, str]:
+    """Cuts the handoff prefix off a circuit and fingerprints it.
+
+    The prefix is the first num_instructions instructions once QUBIT_COORDS are
+    dropped. Its qubits are renumbered in order of first use, and detector
+    coordinates are replaced by whether the detector is postselected. Two
+    circuits whose prefixes agree up to qubit labels and coordinates (e.g. the
+    same cultivation stage laid out for different dfinal) get the same hash.
+
+    Args:
+        circuit: The full circuit.
+        num_instructions: Length of the prefix, ignoring QUBIT_COORDS.
+        postselected: A boolean array over the circuit's detectors.
+
+    Returns:
+        A (prefix, qubits, hash) tuple. prefix uses the circuit's own qubit
+        labels, qubits[k] is the label of canonical qubit k, and hash is a
+        hex digest of the canonical prefix.
+    """
+    stripped = _without_qubit_coords(circuit)
+    if num_instructions > len(stripped):
+        raise ValueError(f"{num_instructions=} > {len(stripped)=}")
+    prefix = stripped[:num_instructions]
+    qubits = _first_use_order(prefix)
+    relabel = {q: k for k, q in enumerate(qubits)}
+
+    canonical = stim.Circuit()
+    det = 0
+    for inst in prefix.flattened():
+        if inst.name == 'DETECTOR':
+            canonical.append('DETECTOR', inst.targets_copy(), [float(postselected[det])])
+            det += 1
+            continue
+        if inst.name == 'SHIFT_COORDS':
+            continue
+        targets = [relabeled_target(t, relabel) for t in inst.targets_copy()]
+        canonical.append(inst.name, targets, inst.gate_args_copy())
+
+    digest = hashlib.sha256(f'v{FORMAT_VERSION}\n{canonical}'.encode()).hexdigest()
+    return prefix, np.array(qubits, dtype=np.int64), digest
+
+
+class FrameStore:
+    """Pauli frames of the shots that survived a circuit prefix.
+
+    This is the handoff format between the cultivation stage and the escape
+    stage. Every array is bit packed (little endian) with one row per kept shot:
+
+        xs, zs: the Pauli frame, over the prefix's canonical qubits.
+        measurements: measurement flips of every prefix measurement.
+        detectors: detector flips of every prefix detector.
+        observables: observable flips accumulated in the prefix.
+        shot_index: index of each kept shot among all sampled shots.
+
+    shots is the number of shots sampled, kept or not. num_instructions and
+    prefix_hash identify the prefix (see canonical_prefix). Stores are saved
+    as .npz files named after their prefix hash.
+    """
+
+    def __init__(self, *,
+                 prefix_hash: str,
+                 num_instructions: int,
+                 num_qubits: int,
+                 num_measurements: int,
+                 num_detectors: int,
+                 num_observables: int,
+                 shots: int,
+                 shot_index: np.ndarray,
+                 xs: np.ndarray,
+                 zs: np.ndarray,
+                 measurements: np.ndarray,
+                 detectors: np.ndarray,
+                 observables: np.ndarray):
+        self.prefix_hash = prefix_hash
+        self.num_instructions = num_instructions
+        self.num_qubits = num_qubits
+        self.num_measurements = num_measurements
+        self.num_detectors = num_detectors
+        self.num_observables = num_observables
+        self.shots = shots
+        self.shot_index = shot_index
+        self.xs = xs
+        self.zs = zs
+        self.measurements = measurements
+        self.detectors = detectors
+        self.observables = observables
+
+    @property
+    def kept_shots(self) -> int:
+        return len(self.shot_index)
+
+    @staticmethod
+    def sample(circuit: stim.Circuit,
+               postselected: np.ndarray,
+               num_instructions: int | None,
+               shots: int,
+               *,
+               max_batch_size: int = 1 << 14,
+               seed: int | None = None) -> 'FrameStore':
+        """Samples a circuit's prefix and keeps the frames of surviving shots.
+
+        Args:
+            circuit: A circuit starting with the prefix to sample. Only the
+                prefix is simulated.
+            postselected: A boolean array over the circuit's detectors.
+            num_instructions: Length of the prefix, ignoring QUBIT_COORDS. None
+                means the whole circuit.
+            shots: How many shots to sample.
+            max_batch_size: The most shots simulated at once.
+            seed: Seeds the simulator.
+        """
+        if num_instructions is None:
+            num_instructions = len(_without_qubit_coords(circuit))
+        prefix, qubits, prefix_hash = canonical_prefix(circuit, num_instructions, postselected)
+        ps = np.asarray(postselected[:prefix.num_detectors], dtype=np.bool_)
+        rng = np.random.default_rng(seed)
+        parts = {k: [] for k in ['shot_index', 'xs', 'zs', 'measurements', 'detectors', 'observables']}
+        for start in range(0, shots, max_batch_size):
+            batch = min(max_batch_size, shots - start)
+            sim = stim.FlipSimulator(
+                batch_size=batch,
+                num_qubits=prefix.num_qubits,
+                seed=int(rng.integers(1 << 62)),
+            )
+            sim.do(prefix)
+            xs, zs, ms, ds, os_ = sim.to_numpy(
+                transpose=True,
+                output_xs=True,
+                output_zs=True,
+                output_measure_flips=True,
+                output_detector_flips=True,
+                output_observable_flips=True,
+            )
+            kept = np.flatnonzero(~np.any(ds[:, ps], axis=1))
+            parts['shot_index'].append(kept + start)
+            parts['xs'].append(np.packbits(xs[kept][:, qubits], axis=1, bitorder='little'))
+            parts['zs'].append(np.packbits(zs[kept][:, qubits], axis=1, bitorder='little'))
+            parts['measurements'].append(np.packbits(ms[kept], axis=1, bitorder='little'))
+            parts['detectors'].append(np.packbits(ds[kept], axis=1, bitorder='little'))
+            parts['observables'].append(np.packbits(os_[kept], axis=1, bitorder='little'))
+
+        return FrameStore(
+            prefix_hash=prefix_hash,
+            num_instructions=num_instructions,
+            num_qubits=len(qubits),
+            num_measurements=prefix.num_measurements,
+            num_detectors=prefix.num_detectors,
+            num_observables=prefix.num_observables,
+            shots=shots,
+            **{k: np.concatenate(v) if v else np.zeros((0, 0), dtype=np.uint8)
+               for k, v in parts.items()},
+        )
+
+    def save(self, directory: str | pathlib.Path) -> pathlib.Path:
+        "Writes the store to <directory>/<prefix_hash>.npz and returns the path"
+        directory = pathlib.Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f'{self.prefix_hash}.npz'
+        tmp = directory / f'.{self.prefix_hash}.{os.getpid()}.npz'
+        np.savez_compressed(
+            tmp,
+            format_version=FORMAT_VERSION,
+            prefix_hash=self.prefix_hash,
+            num_instructions=self.num_instructions,
+            num_qubits=self.num_qubits,
+            num_measurements=self.num_measurements,
+            num_detectors=self.num_detectors,
+            num_observables=self.num_observables,
+            shots=self.shots,
+            shot_index=self.shot_index,
+            xs=self.xs,
+            zs=self.zs,
+            measurements=self.measurements,
+            detectors=self.detectors,
+            observables=self.observables,
+        )
+        os.replace(tmp, path)
+        return path
+
+    @staticmethod
+    def load(path: str | pathlib.Path) -> 'FrameStore':
+        with np.load(path) as data:
+            if int(data['format_version']) != FORMAT_VERSION:
+                raise ValueError(f"{path} has format {int(data['format_version'])}, expected {FORMAT_VERSION}")
+            return FrameStore(
+                prefix_hash=str(data['prefix_hash']),
+                **{k: int(data[k]) for k in ['num_instructions', 'num_qubits', 'num_measurements',
+                                             'num_detectors', 'num_observables', 'shots']},
+                **{k: data[k] for k in ['shot_index', 'xs', 'zs', 'measurements',
+                                        'detectors', 'observables']},
+            )
+
+    @staticmethod
+    def find(directory: str | pathlib.Path,
+             circuit: stim.Circuit,
+             postselected: np.ndarray) -> 'FrameStore | None':
+        "Returns a store in directory whose prefix matches the start of circuit, if any"
+        for path in sorted(pathlib.Path(directory).glob('*.npz')):
+            if path.name.startswith('.'):
+                continue
+            with np.load(path) as data:
+                num_instructions = int(data['num_instructions'])
+                prefix_hash = str(data['prefix_hash'])
+            try:
+                _, _, h = canonical_prefix(circuit, num_instructions, postselected)
+            except ValueError:
+                continue
+            if h == prefix_hash:
+                return FrameStore.load(path)
+        return None
+
+
+class StoredFrameDetectorSampler:
+    """Samples detection events of a circuit by continuing stored prefix frames.
+
+    Only the part of the circuit after the store's prefix is simulated. Each
+    stored shot is handed out at most once per circuit: the range of sampled
+    shots already used is tracked in a claims file next to the store, under a
+    file lock. So several sinter workers, or a resumed collection, never reuse
+    a stored shot for the same circuit. Different circuits sharing the prefix
+    each get every stored shot.
+    """
+
+    def __init__(self,
+                 circuit: stim.Circuit,
+                 store: FrameStore,
+                 postselected: np.ndarray,
+                 *,
+                 claims_path: str | pathlib.Path | None = None):
+        """
+        Args:
+            circuit: The full circuit. Its prefix must match the store.
+            store: The stored prefix frames.
+            postselected: A boolean array over the circuit's detectors.
+            claims_path: Where to record used shots. Without it, shots are
+                only tracked within this object.
+        """
+        prefix, qubits, prefix_hash = canonical_prefix(circuit, store.num_instructions, postselected)
+        if prefix_hash != store.prefix_hash:
+            raise ValueError("The circuit does not start with the store's prefix.")
+        self.store = store
+        self.qubits = qubits
+        self.num_qubits = circuit.num_qubits
+        self.num_detectors = circuit.num_detectors
+        self.num_observables = circuit.num_observables
+        self.claims_path = None if claims_path is None else pathlib.Path(claims_path)
+        self._claimed = 0
+        self._rng = np.random.default_rng()
+
+        suffix = _without_qubit_coords(circuit)[store.num_instructions:]
+        self.lookback = _measurement_lookback(suffix)
+        if self.lookback > store.num_measurements:
+            raise ValueError("The circuit refers to measurements before its first measurement.")
+        self.scratch_qubits = self.num_qubits + np.arange(self.lookback)
+        self.suffix = stim.Circuit()
+        if self.lookback:
+            self.suffix.append('M', self.scratch_qubits)
+        self.suffix += suffix
+
+    @property
+    def remaining_shots(self) -> int:
+        return self.store.shots - self._read_claimed()
+
+    def _read_claimed(self) -> int:
+        if self.claims_path is None or not self.claims_path.exists():
+            return self._claimed
+        return int(self.claims_path.read_text() or 0)
+
+    def _claim(self, shots: int) -> tuple[int, int]:
+        "Reserves up to shots stored sampled shots and returns their [start, stop)"
+        if self.claims_path is None:
+            start = self._claimed
+            self._claimed = min(self.store.shots, start + shots)
+            return start, self._claimed
+        with open(self.claims_path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            start = int(f.read() or 0)
+            stop = min(self.store.shots, start + shots)
+            f.seek(0)
+            f.truncate()
+            f.write(str(stop))
+        return start, stop
+
+    def sample_survivors(self, shots: int, *, row_bytes: int | None = None) -> tuple[int, np.ndarray, np.ndarray, np.ndarray]:
+        """Continues up to shots stored shots through the rest of the circuit.
+
+        Returns:
+            A (shots, kept, dets, obs) tuple. shots is how many sampled shots
+            were used, which is less than requested once the store runs out.
+            kept holds the indices (among those) of the shots that survived
+            the prefix, and dets and obs are their bit packed detection events
+            and observable flips.
+        """
+        if row_bytes is None:
+            row_bytes = (self.num_detectors + 7) // 8
+        start, stop = self._claim(shots)
+        lo, hi = np.searchsorted(self.store.shot_index, [start, stop])
+        kept = self.store.shot_index[lo:hi] - start
+        n = hi - lo
+        store = self.store
+
+        def unpack(packed: np.ndarray, count: int) -> np.ndarray:
+            return np.unpackbits(packed[lo:hi], axis=1, bitorder='little', count=count).T.view(np.bool_)
+
+        if not n:
+            return (stop - start,
+                    kept,
+                    np.zeros((0, row_bytes), dtype=np.uint8),
+                    np.zeros((0, (self.num_observables + 7) // 8), dtype=np.uint8))
+
+        # The stored frames already hold the prefix's gauge, so the simulator
+        # must not randomize them a second time.
+        sim = stim.FlipSimulator(
+            batch_size=n,
+            num_qubits=self.num_qubits + self.lookback,
+            disable_stabilizer_randomization=True,
+            seed=int(self._rng.integers(1 << 62)),
+        )
+        x_mask = np.zeros(shape=(self.num_qubits + self.lookback, n), dtype=np.bool_)
+        z_mask = np.zeros_like(x_mask)
+        x_mask[self.qubits] = unpack(store.xs, store.num_qubits)
+        z_mask[self.qubits] = unpack(store.zs, store.num_qubits)
+        if self.lookback:
+            x_mask[self.scratch_qubits] = unpack(store.measurements, store.num_measurements)[-self.lookback:]
+        sim.broadcast_pauli_errors(pauli='X', mask=x_mask)
+        sim.broadcast_pauli_errors(pauli='Z', mask=z_mask)
+        sim.do(self.suffix)
+        _, _, _, ds, os_ = sim.to_numpy(
+            transpose=True,
+            output_detector_flips=True,
+            output_observable_flips=True,
+        )
+
+        dets = np.zeros(shape=(n, row_bytes * 8), dtype=np.bool_)
+        dets[:, :store.num_detectors] = unpack(store.detectors, store.num_detectors).T
+        dets[:, store.num_detectors:self.num_detectors] = ds
+        obs = np.zeros(shape=(n, self.num_observables), dtype=np.bool_)
+        obs[:, :store.num_observables] ^= unpack(store.observables, store.num_observables).T
+        obs[:, :os_.shape[1]] ^= os_
+        return (
+            stop - start,
+            kept,
+            np.packbits(dets, axis=1, bitorder='little'),
+            np.packbits(obs, axis=1, bitorder='little'),
+        )
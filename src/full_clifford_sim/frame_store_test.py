@@ -0,0 +1,66 @@
+import numpy as np
+
+from full_clifford_sim.frame_store import FrameStore, StoredFrameDetectorSampler
+from full_clifford_sim.gap_sampler import postselected_detectors
+from full_clifford_sim.main_complied_fxns import full_circuit, sample_cultivation_frames
+from full_clifford_sim.two_stage_sampler_test import assert_same_rate, plain_survivors, unpacked
+
+
+def test_find_matches_prefix_across_dfinal(tmp_path):
+    sample_cultivation_frames(0.001, 'hookinj', 1_000, tmp_path, seed=1)
+    for dfinal in [5, 9]:
+        circuit = full_circuit(0.001, dfinal, 'hookinj', verify=False)
+        assert FrameStore.find(tmp_path, circuit, postselected_detectors(circuit)) is not None
+    for circuit in [full_circuit(0.002, 5, 'hookinj', verify=False),
+                    full_circuit(0.001, 5, 'unitstab', verify=False)]:
+        assert FrameStore.find(tmp_path, circuit, postselected_detectors(circuit)) is None
+
+
+def test_save_load_round_trip(tmp_path):
+    path = sample_cultivation_frames(0.001, 'hookinj', 1_000, tmp_path, seed=2)
+    store = FrameStore.load(path)
+    again = FrameStore.load(store.save(tmp_path / 'copy'))
+    assert again.prefix_hash == store.prefix_hash == path.stem
+    assert again.shots == 1_000
+    for k in ['shot_index', 'xs', 'zs', 'measurements', 'detectors', 'observables']:
+        np.testing.assert_array_equal(getattr(again, k), getattr(store, k))
+
+
+def test_matches_plain_sampling(tmp_path):
+    shots = 40_000
+    path = sample_cultivation_frames(0.002, 'hookinj', shots, tmp_path, seed=3)
+    circuit = full_circuit(0.002, 5, 'hookinj', verify=False)
+    postselected = postselected_detectors(circuit)
+    sampler = StoredFrameDetectorSampler(circuit, FrameStore.load(path), postselected)
+    used, kept, dets, obs = sampler.sample_survivors(shots)
+    assert used == shots
+    assert sampler.remaining_shots == 0
+    dets = unpacked(dets, circuit.num_detectors)
+    obs = unpacked(obs, circuit.num_observables)
+
+    # Postselected detectors after the stored prefix still apply.
+    survived = ~np.any(dets[:, postselected], axis=1)
+    keep = np.zeros(shots, dtype=np.bool_)
+    keep[kept[survived]] = True
+    dets, obs = dets[survived], obs[survived]
+    plain_keep, plain_dets, plain_obs = plain_survivors(circuit, postselected, shots)
+    assert_same_rate(keep, plain_keep)
+    for d in np.flatnonzero(~postselected)[-20:]:
+        assert_same_rate(dets[:, d], plain_dets[:, d])
+    assert_same_rate(obs[:, 0], plain_obs[:, 0])
+
+
+def test_claims_hand_out_each_shot_once(tmp_path):
+    path = sample_cultivation_frames(0.001, 'hookinj', 1_000, tmp_path, seed=4)
+    store = FrameStore.load(path)
+    circuit = full_circuit(0.001, 5, 'hookinj', verify=False)
+    postselected = postselected_detectors(circuit)
+    claims = tmp_path / 'circuit.claims'
+    first = StoredFrameDetectorSampler(circuit, store, postselected, claims_path=claims)
+    second = StoredFrameDetectorSampler(circuit, store, postselected, claims_path=claims)
+
+    used_first, kept_first, _, _ = first.sample_survivors(600)
+    used_second, kept_second, _, _ = second.sample_survivors(600)
+    assert (used_first, used_second) == (600, 400)
+    assert first.remaining_shots == second.remaining_shots == 0
+    assert len(kept_first) + len(kept_second) == store.kept_shots
@@ -1,5 +1,7 @@
 from dataclasses import dataclass
 import stim
+import numpy as np
+from full_clifford_sim.circuit_text import CircuitText
 from full_clifford_sim.coords import *
 from full_clifford_sim.ghz_fxns import *
 from full_clifford_sim.s3_fxns import *
@@ -15,12 +17,19 @@ class FullCircuit:
     def sc_stab_round(self, d_rest: int = None) -> stim.Circuit:
         "Returns gates and ancilla msmts for any stab rd"
 
+        if d_rest not in self._stab_round_text:
+            self._stab_round_text[d_rest] = self._sc_stab_round_text(d_rest).to_text()
+        return stim.Circuit(self._stab_round_text[d_rest])
+
+
+    def _sc_stab_round_text(self, d_rest: int = None) -> CircuitText:
+
         if d_rest is None:
             stepGates = self.cbase.stepGates
         else:
             stepGates = self.cbase.filter_step_gates(d_rest)
 
-        fround = stim.Circuit()
+        fround = CircuitText()
         fround.append("R", self.cbase.ancillaQubits)
         fround.append("TICK")
 
@@ -41,7 +50,6 @@ class FullCircuit:
         return fround
     
 
-    
     def sc_detectors(self, 
                      d_rest: int = None,
                      curr_only: bool = False,
@@ -49,46 +57,47 @@ class FullCircuit:
                      ps_round: bool = False) -> stim.Circuit:
         "Defines a regular detector set for the input SC"
 
-        detCircuit = stim.Circuit()
         if d_rest is None: d_rest = self.dx
 
+        key = (d_rest, curr_only, first_round, ps_round)
+        if key not in self._detector_text:
+            self._detector_text[key] = self._sc_detector_text(*key)
+        return stim.Circuit(self._detector_text[key])
+
+
+    def _sc_detector_text(self, 
+                          d_rest: int,
+                          curr_only: bool,
+                          first_round: bool,
+                          ps_round: bool) -> str:
+        "The text of sc_detectors, with every ancilla's detector worked out at once"
+
         no1scA = self.no1SCAnc
+        k = np.arange(no1scA)
+        aq = self.cbase.ancillaQubits[:no1scA]
+        qc_x = (aq //2) % (self.dx+1) - 0.5
+        qc_y = (aq //2) // (self.dx+1) - 0.5
+        valid = self.cbase.valid_ancilla_mask(aq, d_rest=d_rest)
+
+        if first_round and curr_only: #custom detectors for transition round
+            isX = self.cbase.Xstab_mask(aq)
+            emit = (((qc_y > d_rest) & (qc_y > qc_x) & isX)
+                    | ((qc_x > d_rest) & (qc_x > qc_y) & ~isX)
+                    | valid)
+        elif not first_round:
+            emit = valid
+        else:
+            emit = np.zeros(no1scA, dtype=np.bool_)
 
-        for k in range(no1scA):
-            aq = self.cbase.ancillaQubits[k]
-            det_loc_arg =  (*self.cbase.ancilla_coords(aq), ps_round)
-            if not first_round and self.cbase.is_valid_ancilla(aq, d_rest=d_rest):
-                if not curr_only:
-                    detCircuit.append("DETECTOR", 
-                                  [stim.target_rec(-no1scA+k),
-                                   stim.target_rec(-len(self.cbase.ancillaQubits)-(no1scA)+k)],
-                                   arg = det_loc_arg) 
-                else: #current only
-                    if not first_round:
-                        detCircuit.append("DETECTOR", 
-                                    [stim.target_rec(-no1scA+k)],
-                                    arg = det_loc_arg) 
-                        
-            if first_round and curr_only: #custom detectors for transition round
-                qc = aq //2
-                qc_x = qc % (self.dx+1) - 0.5
-                qc_y = qc // (self.dx+1) - 0.5
-                if (qc_y > d_rest and qc_y > qc_x and self.cbase.is_Xstab(aq)):
-                        detCircuit.append("DETECTOR", 
-                            [stim.target_rec(-no1scA+k)],
-                            arg = det_loc_arg) 
-                elif (qc_x > d_rest and qc_x > qc_y  and not self.cbase.is_Xstab(aq)):
-                        detCircuit.append("DETECTOR", 
-                            [stim.target_rec(-no1scA+k)],
-                            arg = det_loc_arg) 
-                elif self.cbase.is_valid_ancilla(aq, d_rest=d_rest):
-                    detCircuit.append("DETECTOR", 
-                            [stim.target_rec(-no1scA+k)],
-                            arg = det_loc_arg) 
-
-        detCircuit.append("SHIFT_COORDS", arg=(0,0,1))
-
-        return detCircuit
+        recs = [-no1scA + k]
+        if not first_round and not curr_only: #compare with previous round
+            recs.append(-len(self.cbase.ancillaQubits) - no1scA + k)
+
+        text = CircuitText()
+        for x, y, *ks in zip(qc_x[emit].tolist(), qc_y[emit].tolist(), *(r[emit].tolist() for r in recs)):
+            text.append('DETECTOR', [f'rec[{r}]' for r in ks], (x, y, 0, int(ps_round)))
+        text.append('SHIFT_COORDS', args=(0, 0, 1))
+        return text.to_text()
 
     
 
@@ -102,29 +111,23 @@ class FullCircuit:
         _________
         
         """
-        yli_circ = stim.Circuit()
+        yli_circ = CircuitText()
 
-        outside_qubs = []
-        plus_qubs = []
+        q = self.cbase.dataQubits
+        qc_x = (q//2) % self.dx 
+        qc_y = (q//2) //self.dx 
 
         #first reset all data qubits outside OG surface code
-        for q in self.cbase.dataQubits:
-            qc = q/2
-            qc_x = qc % self.dx 
-            qc_y = qc //self.dx 
-
-            if (qc_x >= d_rest or qc_y >= d_rest):
-                outside_qubs.append(q)
-                #now put lower qubits in |+> state
-                if (qc_y >= d_rest and qc_y > qc_x):
-                    plus_qubs.append(q)
-
-        yli_circ.append("R", outside_qubs)
+        outside = (qc_x >= d_rest) | (qc_y >= d_rest)
+        #now put lower qubits in |+> state
+        plus = outside & (qc_y >= d_rest) & (qc_y > qc_x)
+
+        yli_circ.append("R", q[outside])
         yli_circ.append("TICK")
-        yli_circ.append("H", plus_qubs)
+        yli_circ.append("H", q[plus])
         yli_circ.append("TICK")
 
-        return yli_circ
+        return yli_circ.to_circuit()
 
     
     def logYMeas(self) -> stim.Circuit:
@@ -140,10 +143,9 @@ class FullCircuit:
 
         measlen = self.dx + self.dy - 1
 
-        yMeas = [ stim.target_rec(-measlen + k)
-                 for k in range(measlen)] 
+        yMeas = ' '.join(f'rec[{r}]' for r in range(-measlen, 0))
 
-        measCircuit.append("OBSERVABLE_INCLUDE", yMeas, 0) 
+        measCircuit += stim.Circuit(f'OBSERVABLE_INCLUDE(0) {yMeas}')
         return measCircuit
     
     
@@ -192,6 +194,8 @@ class FullCircuit:
     def __post_init__(self):
 
         self.no1SCAnc = self.dx * self.dy - 1
+        self._stab_round_text = {}
+        self._detector_text = {}
 
         self.cbase = RotSurfCodeCoords(self.dx,self.dy)
         self.qcircuit = self.cbase.layout_coords()
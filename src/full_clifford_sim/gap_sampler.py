@@ -1,17 +1,77 @@
 import collections
+import contextlib
+import functools
+import hashlib
 import math
+import pathlib
+import sys
 import time
 
 import numpy as np
 import pymatching
+import scipy.sparse
+import scipy.sparse.csgraph
 import sinter
 import stim
 
 #### THIS FILE IS LIFTED FROM ZENODO CODE OF MSC PAPER ###
 ### minor edts have been made to is_postselected and sinter_samplers for compatability ###
 
+from full_clifford_sim.artifact_cache import ArtifactCache
 from full_clifford_sim.dem_utils import dem_with_compressed_detectors, \
-    dem_with_replaced_targets
+    dem_text_with_replaced_targets
+from full_clifford_sim.frame_store import FrameStore, StoredFrameDetectorSampler
+from full_clifford_sim.two_stage_sampler import TwoStageDetectorSampler
+
+# Default settings of dem_with_compressed_detectors. They are part of the artifact cache key.
+_COMPRESSION_PARAMS = dict(
+    max_compressed_errors=2,
+    error_size_cutoff=3,
+    detection_event_cutoff=4,
+    epsilon=0.0,
+)
+_ARTIFACT_FORMAT_VERSION = 3
+
+# Converts pymatching weights, ln((1-p)/p), into decibels of evidence,
+# -10 log10(p/(1-p)). The ratio is the same for every p.
+_DB_PER_WEIGHT = 10 / math.log(10)
+
+
+def is_postselected(coords: list[float]) -> bool:
+    if len(coords) == 0:
+        return True
+    elif len(coords) == 3: #did not specify postselection mask
+        return False
+    elif coords[-1] > 0.0:
+        return True
+    return False
+
+
+def postselected_detectors(circuit: stim.Circuit,
+                           d2c: dict[int, list[float]] | None = None) -> np.ndarray:
+    """A boolean array marking the circuit's detectors that discard a shot when they fire.
+
+    Vectorized equivalent of is_postselected over every detector's coordinates.
+    """
+    if d2c is None:
+        d2c = circuit.get_detector_coordinates()
+    n = len(d2c)
+    dets = np.fromiter(d2c.keys(), dtype=np.int64, count=n)
+    lengths = np.fromiter(map(len, d2c.values()), dtype=np.int64, count=n)
+    last = np.fromiter((c[-1] if c else 0.0 for c in d2c.values()), dtype=np.float64, count=n)
+    mask = np.zeros(circuit.num_detectors, dtype=np.bool_)
+    mask[dets] = (lengths == 0) | ((lengths != 3) & (last > 0.0))
+    return mask
+
+
+@contextlib.contextmanager
+def _timed(seconds: dict[str, float], stage: str):
+    t0 = time.monotonic()
+    try:
+        yield
+    finally:
+        seconds[stage] = seconds.get(stage, 0.0) + time.monotonic() - t0
+
 
 def sinter_samplers() -> dict[str, sinter.Sampler]:
     return {
@@ -25,11 +85,44 @@ class PymatchingGapSampler(sinter.Sampler):
 
     Requires the observable to exist purely on boundary edges.
     """
-    def __init__(self, decoder: sinter.Decoder | None = None):
+    def __init__(self,
+                 decoder: sinter.Decoder | None = None,
+                 *,
+                 cache_bytes: int = 0,
+                 db_bin_width: int = 1,
+                 max_db: int | None = None,
+                 kept_shots_per_batch: int | None = None,
+                 two_stage: bool = False,
+                 frame_store_dir: str | None = None,
+                 artifact_cache_dir: str | None = None,
+                 compression: dict | None = None,
+                 report_decode_counts: bool = False):
         self.decoder = decoder
+        self.cache_bytes = cache_bytes
+        self.db_bin_width = db_bin_width
+        self.max_db = max_db
+        self.kept_shots_per_batch = kept_shots_per_batch
+        self.two_stage = two_stage
+        self.frame_store_dir = frame_store_dir
+        self.artifact_cache_dir = artifact_cache_dir
+        self.compression = compression
+        self.report_decode_counts = report_decode_counts
 
     def compiled_sampler_for_task(self, task: sinter.Task) -> sinter.CompiledSampler:
-        return CompiledPymatchingGapSampler(task, self.decoder, False)
+        return CompiledPymatchingGapSampler(
+            task,
+            self.decoder,
+            False,
+            cache_bytes=self.cache_bytes,
+            db_bin_width=self.db_bin_width,
+            max_db=self.max_db,
+            kept_shots_per_batch=self.kept_shots_per_batch,
+            two_stage=self.two_stage,
+            frame_store_dir=self.frame_store_dir,
+            artifact_cache_dir=self.artifact_cache_dir,
+            compression=self.compression,
+            report_decode_counts=self.report_decode_counts,
+        )
     
 
 class PymatchingPredSampler(sinter.Sampler):
@@ -37,24 +130,65 @@ class PymatchingPredSampler(sinter.Sampler):
 
     Requires the observable to exist purely on boundary edges.
     """
-    def __init__(self, decoder: sinter.Decoder | None = None):
+    def __init__(self,
+                 decoder: sinter.Decoder | None = None,
+                 *,
+                 cache_bytes: int = 0,
+                 db_bin_width: int = 1,
+                 max_db: int | None = None,
+                 kept_shots_per_batch: int | None = None,
+                 two_stage: bool = False,
+                 frame_store_dir: str | None = None,
+                 artifact_cache_dir: str | None = None,
+                 compression: dict | None = None,
+                 report_decode_counts: bool = False):
         self.decoder = decoder
+        self.cache_bytes = cache_bytes
+        self.db_bin_width = db_bin_width
+        self.max_db = max_db
+        self.kept_shots_per_batch = kept_shots_per_batch
+        self.two_stage = two_stage
+        self.frame_store_dir = frame_store_dir
+        self.artifact_cache_dir = artifact_cache_dir
+        self.compression = compression
+        self.report_decode_counts = report_decode_counts
 
     def compiled_sampler_for_task(self, task: sinter.Task) -> sinter.CompiledSampler:
-        return CompiledPymatchingGapSampler(task, self.decoder, True)
+        return CompiledPymatchingGapSampler(
+            task,
+            self.decoder,
+            True,
+            cache_bytes=self.cache_bytes,
+            db_bin_width=self.db_bin_width,
+            max_db=self.max_db,
+            kept_shots_per_batch=self.kept_shots_per_batch,
+            two_stage=self.two_stage,
+            frame_store_dir=self.frame_store_dir,
+            artifact_cache_dir=self.artifact_cache_dir,
+            compression=self.compression,
+            report_decode_counts=self.report_decode_counts,
+        )
 
 
 class CompiledPymatchingGapSampler(sinter.CompiledSampler):
-    def __init__(self, task: sinter.Task, decoder: sinter.Decoder | None, pred_only: bool = False):
+    def __init__(self,
+                 task: sinter.Task,
+                 decoder: sinter.Decoder | None,
+                 pred_only: bool = False,
+                 *,
+                 low_event_tiers: bool = True,
+                 cache_bytes: int = 0,
+                 db_bin_width: int = 1,
+                 max_db: int | None = None,
+                 kept_shots_per_batch: int | None = None,
+                 stream_chunk_shots: int = 1 << 14,
+                 two_stage: bool = False,
+                 frame_store_dir: str | None = None,
+                 artifact_cache_dir: str | None = None,
+                 artifact_cache_bytes: int = 1 << 30,
+                 compression: dict | None = None,
+                 report_decode_counts: bool = False):
         circuit = task.circuit
-        def is_postselected(coords: list[float]) -> bool:
-            if len(coords) == 0:
-                return True
-            elif len(coords) == 3: #did not specify postselection mask
-                return False
-            elif coords[-1] > 0.0:
-                return True
-            return False
 
         self.num_obs = circuit.num_observables
         self.pred_only = pred_only
@@ -62,66 +196,188 @@ class CompiledPymatchingGapSampler(sinter.CompiledSampler):
         if self.num_obs > 8:
             raise NotImplementedError(f"{self.num_obs} > 8")
 
-        dem = task.detector_error_model #changed
-        dem = dem_with_compressed_detectors(
-            dem=dem,
-            compressed_detector_predicate=is_postselected,
-            max_compressed_errors=2,
-            error_size_cutoff=3,
-            detection_event_cutoff=4,
-        )
+        # Seconds spent per construction stage. 'artifacts' covers the DEM stages
+        # (or the cache lookup), and lazily built parts are added on first use.
+        self.circuit = circuit
+        self.construction_seconds = {}
+        timed = functools.partial(_timed, self.construction_seconds)
 
-        # Byte-align the additional detectors, for convenience.
-        aligned_circuit = circuit.copy()
+        # Byte-align the additional detectors, for convenience. The aligned
+        # circuit itself is only built if the stim sampler is needed.
         while num_dets & 7:
             num_dets += 1
-            aligned_circuit.append("DETECTOR")
-        for k in range(self.num_obs):
-            aligned_circuit.append("DETECTOR")
+        self.num_aligned_dets = num_dets + self.num_obs
 
-        dem_obs2det = dem_with_replaced_targets(dem, {
-            stim.target_logical_observable_id(k): stim.target_relative_detector_id(num_dets + k)
-            for k in range(self.num_obs)
-        })
-        dem.append('detector', (), [stim.target_relative_detector_id(aligned_circuit.num_detectors - 1)])
-
-        self.postselection_mask = np.zeros(shape=num_dets // 8 + 1, dtype=np.uint8)
-        vv1 = []
-        vv2 = []
-        self.d2c = circuit.get_detector_coordinates()
-        for det, coords in self.d2c.items():
-            if is_postselected(coords):
-                vv1.append(det)
-                vv2.append(coords)
-                self.postselection_mask[det >> 3] |= 1 << (det & 7)
+        with timed('detector_coords'):
+            self.d2c = circuit.get_detector_coordinates()
+            postselected = postselected_detectors(circuit, self.d2c)
+
+        # compression overrides entries of _COMPRESSION_PARAMS, e.g. to fold
+        # more errors into the postselected detectors with some pruning, or to
+        # spread the folding over num_workers processes.
+        compression = {**_COMPRESSION_PARAMS, **(compression or {})}
+
+        built = {}
+        def build_artifacts() -> dict:
+            with timed('compress_dem'):
+                report = {}
+                dem = task.detector_error_model #changed
+                dem = dem_with_compressed_detectors(
+                    dem=dem,
+                    compressed_detector_predicate=is_postselected,
+                    report=report,
+                    **compression,
+                )
+
+            with timed('replace_targets'):
+                obs2det_text = dem_text_with_replaced_targets(dem, {
+                    stim.target_logical_observable_id(k): stim.target_relative_detector_id(num_dets + k)
+                    for k in range(self.num_obs)
+                })
+                dem_obs2det = stim.DetectorErrorModel(obs2det_text)
+                dem.append('detector', (), [stim.target_relative_detector_id(self.num_aligned_dets - 1)])
+
+            postselection_mask = np.zeros(shape=num_dets // 8 + 1, dtype=np.uint8)
+            packed = np.packbits(postselected, bitorder='little')
+            postselection_mask[:len(packed)] = packed
+
+            built['dem'] = dem
+            with timed('gap_matcher'):
+                built['gap_matcher'] = pymatching.Matching.from_detector_error_model(dem_obs2det)
+            return {
+                'dem': task.detector_error_model,
+                'compressed_dem': dem,
+                'obs2det_dem': obs2det_text,
+                'postselection_mask': postselection_mask,
+                'discarded_mass': report.get('discarded_mass', 0.0),
+            }
+
+        # The DEM derived artifacts are the slow part of construction, so they
+        # can be shared through an on-disk cache keyed by the circuit and DEM.
+        self.artifact_cache = None
+        with timed('artifacts'):
+            if artifact_cache_dir is None:
+                artifacts = build_artifacts()
+            else:
+                self.artifact_cache = ArtifactCache(artifact_cache_dir, max_bytes=artifact_cache_bytes)
+                key = ArtifactCache.key(
+                    format_version=_ARTIFACT_FORMAT_VERSION,
+                    circuit=str(circuit),
+                    detector_error_model=str(task.detector_error_model),
+                    # The worker count does not change the compressed DEM.
+                    **{k: v for k, v in compression.items() if k != 'num_workers'},
+                )
+                artifacts = self.artifact_cache.get_or_build(key, lambda: {
+                    k: str(v) if isinstance(v, stim.DetectorErrorModel) else v
+                    for k, v in build_artifacts().items()
+                })
+        self._decoder_dem = built.get('dem')
+        if self._decoder_dem is None:
+            self._decoder_dem = stim.DetectorErrorModel(str(artifacts['compressed_dem']))
+        self.postselection_mask = artifacts['postselection_mask']
+        # Probability mass of the partial error combinations pruned by compression.
+        self.compression_discarded_mass = float(artifacts['discarded_mass'])
 
         self.controlled_det_byte = num_dets >> 3
-        if decoder is not None:
-            self.compiled_decoder = decoder.compile_decoder_for_dem(dem=dem)
-        else:
-            self.compiled_decoder = None
-        self.gap_matcher = pymatching.Matching.from_detector_error_model(dem_obs2det)
-        self.stim_sampler = aligned_circuit.compile_detector_sampler()
+        self.decoder = decoder
+        self.gap_matcher = built.get('gap_matcher')
+        if self.gap_matcher is None:
+            with timed('gap_matcher'):
+                self.gap_matcher = pymatching.Matching.from_detector_error_model(
+                    stim.DetectorErrorModel(str(artifacts['obs2det_dem'])))
+
+        # In two stage mode the part of the circuit after the last postselected
+        # detector is only simulated for shots that survive postselection.
+        self.two_stage_sampler = None
+        if two_stage:
+            with timed('two_stage'):
+                self.two_stage_sampler = TwoStageDetectorSampler(circuit, postselected)
 
-        edge = next(iter(self.gap_matcher.to_networkx().edges.values()))
-        edge_w = edge['weight']
-        edge_p = edge['error_probability']
-        self.decibels_per_w = -math.log10(edge_p / (1 - edge_p)) * 10 / edge_w
+        # Shots are first drawn from a stored cultivation prefix, when
+        # frame_store_dir holds one matching the start of the circuit.
+        self.frame_store_sampler = None
+        if frame_store_dir is not None:
+            with timed('frame_store'):
+                store = FrameStore.find(frame_store_dir, circuit, postselected)
+                if store is not None:
+                    circuit_hash = hashlib.sha256(str(circuit).encode()).hexdigest()[:16]
+                    self.frame_store_sampler = StoredFrameDetectorSampler(
+                        circuit,
+                        store,
+                        postselected,
+                        claims_path=pathlib.Path(frame_store_dir) / f'{store.prefix_hash}.{circuit_hash}.claims',
+                    )
 
+        # Shots with at most two detection events are resolved from a table of
+        # shortest path lengths instead of going through the gap matcher.
+        self.low_event_table = None
+        if low_event_tiers:
+            with timed('low_event_table'):
+                self.low_event_table = _LowEventCosetTable.from_matcher(
+                    self.gap_matcher,
+                    num_dets=num_dets,
+                    num_obs=self.num_obs,
+                )
+        self.tier_counts = collections.Counter()
+
+        # Gap histogram settings, and the running total over all sample calls.
+        self.db_bin_width = db_bin_width
+        self.max_db = max_db
+        self.gap_histogram = GapHistogram(db_bin_width=db_bin_width, max_db=max_db)
+
+        # With kept_shots_per_batch set, sample() streams chunks of
+        # stream_chunk_shots until that many shots survive postselection.
+        self.kept_shots_per_batch = kept_shots_per_batch
+        self.stream_chunk_shots = stream_chunk_shots
+        self._kept_dets = None
+        self._kept_obs = None
+
+        # Syndromes that need the matcher are memoized when cache_bytes > 0.
+        self.coset_cache = _CosetWeightCache(cache_bytes) if cache_bytes > 0 else None
+
+        # Optionally add tier_* and coset_cache_* keys to each sample's
+        # custom_counts, which are otherwise only the gap histogram.
+        self.report_decode_counts = report_decode_counts
+
+    @functools.cached_property
+    def compiled_decoder(self) -> sinter.CompiledDecoder | None:
+        "The optional decoder, compiled on first use"
+        if self.decoder is None:
+            return None
+        with _timed(self.construction_seconds, 'compiled_decoder'):
+            return self.decoder.compile_decoder_for_dem(dem=self._decoder_dem)
+
+    @functools.cached_property
+    def stim_sampler(self) -> stim.CompiledDetectorSampler:
+        "Samples the byte aligned circuit, compiled on first use"
+        with _timed(self.construction_seconds, 'stim_sampler'):
+            padding = stim.Circuit()
+            for _ in range(self.num_aligned_dets - self.circuit.num_detectors):
+                padding.append("DETECTOR")
+            return (self.circuit + padding).compile_detector_sampler()
 
     def sample(self, max_shots: int) -> sinter.AnonTaskStats:
         t0 = time.monotonic()
-        dets, actual_obs = self.stim_sampler.sample(
-            shots=max_shots,
-            bit_packed=True,
-            separate_observables=True,
-        )
-        
-        num_shots = dets.shape[0]
-        discard_mask = np.any(dets & self.postselection_mask, axis=1)
-        num_discards = np.count_nonzero(discard_mask)
-        dets = dets[~discard_mask]
-        actual_obs = actual_obs[~discard_mask]
+        if self.kept_shots_per_batch is None and (self.two_stage_sampler is not None
+                                                  or self.frame_store_sampler is not None):
+            _, dets, actual_obs = self._sample_survivors(max_shots)
+            num_shots = max_shots
+            num_discards = num_shots - dets.shape[0]
+        elif self.kept_shots_per_batch is None:
+            dets, actual_obs = self.stim_sampler.sample(
+                shots=max_shots,
+                bit_packed=True,
+                separate_observables=True,
+            )
+
+            num_shots = dets.shape[0]
+            discard_mask = np.any(dets & self.postselection_mask, axis=1)
+            num_discards = np.count_nonzero(discard_mask)
+            dets = dets[~discard_mask]
+            actual_obs = actual_obs[~discard_mask]
+        else:
+            num_shots, dets, actual_obs = self._sample_kept_streaming(max_shots)
+            num_discards = num_shots - dets.shape[0]
         num_kept_shots = dets.shape[0]
 
         predictions: np.ndarray | None = None
@@ -130,16 +386,9 @@ class CompiledPymatchingGapSampler(sinter.CompiledSampler):
                 bit_packed_detection_event_data=dets
             )[:,0]
 
-        weights = np.zeros(shape=(num_kept_shots, 1 << self.num_obs), dtype=np.float64)
-        for mask in range(1 << self.num_obs):
-            dets[:, self.controlled_det_byte] = mask
-            weight = _decode_weight_with_pymatching_with_better_error_message(
-                self.gap_matcher,
-                dets,
-                self.d2c,
-            )
-            weights[:, mask] = weight
-        
+        tier_counts_before = self.tier_counts.copy()
+        cache_stats_before = self.cache_stats.copy()
+        weights = self._coset_weights(dets)
 
         if self.compiled_decoder is None:
             predictions = np.array(np.argmin(weights, axis=1), dtype=np.uint8)
@@ -153,14 +402,20 @@ class CompiledPymatchingGapSampler(sinter.CompiledSampler):
         num_errors = np.count_nonzero(errors)
 
         # Classify all shots by their error + gap.
-        custom_counts = collections.Counter()
-        gaps_db = np.round(gaps * self.decibels_per_w).astype(dtype=np.int64)
-        for k in range(num_kept_shots):
-            g = gaps_db[k]
-            #e = 'IXZY'[errors[k]] #rn if this line is chosen then all errors are reported as X
-            e = 'CE'[errors[k]]
-            key = f'{e}{g}'
-            custom_counts[key] += 1
+        gaps_db = np.round(gaps * _DB_PER_WEIGHT).astype(dtype=np.int64)
+        histogram = GapHistogram(db_bin_width=self.db_bin_width, max_db=self.max_db)
+        histogram.add(errors, gaps_db)
+        self.gap_histogram.merge(histogram)
+        custom_counts = histogram.to_custom_counts()
+        # Which tier resolved the kept shots, and how the coset cache did, so
+        # both show up in sinter's totals rather than only in this worker.
+        if self.report_decode_counts:
+            for tier, n in (self.tier_counts - tier_counts_before).items():
+                custom_counts[f'tier_{tier}'] = n
+            if self.coset_cache is not None:
+                cache_stats = self.cache_stats
+                for stat in ['hits', 'misses', 'evictions']:
+                    custom_counts[f'coset_cache_{stat}'] = cache_stats[stat] - cache_stats_before[stat]
         t1 = time.monotonic()
 
         return sinter.AnonTaskStats(
@@ -171,6 +426,537 @@ class CompiledPymatchingGapSampler(sinter.CompiledSampler):
             custom_counts=custom_counts,
         )
 
+    def _sample_kept_streaming(self, max_shots: int) -> tuple[int, np.ndarray, np.ndarray]:
+        """Draws shots in chunks until kept_shots_per_batch survive postselection.
+
+        Only the bytes holding postselected detectors are tested, and survivors
+        are compacted into buffers that are allocated once. Shots drawn after the
+        one that fills the buffer are not counted, so the discard rate stays
+        unbiased.
+
+        Returns:
+            A (num_shots, dets, obs) tuple, where num_shots counts every shot
+            used (kept or discarded) and dets/obs are views of the kept shots.
+        """
+        target = min(self.kept_shots_per_batch, max_shots)
+        if self._kept_dets is None or self._kept_dets.shape[0] < target:
+            self._kept_dets = np.empty(
+                shape=(target, len(self.postselection_mask)), dtype=np.uint8)
+            self._kept_obs = np.empty(
+                shape=(target, (self.num_obs + 7) // 8), dtype=np.uint8)
+
+        num_shots = 0
+        num_kept = 0
+        while num_kept < target and num_shots < max_shots:
+            chunk = min(self.stream_chunk_shots, max_shots - num_shots)
+            survivors, dets, obs = self._sample_survivors(chunk)
+            room = target - num_kept
+            if len(survivors) >= room:
+                chunk = int(survivors[room - 1]) + 1
+                dets = dets[:room]
+                obs = obs[:room]
+            self._kept_dets[num_kept:num_kept + len(dets)] = dets
+            self._kept_obs[num_kept:num_kept + len(obs)] = obs
+            num_kept += len(dets)
+            num_shots += chunk
+
+        return num_shots, self._kept_dets[:num_kept], self._kept_obs[:num_kept]
+
+    def _sample_survivors(self, shots: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Samples shots and returns (survivor indices, dets, obs) of the kept ones.
+
+        Postselection only tests the bytes that hold postselected detectors.
+        """
+        ps_bytes = np.flatnonzero(self.postselection_mask)
+        if self.frame_store_sampler is not None and self.frame_store_sampler.remaining_shots:
+            used, survivors, dets, obs = self.frame_store_sampler.sample_survivors(
+                shots, row_bytes=len(self.postselection_mask))
+            # Postselected detectors after the stored prefix still apply.
+            keep = ~np.any(dets[:, ps_bytes] & self.postselection_mask[ps_bytes], axis=1)
+            survivors, dets, obs = survivors[keep], dets[keep], obs[keep]
+            if used < shots:
+                rest_survivors, rest_dets, rest_obs = self._sample_survivors(shots - used)
+                survivors = np.concatenate([survivors, rest_survivors + used])
+                dets = np.concatenate([dets, rest_dets])
+                obs = np.concatenate([obs, rest_obs])
+            return survivors, dets, obs
+        if self.two_stage_sampler is not None:
+            return self.two_stage_sampler.sample_survivors(
+                shots, row_bytes=len(self.postselection_mask))
+        dets, obs = self.stim_sampler.sample(
+            shots=shots,
+            bit_packed=True,
+            separate_observables=True,
+        )
+        survivors = np.flatnonzero(~np.any(
+            dets[:, ps_bytes] & self.postselection_mask[ps_bytes], axis=1))
+        return survivors, dets[survivors], obs[survivors]
+
+    def _coset_weights(self, dets: np.ndarray) -> np.ndarray:
+        """Returns the (num_shots, 2**num_obs) coset weights of the kept shots.
+
+        Shots with zero, one or two detection events are looked up in the low
+        event table when there is one. Everything else goes to the gap matcher.
+        """
+        num_shots = dets.shape[0]
+        if self.low_event_table is not None:
+            weights, resolved = self.low_event_table.coset_weights(
+                dets[:, :self.controlled_det_byte])
+            self.tier_counts += self.low_event_table.last_tier_counts
+            rest = np.flatnonzero(~resolved)
+        else:
+            weights = np.empty(shape=(num_shots, 1 << self.num_obs), dtype=np.float64)
+            rest = np.arange(num_shots)
+
+        if len(rest):
+            weights[rest] = self._matcher_coset_weights(dets[rest])
+        self.tier_counts['matcher'] += len(rest)
+        return weights
+
+    def _matcher_coset_weights(self, dets: np.ndarray) -> np.ndarray:
+        """Decodes each distinct detector row once, then scatters the weights back.
+
+        Rows already in the coset cache skip the matcher entirely.
+        """
+        rows, inverse = np.unique(dets, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        self.tier_counts['matcher_distinct'] += rows.shape[0]
+
+        if self.coset_cache is None:
+            row_weights = _decode_coset_weights(
+                self.gap_matcher,
+                rows,
+                controlled_det_byte=self.controlled_det_byte,
+                num_obs=self.num_obs,
+                d2c=self.d2c,
+            )
+            return row_weights[inverse]
+
+        row_weights, found = self.coset_cache.lookup(rows, num_masks=1 << self.num_obs)
+        missing = np.flatnonzero(~found)
+        if len(missing):
+            decoded = _decode_coset_weights(
+                self.gap_matcher,
+                rows[missing],
+                controlled_det_byte=self.controlled_det_byte,
+                num_obs=self.num_obs,
+                d2c=self.d2c,
+            )
+            row_weights[missing] = decoded
+            self.coset_cache.insert(rows[missing], decoded)
+        return row_weights[inverse]
+
+    @property
+    def cache_stats(self) -> collections.Counter:
+        """Hit, miss and eviction counts of the coset cache (empty if disabled)."""
+        if self.coset_cache is None:
+            return collections.Counter()
+        return self.coset_cache.stats
+
+
+class GapHistogram:
+    """Counts kept shots by error flag and gap, with the gap in decibels.
+
+    Bins are db_bin_width decibels wide and are labelled by their lower edge,
+    so the default width reproduces keys like 'C59' and 'E12'. Gaps above
+    max_db are clamped into the last bin, which bounds the number of keys.
+    Histograms with the same binning merge by adding their count arrays.
+    """
+
+    def __init__(self, *, db_bin_width: int = 1, max_db: int | None = None):
+        if db_bin_width < 1:
+            raise ValueError(f'{db_bin_width=} < 1')
+        self.db_bin_width = db_bin_width
+        self.max_db = max_db
+        # Row 0 counts correct shots ('C'), row 1 counts errors ('E').
+        self.counts = np.zeros(shape=(2, 0), dtype=np.int64)
+
+    def _grow(self, num_bins: int) -> None:
+        if num_bins > self.counts.shape[1]:
+            grown = np.zeros(shape=(2, num_bins), dtype=np.int64)
+            grown[:, :self.counts.shape[1]] = self.counts
+            self.counts = grown
+
+    def _bins(self, gaps_db: np.ndarray) -> np.ndarray:
+        gaps_db = np.maximum(gaps_db, 0)
+        if self.max_db is not None:
+            gaps_db = np.minimum(gaps_db, self.max_db)
+        bins = gaps_db // self.db_bin_width
+        self._grow(int(np.max(bins)) + 1)
+        return bins
+
+    def add(self, errors: np.ndarray, gaps_db: np.ndarray) -> None:
+        """Adds shots given their error values (nonzero means an error) and integer dB gaps."""
+        if len(gaps_db) == 0:
+            return
+        bins = self._bins(gaps_db)
+        num_bins = self.counts.shape[1]
+        flat = np.bincount(
+            (errors != 0) * num_bins + bins,
+            minlength=2 * num_bins,
+        )
+        self.counts += flat.reshape(2, num_bins)
+
+    def merge(self, other: 'GapHistogram') -> None:
+        if (other.db_bin_width, other.max_db) != (self.db_bin_width, self.max_db):
+            raise ValueError("Can't merge gap histograms with different binning.")
+        self._grow(other.counts.shape[1])
+        self.counts[:, :other.counts.shape[1]] += other.counts
+
+    def to_custom_counts(self) -> collections.Counter:
+        custom_counts = collections.Counter()
+        for e, b in zip(*np.nonzero(self.counts)):
+            custom_counts[f'{"CE"[e]}{b * self.db_bin_width}'] = int(self.counts[e, b])
+        return custom_counts
+
+    @staticmethod
+    def from_custom_counts(custom_counts: dict[str, int],
+                           *,
+                           db_bin_width: int = 1,
+                           max_db: int | None = None) -> 'GapHistogram':
+        """Rebuilds a histogram from 'C<dB>'/'E<dB>' keys, e.g. from a sinter csv row."""
+        histogram = GapHistogram(db_bin_width=db_bin_width, max_db=max_db)
+        keys = [k for k in custom_counts if k[:1] in ('C', 'E')]
+        if not keys:
+            return histogram
+        errors = np.array([k[0] == 'E' for k in keys], dtype=np.int64)
+        gaps_db = np.array([int(k[1:]) for k in keys], dtype=np.int64)
+        num_shots = np.array([custom_counts[k] for k in keys], dtype=np.int64)
+        bins = histogram._bins(gaps_db)
+        np.add.at(histogram.counts, (errors, bins), num_shots)
+        return histogram
+
+
+class _CosetWeightCache:
+    """LRU memo from bit packed detector rows to their coset weights.
+
+    Entries are keyed on the row's bytes and evicted least-recently-used first
+    once their estimated size exceeds max_bytes.
+    """
+
+    # Rough per-entry cost of the dict slot, key object and value array headers.
+    ENTRY_OVERHEAD_BYTES = sys.getsizeof(b'') + sys.getsizeof(np.empty(0)) + 64
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.entries: collections.OrderedDict[bytes, np.ndarray] = collections.OrderedDict()
+        self.stats = collections.Counter()
+
+    def _entry_bytes(self, key: bytes, weights: np.ndarray) -> int:
+        return len(key) + weights.nbytes + self.ENTRY_OVERHEAD_BYTES
+
+    def lookup(self, rows: np.ndarray, *, num_masks: int) -> tuple[np.ndarray, np.ndarray]:
+        """Returns (weights, found) for each row, refreshing the rows that hit."""
+        weights = np.empty(shape=(rows.shape[0], num_masks), dtype=np.float64)
+        found = np.zeros(shape=rows.shape[0], dtype=np.bool_)
+        for k in range(rows.shape[0]):
+            key = rows[k].tobytes()
+            hit = self.entries.get(key)
+            if hit is not None:
+                self.entries.move_to_end(key)
+                weights[k] = hit
+                found[k] = True
+        num_hits = int(np.count_nonzero(found))
+        self.stats['hits'] += num_hits
+        self.stats['misses'] += rows.shape[0] - num_hits
+        return weights, found
+
+    def insert(self, rows: np.ndarray, weights: np.ndarray) -> None:
+        for k in range(rows.shape[0]):
+            key = rows[k].tobytes()
+            value = weights[k].copy()
+            self.entries[key] = value
+            self.num_bytes += self._entry_bytes(key, value)
+        while self.num_bytes > self.max_bytes and self.entries:
+            key, value = self.entries.popitem(last=False)
+            self.num_bytes -= self._entry_bytes(key, value)
+            self.stats['evictions'] += 1
+        self.stats['entries'] = len(self.entries)
+        self.stats['bytes'] = self.num_bytes
+
+
+# pymatching rounds edge weights to integers, using this many distinct levels
+# for the largest edge weight, and reports matching weights in those units.
+_PYMATCHING_NUM_DISTINCT_WEIGHTS = 1 << 24
+
+_POPCOUNT_8 = np.array([bin(k).count('1') for k in range(256)], dtype=np.uint8)
+
+
+class _LowEventCosetTable:
+    """Exact coset weights for shots with at most two detection events.
+
+    Stores shortest path lengths in the gap matching graph from every node to
+    the boundary and to every observable node, plus the node-to-node lengths
+    that can beat sending both nodes to the boundary. With at most two
+    detection events the minimum weight matching of each coset is one of a
+    handful of path combinations, so it can be evaluated with array lookups.
+
+    Path lengths are measured in pymatching's integer weight units, which makes
+    the looked up weights bit-identical to what the gap matcher reports.
+    """
+
+    def __init__(self,
+                 *,
+                 num_nodes: int,
+                 obs_nodes: np.ndarray,
+                 to_boundary: np.ndarray,
+                 to_obs: np.ndarray,
+                 pair_keys: np.ndarray,
+                 pair_dists: np.ndarray,
+                 normalising_constant: float):
+        self.num_nodes = num_nodes
+        self.num_obs = len(obs_nodes)
+        self.obs_nodes = obs_nodes
+        self.to_boundary = to_boundary
+        self.to_obs = to_obs
+        self.pair_keys = pair_keys
+        self.pair_dists = pair_dists
+        self.normalising_constant = normalising_constant
+        self.zero_event_weights = self._obs_only_weights()
+        self.last_tier_counts = collections.Counter()
+
+    @staticmethod
+    def from_matcher(matcher: pymatching.Matching,
+                     *,
+                     num_dets: int,
+                     num_obs: int,
+                     sources_per_chunk: int = 256) -> '_LowEventCosetTable | None':
+        """Builds the table, or returns None if the matcher can't be tabulated.
+
+        Args:
+            matcher: The gap matcher, with observable k on node num_dets + k.
+            num_dets: The byte-aligned number of ordinary detectors.
+            num_obs: The number of observables.
+            sources_per_chunk: How many Dijkstra sources to run at once.
+        """
+        num_nodes = matcher.num_nodes
+        boundary = num_nodes
+        edges = matcher.edges()
+        if not edges:
+            return None
+        us = np.array([u for u, _, _ in edges], dtype=np.int64)
+        vs = np.array([boundary if v is None else v for _, v, _ in edges], dtype=np.int64)
+        ws = np.array([d['weight'] for _, _, d in edges], dtype=np.float64)
+        if np.any(ws < 0):
+            return None
+        max_w = np.max(ws)
+        if max_w == 0:
+            return None
+        normalising_constant = (_PYMATCHING_NUM_DISTINCT_WEIGHTS - 1) / max_w
+        ws = np.round(ws * normalising_constant)
+        boundary_nodes = np.array(sorted(matcher.boundary), dtype=np.int64)
+        us = np.concatenate([us, boundary_nodes])
+        vs = np.concatenate([vs, np.full(len(boundary_nodes), boundary)])
+        ws = np.concatenate([ws, np.zeros(len(boundary_nodes))])
+
+        # Keep the lightest of any parallel edges; csr construction would sum them.
+        order = np.lexsort((ws, np.maximum(us, vs), np.minimum(us, vs)))
+        lo = np.minimum(us, vs)[order]
+        hi = np.maximum(us, vs)[order]
+        ws = ws[order]
+        first = np.ones(len(lo), dtype=np.bool_)
+        first[1:] = (lo[1:] != lo[:-1]) | (hi[1:] != hi[:-1])
+        lo, hi, ws = lo[first], hi[first], ws[first]
+        graph = scipy.sparse.csr_matrix((ws, (lo, hi)), shape=(num_nodes + 1, num_nodes + 1))
+
+        obs_nodes = num_dets + np.arange(num_obs, dtype=np.int64)
+        dist = scipy.sparse.csgraph.dijkstra(
+            graph, directed=False, indices=np.concatenate([[boundary], obs_nodes]))
+        to_boundary = dist[0, :num_nodes]
+        to_obs = np.ascontiguousarray(dist[1:, :num_nodes].T)
+
+        # A pair only needs its own entry when matching it together beats
+        # matching both of its nodes to the boundary.
+        finite = np.isfinite(to_boundary)
+        max_to_boundary = np.max(to_boundary[finite]) if np.any(finite) else 0.0
+        keys = []
+        dists = []
+        for start in range(0, num_nodes, sources_per_chunk):
+            sources = np.arange(start, min(num_nodes, start + sources_per_chunk))
+            limit = np.max(to_boundary[sources]) + max_to_boundary
+            block = scipy.sparse.csgraph.dijkstra(
+                graph, directed=False, indices=sources, limit=limit)[:, :num_nodes]
+            a, b = np.nonzero(block < to_boundary[sources, None] + to_boundary[None, :])
+            keep = a + start < b
+            a, b = a[keep], b[keep]
+            keys.append((a + start) * num_nodes + b)
+            dists.append(block[a, b])
+        pair_keys = np.concatenate(keys)
+        order = np.argsort(pair_keys)
+
+        table = _LowEventCosetTable(
+            num_nodes=num_nodes,
+            obs_nodes=obs_nodes,
+            to_boundary=to_boundary,
+            to_obs=to_obs,
+            pair_keys=pair_keys[order],
+            pair_dists=np.concatenate(dists)[order],
+            normalising_constant=normalising_constant,
+        )
+        if not table._agrees_with_matcher(matcher, num_dets=num_dets):
+            return None
+        return table
+
+    def _agrees_with_matcher(self, matcher: pymatching.Matching, *, num_dets: int, num_checks: int = 16) -> bool:
+        """Spot checks single event shots against the matcher.
+
+        Guards against pymatching changing how it discretizes edge weights.
+        """
+        nodes = np.flatnonzero(np.isfinite(self.to_boundary[:num_dets]))[:num_checks]
+        if not len(nodes):
+            return True
+        num_masks = 1 << self.num_obs
+        dets = np.zeros(shape=(len(nodes), num_dets // 8 + 1), dtype=np.uint8)
+        dets[np.arange(len(nodes)), nodes >> 3] = 1 << (nodes & 7)
+        expected, resolved = self.coset_weights(dets[:, :-1])
+        if not np.all(resolved):
+            return True
+        try:
+            actual = _decode_coset_weights(
+                matcher,
+                dets,
+                controlled_det_byte=num_dets >> 3,
+                num_obs=self.num_obs,
+                d2c={},
+            )
+        except ValueError:
+            return False
+        return np.array_equal(expected, actual.reshape(-1, num_masks))
+
+    def _obs_only_weights(self) -> np.ndarray:
+        """Minimum matching lengths of each set of flipped observable nodes."""
+        num_masks = 1 << self.num_obs
+        obs_to_boundary = self.to_boundary[self.obs_nodes]
+        obs_to_obs = self.to_obs[self.obs_nodes]
+        result = np.zeros(shape=num_masks, dtype=np.float64)
+        for mask in range(1, num_masks):
+            i = (mask & -mask).bit_length() - 1
+            rest = mask ^ (1 << i)
+            best = obs_to_boundary[i] + result[rest]
+            for j in range(i + 1, self.num_obs):
+                if rest & (1 << j):
+                    best = min(best, obs_to_obs[i, j] + result[rest ^ (1 << j)])
+            result[mask] = best
+        return result
+
+    def _pair_dist(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        if not len(self.pair_keys):
+            return np.full(shape=len(a), fill_value=np.inf)
+        keys = np.minimum(a, b) * self.num_nodes + np.maximum(a, b)
+        pos = np.minimum(np.searchsorted(self.pair_keys, keys), len(self.pair_keys) - 1)
+        return np.where(self.pair_keys[pos] == keys, self.pair_dists[pos], np.inf)
+
+    def _one_event_weights(self, a: np.ndarray) -> np.ndarray:
+        z = self.zero_event_weights
+        result = np.empty(shape=(len(a), len(z)), dtype=np.float64)
+        for mask in range(len(z)):
+            best = self.to_boundary[a] + z[mask]
+            for i in range(self.num_obs):
+                if mask & (1 << i):
+                    best = np.minimum(best, self.to_obs[a, i] + z[mask ^ (1 << i)])
+            result[:, mask] = best
+        return result
+
+    def _two_event_weights(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        z = self.zero_event_weights
+        result = np.empty(shape=(len(a), len(z)), dtype=np.float64)
+        to_boundary_a = self.to_boundary[a]
+        to_boundary_b = self.to_boundary[b]
+        paired = np.minimum(self._pair_dist(a, b), to_boundary_a + to_boundary_b)
+        for mask in range(len(z)):
+            best = paired + z[mask]
+            for i in range(self.num_obs):
+                if not mask & (1 << i):
+                    continue
+                rest = mask ^ (1 << i)
+                best = np.minimum(best, to_boundary_a + self.to_obs[b, i] + z[rest])
+                best = np.minimum(best, self.to_obs[a, i] + to_boundary_b + z[rest])
+                for j in range(self.num_obs):
+                    if j != i and rest & (1 << j):
+                        best = np.minimum(best, self.to_obs[a, i] + self.to_obs[b, j] + z[rest ^ (1 << j)])
+            result[:, mask] = best
+        return result
+
+    def coset_weights(self, event_bytes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Computes coset weights for the shots with at most two detection events.
+
+        Args:
+            event_bytes: Bit packed detection events, excluding the byte holding
+                the observable nodes.
+
+        Returns:
+            A (weights, resolved) tuple. weights has shape (num_shots,
+            2**num_obs) and is only filled in where resolved is True.
+        """
+        num_shots = event_bytes.shape[0]
+        weights = np.empty(shape=(num_shots, 1 << self.num_obs), dtype=np.float64)
+        resolved = np.zeros(shape=num_shots, dtype=np.bool_)
+        counts = _POPCOUNT_8[event_bytes].sum(axis=1, dtype=np.int64)
+
+        zero = np.flatnonzero(counts == 0)
+        weights[zero] = self.zero_event_weights
+
+        low = np.flatnonzero((counts == 1) | (counts == 2))
+        bits = np.unpackbits(event_bytes[low], axis=1, bitorder='little')
+        shot_pos, nodes = np.nonzero(bits)
+        starts = np.searchsorted(shot_pos, np.arange(len(low)))
+        one = counts[low] == 1
+        weights[low[one]] = self._one_event_weights(nodes[starts[one]])
+        two = ~one
+        weights[low[two]] = self._two_event_weights(nodes[starts[two]], nodes[starts[two] + 1])
+
+        resolved[zero] = True
+        resolved[low] = True
+        # Unreachable cosets are left for the matcher to report.
+        resolved &= np.all(np.isfinite(weights), axis=1, where=resolved[:, None])
+        weights[resolved] /= self.normalising_constant
+
+        self.last_tier_counts = collections.Counter({
+            'zero_events': np.count_nonzero(resolved[zero]),
+            'one_event': np.count_nonzero(resolved[low[one]]),
+            'two_events': np.count_nonzero(resolved[low[two]]),
+        })
+        return weights, resolved
+
+
+def _decode_coset_weights(
+        matcher: pymatching.Matching,
+        dets: np.ndarray,
+        *,
+        controlled_det_byte: int,
+        num_obs: int,
+        d2c: dict[int, list[float]],
+        max_chunk_bytes: int = 1 << 26,
+) -> np.ndarray:
+    """Decodes every observable coset of every shot, one decode_batch call per mask.
+
+    This is plain batching, not a shared matching: pymatching can't reuse one
+    coset's matching for another, so every shot still costs 2**num_obs full
+    matchings. Shots are copied in chunks of at most max_chunk_bytes, and the
+    controlled detector byte of the copy is set to each mask in turn, so the
+    caller's array is left alone and memory doesn't grow with 2**num_obs.
+
+    Returns:
+        A float64 array of shape (num_shots, 2**num_obs) where entry [k, mask] is
+        the weight of the lightest matching of shot k within the coset that flips
+        exactly the observables in mask.
+    """
+    num_masks = 1 << num_obs
+    num_shots, num_bytes = dets.shape
+    weights = np.empty(shape=(num_shots, num_masks), dtype=np.float64)
+    chunk = max(1, max_chunk_bytes // num_bytes)
+    for start in range(0, num_shots, chunk):
+        block = dets[start:start + chunk].copy()
+        for mask in range(num_masks):
+            block[:, controlled_det_byte] = mask
+            weights[start:start + chunk, mask] = _decode_weight_with_pymatching_with_better_error_message(
+                matcher,
+                block,
+                d2c,
+            )
+    return weights
+
 
 def _decode_weight_with_pymatching_with_better_error_message(
         matcher: pymatching.Matching,
@@ -0,0 +1,144 @@
+import collections
+
+import numpy as np
+import pytest
+import sinter
+
+from full_clifford_sim.gap_sampler import CompiledPymatchingGapSampler, GapHistogram, _decode_coset_weights, \
+    is_postselected, postselected_detectors
+from full_clifford_sim.main_complied_fxns import full_circuit
+
+
+def _task(p: float = 0.001, dfinal: int = 5) -> sinter.Task:
+    circuit = full_circuit(p, dfinal, 'hookinj', verify=False)
+    try:
+        dem = circuit.detector_error_model(decompose_errors=True, approximate_disjoint_errors=True)
+    except ValueError:
+        dem = circuit.detector_error_model(approximate_disjoint_errors=True)
+    return sinter.Task(circuit=circuit, detector_error_model=dem)
+
+
+def _kept_dets(sampler: CompiledPymatchingGapSampler, shots: int) -> np.ndarray:
+    _, dets, _ = sampler._sample_survivors(shots)
+    return dets
+
+
+def test_postselected_detectors():
+    circuit = full_circuit(0.001, 5, 'hookinj', verify=False)
+    d2c = circuit.get_detector_coordinates()
+    expected = [is_postselected(d2c[k]) for k in range(circuit.num_detectors)]
+    np.testing.assert_array_equal(postselected_detectors(circuit), expected)
+
+
+def test_low_event_tiers_match_matcher():
+    sampler = CompiledPymatchingGapSampler(_task(), None)
+    table = sampler.low_event_table
+    assert table is not None
+    dets = _kept_dets(sampler, 20_000)
+
+    weights, resolved = table.coset_weights(dets[:, :sampler.controlled_det_byte])
+    for tier in ['zero_events', 'one_event', 'two_events']:
+        assert table.last_tier_counts[tier] > 0
+    expected = _decode_coset_weights(
+        sampler.gap_matcher,
+        dets[resolved],
+        controlled_det_byte=sampler.controlled_det_byte,
+        num_obs=sampler.num_obs,
+        d2c=sampler.d2c,
+    )
+    np.testing.assert_array_equal(weights[resolved], expected)
+
+
+def test_coset_weights_match_with_and_without_tiers():
+    task = _task()
+    tiered = CompiledPymatchingGapSampler(task, None)
+    plain = CompiledPymatchingGapSampler(task, None, low_event_tiers=False)
+    dets = _kept_dets(tiered, 5_000)
+    np.testing.assert_array_equal(tiered._coset_weights(dets), plain._coset_weights(dets))
+
+
+def test_coset_cache_serves_repeated_rows():
+    task = _task()
+    cached = CompiledPymatchingGapSampler(task, None, cache_bytes=1 << 20)
+    dets = _kept_dets(cached, 5_000)
+    expected = CompiledPymatchingGapSampler(task, None)._coset_weights(dets)
+    np.testing.assert_array_equal(cached._coset_weights(dets), expected)
+    np.testing.assert_array_equal(cached._coset_weights(dets), expected)
+    assert cached.cache_stats['hits'] > 0
+
+
+def test_sample_reports_decode_counts_when_asked():
+    task = _task()
+    stats = CompiledPymatchingGapSampler(task, None, cache_bytes=1 << 20).sample(2_000)
+    assert all(k[:1] in ('C', 'E') for k in stats.custom_counts)
+
+    # A tiny cache, so entries get evicted.
+    sampler = CompiledPymatchingGapSampler(task, None, cache_bytes=1 << 12, report_decode_counts=True)
+    stats = sampler.sample(2_000)
+    kept = stats.shots - stats.discards
+    counts = stats.custom_counts
+    assert sum(v for k, v in counts.items() if k[:1] in ('C', 'E')) == kept
+    assert sum(counts[f'tier_{t}'] for t in ['zero_events', 'one_event', 'two_events', 'matcher']) == kept
+    assert counts['coset_cache_hits'] + counts['coset_cache_misses'] == counts['tier_matcher_distinct']
+    assert counts['coset_cache_evictions'] == sampler.cache_stats['evictions'] > 0
+
+
+def test_gap_histogram_matches_per_shot_keys():
+    rng = np.random.default_rng(0)
+    errors = rng.integers(2, size=10_000)
+    gaps_db = rng.integers(-3, 80, size=10_000)
+    expected = collections.Counter(f'{"CE"[e]}{max(g, 0)}' for e, g in zip(errors.tolist(), gaps_db.tolist()))
+
+    histogram = GapHistogram()
+    histogram.add(errors[:4_000], gaps_db[:4_000])
+    rest = GapHistogram()
+    rest.add(errors[4_000:], gaps_db[4_000:])
+    histogram.merge(rest)
+    assert histogram.to_custom_counts() == expected
+    again = GapHistogram.from_custom_counts({**expected, 'tier_matcher': 5})
+    np.testing.assert_array_equal(again.counts, histogram.counts)
+
+
+def test_gap_histogram_bins_and_clamps():
+    histogram = GapHistogram(db_bin_width=10, max_db=35)
+    histogram.add(np.array([0, 0, 1, 1]), np.array([9, 10, 34, 99]))
+    assert histogram.to_custom_counts() == {'C0': 1, 'C10': 1, 'E30': 2}
+    with pytest.raises(ValueError):
+        histogram.merge(GapHistogram())
+
+
+class _ReplayedShots:
+    "Stands in for a stim sampler, handing out rows of pre-sampled shots in order"
+
+    def __init__(self, dets: np.ndarray, obs: np.ndarray):
+        self.dets = dets
+        self.obs = obs
+        self.next_shot = 0
+
+    def sample(self, shots: int, *, bit_packed: bool, separate_observables: bool):
+        assert bit_packed and separate_observables
+        start = self.next_shot
+        self.next_shot += shots
+        assert self.next_shot <= len(self.dets)
+        return self.dets[start:self.next_shot], self.obs[start:self.next_shot]
+
+
+def test_streaming_batches_match_plain_sampling():
+    task = _task(p=0.002)
+    streaming = CompiledPymatchingGapSampler(task, None, kept_shots_per_batch=500, stream_chunk_shots=700)
+    plain = CompiledPymatchingGapSampler(task, None)
+    dets, obs = streaming.stim_sampler.sample(shots=30_000, bit_packed=True, separate_observables=True)
+    streaming.stim_sampler = replayed = _ReplayedShots(dets, obs)
+
+    for _ in range(5):
+        start = replayed.next_shot
+        stats = streaming.sample(10_000)
+        assert stats.shots - stats.discards == 500
+        assert stats.shots < 10_000
+        # The shots counted are the ones drawn before the buffer filled, and
+        # they score the same as sampling them in one go.
+        plain.stim_sampler = _ReplayedShots(dets[start:start + stats.shots], obs[start:start + stats.shots])
+        expected = plain.sample(stats.shots)
+        assert (stats.shots, stats.errors, stats.discards, stats.custom_counts) == \
+            (expected.shots, expected.errors, expected.discards, expected.custom_counts)
+    assert streaming._kept_dets.shape[0] == 500
@@ -0,0 +1,264 @@
+import contextlib
+import io
+import pathlib
+import tempfile
+import time
+
+import sinter
+import stim
+
+from full_clifford_sim.dem_utils import dem_with_compressed_detectors
+from full_clifford_sim.gap_sampler import CompiledPymatchingGapSampler, is_postselected
+from full_clifford_sim.main_complied_fxns import full_circuit, full_circuit_skeleton, sample_cultivation_frames
+from full_clifford_sim.parametric_dem import sweep_tasks
+from full_clifford_sim.qubit_map import compact_qubits
+from full_clifford_sim.sweep_grid import iter_grid_tasks, sweep_grid
+
+SAMPLE_CIRCUITS = pathlib.Path(__file__).resolve().parents[2] / 'sample_circuits'
+
+
+def load_sample_task(name: str) -> sinter.Task:
+    "Loads one of the baseline circuits in sample_circuits, e.g. 'fd3' or 'fd5'"
+    return task_for_circuit(stim.Circuit.from_file(SAMPLE_CIRCUITS / f'{name}_baseline_ckt.stim'))
+
+
+def task_for_circuit(circuit: stim.Circuit) -> sinter.Task:
+    "Wraps a circuit in a task, decomposing its errors when stim can"
+    try:
+        dem = circuit.detector_error_model(decompose_errors=True,
+                                           approximate_disjoint_errors=True)
+    except ValueError:
+        dem = circuit.detector_error_model(approximate_disjoint_errors=True)
+    return sinter.Task(circuit=circuit, detector_error_model=dem)
+
+
+def bench_low_event_tiers(name: str, shots: int) -> None:
+    "Reports how many kept shots each decoding tier resolves, and the time saved"
+    task = load_sample_task(name)
+    for tiers in [False, True]:
+        sampler = CompiledPymatchingGapSampler(task, None, low_event_tiers=tiers)
+        t0 = time.monotonic()
+        stats = sampler.sample(shots)
+        t1 = time.monotonic()
+        kept = stats.shots - stats.discards
+        print(f'{name} low_event_tiers={tiers}: {t1 - t0:.2f}s for {stats.shots} shots ({kept} kept)')
+        if tiers:
+            for tier in ['zero_events', 'one_event', 'two_events', 'matcher']:
+                n = sampler.tier_counts[tier]
+                print(f'    {tier:>12}: {n:>9} ({n / max(kept, 1):.1%})')
+
+
+def bench_coset_cache(name: str, shots: int, batches: int, cache_bytes: int) -> None:
+    "Reports syndrome deduplication and coset cache hit rates over several batches"
+    task = load_sample_task(name)
+    sampler = CompiledPymatchingGapSampler(task, None, cache_bytes=cache_bytes, report_decode_counts=True)
+    t0 = time.monotonic()
+    total = sinter.AnonTaskStats()
+    for _ in range(batches):
+        total += sampler.sample(shots)
+    t1 = time.monotonic()
+    # The counts sinter would add up over its workers.
+    counts = total.custom_counts
+    matched = counts['tier_matcher']
+    distinct = counts['tier_matcher_distinct']
+    hits = counts['coset_cache_hits']
+    lookups = max(hits + counts['coset_cache_misses'], 1)
+    stats = sampler.cache_stats
+    print(f'{name} cache_bytes={cache_bytes}: {t1 - t0:.2f}s for {batches}x{shots} shots')
+    print(f'    matcher shots {matched}, distinct per batch {distinct} ({distinct / max(matched, 1):.1%})')
+    print(f'    hits {hits} ({hits / lookups:.1%}), misses {counts["coset_cache_misses"]}, '
+          f'evictions {counts["coset_cache_evictions"]}, entries {stats["entries"]} ({stats["bytes"]} bytes)')
+
+
+def bench_two_stage(name: str, shots: int) -> None:
+    "Compares drawing postselected shots in one pass against the two stage sampler"
+    task = load_sample_task(name)
+    for two_stage in [False, True]:
+        sampler = CompiledPymatchingGapSampler(task, None, two_stage=two_stage)
+        t0 = time.monotonic()
+        kept, _, _ = sampler._sample_survivors(shots)
+        t1 = time.monotonic()
+        print(f'{name} two_stage={two_stage}: {t1 - t0:.2f}s to draw {shots} shots ({len(kept)} kept)')
+    split = sampler.two_stage_sampler
+    print(f'    prefix holds {split.prefix.num_detectors} of {split.num_detectors} detectors, '
+          f'replays {split.lookback} measurements')
+
+
+def bench_construction(name: str) -> None:
+    "Prints where CompiledPymatchingGapSampler construction time goes, stage by stage"
+    task = load_sample_task(name)
+    t0 = time.monotonic()
+    sampler = CompiledPymatchingGapSampler(task, None)
+    t1 = time.monotonic()
+    sampler.sample(1)  # builds the lazily compiled parts
+    print(f'{name} construction: {t1 - t0:.3f}s')
+    for stage, seconds in sampler.construction_seconds.items():
+        print(f'    {stage:>16}: {seconds:.3f}s')
+
+
+def bench_compression(name: str, max_compressed_errors: int, epsilons: list[float]) -> None:
+    "Shows the speed / accuracy trade off of pruning higher order DEM compression"
+    dem = load_sample_task(name).detector_error_model
+    for epsilon in epsilons:
+        report = {}
+        t0 = time.monotonic()
+        dem_with_compressed_detectors(
+            dem=dem,
+            compressed_detector_predicate=is_postselected,
+            max_compressed_errors=max_compressed_errors,
+            error_size_cutoff=3,
+            detection_event_cutoff=4,
+            epsilon=epsilon,
+            report=report,
+        )
+        t1 = time.monotonic()
+        print(f'{name} max_compressed_errors={max_compressed_errors} epsilon={epsilon}: {t1 - t0:.2f}s, '
+              f'discarded {report["discarded_combinations"]} combinations '
+              f'holding {report["discarded_mass"]:.3g} probability')
+
+
+def bench_parallel_compression(name: str, max_compressed_errors: int, workers: list[int]) -> None:
+    "Times DEM compression with the error folding spread over process pools of several sizes"
+    dem = load_sample_task(name).detector_error_model
+    expected = None
+    for num_workers in workers:
+        t0 = time.monotonic()
+        out = dem_with_compressed_detectors(
+            dem=dem,
+            compressed_detector_predicate=is_postselected,
+            max_compressed_errors=max_compressed_errors,
+            error_size_cutoff=3,
+            detection_event_cutoff=4,
+            num_workers=num_workers,
+        )
+        t1 = time.monotonic()
+        if expected is None:
+            expected = out
+        print(f'{name} max_compressed_errors={max_compressed_errors} num_workers={num_workers}: '
+              f'{t1 - t0:.2f}s, same result: {out == expected}')
+
+
+def bench_compact_qubits(name: str, shots: int) -> None:
+    "Compares sampling a baseline circuit before and after renumbering its qubits densely"
+    circuit = load_sample_task(name).circuit
+    compact, _ = compact_qubits(circuit)
+    for label, c in [('sparse', circuit), ('compact', compact)]:
+        task = task_for_circuit(c)
+        sampler = CompiledPymatchingGapSampler(task, None)
+        t0 = time.monotonic()
+        c.compile_detector_sampler().sample(shots, bit_packed=True)
+        t1 = time.monotonic()
+        stats = sampler.sample(shots)
+        t2 = time.monotonic()
+        print(f'{name} {label} ({c.num_qubits} qubits): stim {t1 - t0:.2f}s, '
+              f'gap sampler {t2 - t1:.2f}s for {shots} shots ({stats.errors} errors)')
+
+
+def bench_artifact_cache(name: str) -> None:
+    "Compares building a sampler from scratch against loading its DEM artifacts from disk"
+    task = load_sample_task(name)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for attempt in ['cold', 'warm']:
+            t0 = time.monotonic()
+            CompiledPymatchingGapSampler(task, None, artifact_cache_dir=cache_dir)
+            t1 = time.monotonic()
+            print(f'{name} artifact cache {attempt}: constructed in {t1 - t0:.2f}s')
+
+
+def bench_parametric_sweep(dfinal: int, ps: list[float]) -> None:
+    "Compares building a p sweep's circuits and DEMs for every p against one parametric DEM"
+    def circuit_at(p: float) -> stim.Circuit:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return full_circuit(p, dfinal=dfinal, prep='hookinj')
+
+    t0 = time.monotonic()
+    stim_tasks = [task_for_circuit(circuit_at(p)) for p in ps]
+    t1 = time.monotonic()
+    tasks = sweep_tasks(circuit_at(ps[0]), ps[0], ps)
+    t2 = time.monotonic()
+    close = all(
+        a.detector_error_model.approx_equals(b.detector_error_model, atol=1e-12)
+        for a, b in zip(stim_tasks, tasks)
+    )
+    print(f'd{dfinal} sweep of {len(ps)} p: per p {t1 - t0:.2f}s, parametric DEM {t2 - t1:.2f}s, '
+          f'same models: {close}')
+
+
+def bench_skeleton_cache(dfinal: int, ps: list[float]) -> None:
+    "Compares building a p sweep's circuits from scratch against reusing one noiseless skeleton"
+    for cached in [False, True]:
+        full_circuit_skeleton.cache_clear()
+        t0 = time.monotonic()
+        for p in ps:
+            if not cached:
+                full_circuit_skeleton.cache_clear()
+            with contextlib.redirect_stdout(io.StringIO()):
+                full_circuit(p, dfinal=dfinal, prep='hookinj', handoff=True)
+        t1 = time.monotonic()
+        print(f'd{dfinal} {len(ps)} circuits, skeleton cached={cached}: {t1 - t0:.2f}s')
+
+
+def bench_folded_rounds(dfinal: int, rounds: list[int]) -> None:
+    "Shows that circuit and DEM construction stay flat as escape rounds are added"
+    for latter_rounds in rounds:
+        t0 = time.monotonic()
+        with contextlib.redirect_stdout(io.StringIO()):
+            circuit = full_circuit(0.001, dfinal=dfinal, prep='hookinj', latter_rounds=latter_rounds)
+        t1 = time.monotonic()
+        dem = task_for_circuit(circuit).detector_error_model
+        t2 = time.monotonic()
+        print(f'd{dfinal} x{latter_rounds}: circuit {t1 - t0:.2f}s ({len(circuit)} instructions), '
+              f'DEM {t2 - t1:.2f}s ({len(dem)} instructions)')
+
+
+def bench_frame_store(p: float, shots: int, variants: list[tuple[int, int]]) -> None:
+    "Feeds several (dfinal, latter_rounds) escape stages from one stored cultivation prefix"
+    with tempfile.TemporaryDirectory() as store_dir:
+        t0 = time.monotonic()
+        path = sample_cultivation_frames(p, 'hookinj', shots, store_dir)
+        t1 = time.monotonic()
+        print(f'hookinj p={p}: stored {shots} cultivation shots in {t1 - t0:.2f}s ({path.stat().st_size} bytes)')
+        for dfinal, latter_rounds in variants:
+            with contextlib.redirect_stdout(io.StringIO()):
+                circuit = full_circuit(p, dfinal=dfinal, prep='hookinj', latter_rounds=latter_rounds)
+            task = task_for_circuit(circuit)
+            for frame_store_dir in [None, store_dir]:
+                sampler = CompiledPymatchingGapSampler(task, None, frame_store_dir=frame_store_dir)
+                t0 = time.monotonic()
+                stats = sampler.sample(shots)
+                t1 = time.monotonic()
+                source = 'store' if frame_store_dir else 'fresh'
+                print(f'    d{dfinal} x{latter_rounds} {source}: {t1 - t0:.2f}s, '
+                      f'{stats.shots - stats.discards} kept, {stats.errors} errors')
+
+
+def bench_sweep_grid(dfinals: list[int], ps: list[float], workers: list[int]) -> None:
+    "Times building a sweep grid's tasks, and how long collection would wait for the first one"
+    grid = sweep_grid(ps=ps, preps=['hookinj', 'unitstab'], dfinals=dfinals)
+    for num_workers in workers:
+        t0 = time.monotonic()
+        first = None
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in iter_grid_tasks(grid, num_workers=num_workers):
+                if first is None:
+                    first = time.monotonic() - t0
+        t1 = time.monotonic()
+        print(f'{len(grid)} points, {num_workers} workers: {t1 - t0:.2f}s, first task after {first:.2f}s')
+
+
+if __name__ == '__main__':
+
+    for name in ['fd3', 'fd5']:
+        bench_construction(name)
+        bench_compression(name, max_compressed_errors=4, epsilons=[0.0, 1e-3, 1e-2, 1e-1])
+        bench_parallel_compression(name, max_compressed_errors=6, workers=[1, 2, 4, 8])
+        bench_low_event_tiers(name, shots=100_000)
+        bench_coset_cache(name, shots=20_000, batches=5, cache_bytes=1 << 24)
+        bench_two_stage(name, shots=100_000)
+        bench_artifact_cache(name)
+        bench_compact_qubits(name, shots=200_000)
+    bench_skeleton_cache(11, ps=[0.0005 * k for k in range(1, 11)])
+    bench_folded_rounds(9, rounds=[3, 10, 30, 100])
+    bench_parametric_sweep(7, ps=[0.0005 * k for k in range(1, 11)])
+    bench_frame_store(0.001, shots=100_000, variants=[(5, 2), (7, 3), (9, 3)])
+    bench_sweep_grid([7, 9, 11], ps=[0.0005 * k for k in range(1, 5)], workers=[1, 2, 4])
@@ -1,31 +1,45 @@
+import functools
+import hashlib
+import os
+import pathlib
+import sys
+
 import stim
 from full_clifford_sim.coords import *
 from full_clifford_sim.full_circuit_fxns import *
 from full_clifford_sim.s3_fxns import *
-from full_clifford_sim.noise_model import insert_circuit_errs
+from full_clifford_sim.noise_model import SegmentedCircuit
+from full_clifford_sim.qubit_map import compact_qubits
+from full_clifford_sim.verification import verify_circuits
+from full_clifford_sim.frame_store import FrameStore
+from full_clifford_sim.gap_sampler import postselected_detectors
 import full_clifford_sim.ug_coords as sc
 
-def full_circuit(nm: float, 
-                 dfinal: int, 
-                 prep: str,
-                 latter_rounds: int = 3,
-                 ghz_size: int = 3,
-                 component_array: List = [1,1,1,1,1,1],
-                 cultiv_only: bool = False,
-                 ps_on_d3: int = 0,
-                 neutralatom: bool = False,
-                 handoff: bool= False
-                 ) -> stim.Circuit:
-    
+# The modules that decide what a skeleton contains (and how it is saved).
+_SKELETON_BUILDER_MODULES = [
+    __name__,
+    'full_clifford_sim.circuit_text',
+    'full_clifford_sim.coords',
+    'full_clifford_sim.full_circuit_fxns',
+    'full_clifford_sim.ghz_fxns',
+    'full_clifford_sim.noise_model',
+    'full_clifford_sim.s3_fxns',
+    'full_clifford_sim.ug_coords',
+]
 
-    rsc = FullCircuit(dx=dfinal,
-                    dy=dfinal ,
-                    glen=ghz_size, 
-                    basis="Y",
-                    smallsc=(ps_on_d3==2))
-    
-    #component_array [0:unitary prep, 1:ghz_prep+dec, 2:cbasis_check, \
-    # 3:uni_grow, 4:d5_stab, 5:final_growth]
+
+@functools.cache
+def _skeleton_builder_hash() -> str:
+    "Fingerprints the skeleton builder, so saved skeletons go stale when it changes"
+    h = hashlib.sha256(stim.__version__.encode())
+    for name in _SKELETON_BUILDER_MODULES:
+        h.update(pathlib.Path(sys.modules[name].__file__).read_bytes())
+    return h.hexdigest()[:16]
+
+def _add_cultivation_prefix(rsc: FullCircuit,
+                            segments: SegmentedCircuit,
+                            prep: str) -> None:
+    "Appends the Y state prep and the CH checks, which every escape stage shares"
 
     if prep == "hookinj":
         #stab base hook inj + Y prep
@@ -43,42 +57,55 @@ def full_circuit(nm: float,
     else:
         raise NotImplementedError
 
-    rsc.qcircuit += insert_circuit_errs(prep_circuit, nm, 
-        valid = component_array[0], convert_nac=neutralatom)   
+    segments.append(prep_circuit, component=0)
 
     #CH check
     for _ in range(2): 
 
         #ghz prep
         ghz_prep = rsc.ghzcirc.prepare_ghz_state()
-        rsc.qcircuit += insert_circuit_errs(ghz_prep, nm, 
-            valid = component_array[1], convert_nac=neutralatom)
+        segments.append(ghz_prep, component=1)
 
-        #noisy check
+        #noisy check (twice as noisy on neutral atoms)
         noisy_check = rsc.cbasis_check()
-        rsc.qcircuit += insert_circuit_errs(noisy_check, nm+(nm*neutralatom), 
-            valid = component_array[2], convert_nac=neutralatom)
+        segments.append(noisy_check, component=2, neutral_atom_scale=2)
         
         ghz_meas = rsc.ghzcirc.measure_ghz_state()
-        rsc.qcircuit += insert_circuit_errs(ghz_meas, nm, 
-            valid = component_array[1], convert_nac=neutralatom)
-            
-        
+        segments.append(ghz_meas, component=1)
+
+
+def _build_skeleton(dfinal: int,
+                    prep: str,
+                    latter_rounds: int,
+                    ghz_size: int,
+                    cultiv_only: bool,
+                    ps_on_d3: int,
+                    handoff: bool
+                    ) -> SegmentedCircuit:
+
+    rsc = FullCircuit(dx=dfinal,
+                    dy=dfinal ,
+                    glen=ghz_size, 
+                    basis="Y",
+                    smallsc=(ps_on_d3==2))
+    
+    #component_array [0:unitary prep, 1:ghz_prep+dec, 2:cbasis_check, \
+    # 3:uni_grow, 4:d5_stab, 5:final_growth]
+    segments = SegmentedCircuit()
+    segments.append(rsc.qcircuit)
+    _add_cultivation_prefix(rsc, segments, prep)
+
     if ps_on_d3 == 1: # we might choose to PS on Reg(3)
         stay_ps =  rsc.cstage_circ.d3reg_stabmsmt()
-        rsc.qcircuit += insert_circuit_errs(stay_ps, nm,
-                valid = component_array[4], convert_nac=neutralatom)  
+        segments.append(stay_ps, component=4)
     elif ps_on_d3 == 2: #we might choose stab msmt on Rot(3)
-        print("WARNING: doing ps on Rot")
         rot_ps = rsc.cstage_circ.d3_rotmeas(onlylasttwo=True, prev=False)
-        rsc.qcircuit += insert_circuit_errs(rot_ps, nm,
-                valid = component_array[4], convert_nac=neutralatom)  
+        segments.append(rot_ps, component=4)
     
     #grow d3 to d5 using unitary encoder     
     if ps_on_d3 != 2:
         grow_d3d5 = rsc.cstage_circ.grow_3u5r()
-        rsc.qcircuit += insert_circuit_errs(grow_d3d5, nm,
-            valid = component_array[3], convert_nac=neutralatom)
+        segments.append(grow_d3d5, component=3)
 
     #do postselecion on stab msmt at d-5
     if ps_on_d3 == 0: 
@@ -86,11 +113,10 @@ def full_circuit(nm: float,
         grow_ps += rsc.sc_detectors(curr_only=True, 
                                     d_rest=5, 
                                     ps_round=True)
-        rsc.qcircuit += insert_circuit_errs(grow_ps, nm,
-            valid = component_array[4], convert_nac=neutralatom)
+        segments.append(grow_ps, component=4)
 
     if cultiv_only: #always returns at Rot(5)
-        return rsc.qcircuit
+        return segments
         
     
     d_rest = 3 if ps_on_d3 == 2 else 5
@@ -104,31 +130,161 @@ def full_circuit(nm: float,
                                     d_rest=d_rest)
 
     #do latter stab msmts on larger code
-    for _ in range(latter_rounds - 1):
-        grow_final += rsc.sc_stab_round()
+    if latter_rounds > 1:
+        stab_round = rsc.sc_stab_round()
+        grow_final += stab_round
+        #a round's detectors share a moment with the next round's resets, so
+        #the repeated part runs from one round's detectors to the next msmts
+        #(stim folds it into a REPEAT block when it runs at least twice)
+        grow_final += (rsc.sc_detectors() + stab_round) * (latter_rounds - 2)
         grow_final += rsc.sc_detectors()
 
-    #insert errors into above noisy circuits
-    rsc.qcircuit += insert_circuit_errs(grow_final, nm,
-        valid = component_array[5], convert_nac=neutralatom)
+    segments.append(grow_final, component=5)
 
-        
     #last perfect stab msmt round for decoding
-    rsc.qcircuit += rsc.sc_stab_round()
-    rsc.qcircuit += rsc.sc_detectors()
+    decoding_round = rsc.sc_stab_round()
+    decoding_round += rsc.sc_detectors()
 
     #add logical msmt
     if not handoff:
-        rsc.qcircuit += rsc.logYMeas()
-        print("Shortest graphlike error length:",len(rsc.qcircuit.shortest_graphlike_error()))
+        decoding_round += rsc.logYMeas()
     else:
         #add logical msmt (stim 1.15)
         z_targs = [2*i for i in range(0,rsc.dx)]
         x_targs = [2*rsc.dx*i for i in range(0,rsc.dy)]
-        rsc.qcircuit.append("OBSERVABLE_INCLUDE", arg=0, 
+        decoding_round.append("OBSERVABLE_INCLUDE", arg=0, 
                             targets=[stim.target_z(i) for i in z_targs])
-        rsc.qcircuit.append("OBSERVABLE_INCLUDE", arg=1, 
+        decoding_round.append("OBSERVABLE_INCLUDE", arg=1, 
                             targets=[stim.target_x(i) for i in x_targs])
+    segments.append(decoding_round)
+
+    return segments
+
+
+@functools.lru_cache(maxsize=64)
+def full_circuit_skeleton(dfinal: int,
+                          prep: str,
+                          latter_rounds: int = 3,
+                          ghz_size: int = 3,
+                          cultiv_only: bool = False,
+                          ps_on_d3: int = 0,
+                          handoff: bool = False,
+                          skeleton_dir: str | pathlib.Path | None = None
+                          ) -> SegmentedCircuit:
+    """The noiseless segments of full_circuit, which are the same for every noise strength and model.
+
+    Skeletons are kept in memory, and also as .stim files in skeleton_dir when
+    it is given, so that sweeps only redo the noise insertion for each point.
+    Saved files are named after a hash of the builder's source (and the stim
+    version), so a directory left over from an older builder is not reused.
+    The result is shared between callers and must not be modified.
+    """
+    if skeleton_dir is None:
+        return _build_skeleton(dfinal, prep, latter_rounds, ghz_size, cultiv_only, ps_on_d3, handoff)
+
+    skeleton_dir = pathlib.Path(skeleton_dir)
+    name = (f'skeleton-d{dfinal}-{prep}-r{latter_rounds}-g{ghz_size}-ps{ps_on_d3}'
+            f'{"-cultiv" if cultiv_only else ""}{"-handoff" if handoff else ""}'
+            f'-{_skeleton_builder_hash()}.stim')
+    path = skeleton_dir / name
+    if path.exists():
+        return SegmentedCircuit.from_text(path.read_text())
+
+    segments = _build_skeleton(dfinal, prep, latter_rounds, ghz_size, cultiv_only, ps_on_d3, handoff)
+    skeleton_dir.mkdir(parents=True, exist_ok=True)
+    tmp = skeleton_dir / f'.{name}.{os.getpid()}'
+    tmp.write_text(segments.to_text())
+    os.replace(tmp, path)
+    return segments
+
+
+def full_circuit(nm: float, 
+                 dfinal: int, 
+                 prep: str,
+                 latter_rounds: int = 3,
+                 ghz_size: int = 3,
+                 component_array: List = [1,1,1,1,1,1],
+                 cultiv_only: bool = False,
+                 ps_on_d3: int = 0,
+                 neutralatom: bool = False,
+                 handoff: bool= False,
+                 skeleton_dir: str | pathlib.Path | None = None,
+                 compact: bool = False,
+                 verify: bool = True,
+                 verify_cache_dir: str | pathlib.Path | None = None
+                 ) -> stim.Circuit:
+    """Cultivation followed by the escape to a dfinal code, with noise nm.
+
+    compact renumbers the qubits densely to shrink simulator state. Call
+    compact_qubits on the uncompacted circuit for the map back to the
+    layout's indices.
+
+    verify prints the shortest graphlike error length of non-handoff
+    circuits. It is only searched for once per distinct circuit in a process,
+    and with verify_cache_dir it is also stored there for other processes.
+    Sweeps can pass verify=False and check all their circuits with
+    verify_circuits afterwards, in parallel.
+    """
+    
+    if ps_on_d3 == 2:
+        print("WARNING: doing ps on Rot")
+
+    skeleton = full_circuit_skeleton(dfinal, prep, latter_rounds, ghz_size,
+                                     cultiv_only, ps_on_d3, handoff, skeleton_dir)
+
+    #insert errors into the noisy segments
+    circuit = skeleton.noisy_circuit(nm, component_array, convert_nac=neutralatom)
+
+    if verify and not (cultiv_only or handoff):
+        [certificate] = verify_circuits([circuit], cache_dir=verify_cache_dir)
+        print("Shortest graphlike error length:",certificate.graphlike)
+
+    if compact:
+        circuit, _ = compact_qubits(circuit)
+
+    return circuit
+    
+
+def cultivation_prefix(nm: float,
+                       dfinal: int,
+                       prep: str,
+                       ghz_size: int = 3,
+                       component_array: List = [1,1,1,1,1,1],
+                       ps_on_d3: int = 0,
+                       neutralatom: bool = False
+                       ) -> stim.Circuit:
+    "The start of full_circuit that does not depend on the escape stage"
+
+    rsc = FullCircuit(dx=dfinal,
+                    dy=dfinal ,
+                    glen=ghz_size, 
+                    basis="Y",
+                    smallsc=(ps_on_d3==2))
+    segments = SegmentedCircuit()
+    segments.append(rsc.qcircuit)
+    _add_cultivation_prefix(rsc, segments, prep)
+    return segments.noisy_circuit(nm, component_array, convert_nac=neutralatom)
+
+
+def sample_cultivation_frames(nm: float,
+                              prep: str,
+                              shots: int,
+                              directory: str | pathlib.Path,
+                              dfinal: int = 7,
+                              ghz_size: int = 3,
+                              component_array: List = [1,1,1,1,1,1],
+                              ps_on_d3: int = 0,
+                              neutralatom: bool = False,
+                              seed: int | None = None
+                              ) -> pathlib.Path:
+    """Samples the cultivation prefix once and saves the surviving frames.
 
-    return rsc.qcircuit
-    
\ No newline at end of file
+    Any full_circuit with the same nm, prep, ghz_size (and prefix components)
+    can then be sampled from the store by passing directory as frame_store_dir
+    to the gap samplers, whatever its dfinal and latter_rounds.
+    """
+    prefix = cultivation_prefix(nm, dfinal, prep, ghz_size=ghz_size,
+                                component_array=component_array,
+                                ps_on_d3=ps_on_d3, neutralatom=neutralatom)
+    store = FrameStore.sample(prefix, postselected_detectors(prefix), None, shots, seed=seed)
+    return store.save(directory)
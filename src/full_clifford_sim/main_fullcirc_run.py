@@ -1,3 +1,4 @@
+import os
 import stim
 import sinter
 import pymatching
@@ -12,35 +13,38 @@ from full_clifford_sim.full_circuit_fxns import *
 from full_clifford_sim.s3_fxns import *
 from full_clifford_sim.main_complied_fxns import *
 from full_clifford_sim.gap_sampler import *
+from full_clifford_sim.sweep_grid import SweepPoint, collect_grid, sweep_grid
 
 
 if __name__ == '__main__':
 
 
-    gs_tasks = [
-        sinter.Task(
-            circuit = full_circuit(p, 
-                                   dfinal=df, 
-                                   ghz_size = glen,
-                                   latter_rounds=l, prep=prep, ps_on_d3=1),
-            json_metadata={'p': p, 'b':'Y', 'noise':'uniform', 'd2':df, 
-                            'c':f'e2e-Y-{prep}-g{glen}-3ps1-stab{df}x{l}',
-                            'ghz_size':3, 'latter_rounds': l},
-        )
-        for p in [0.001]
-        for prep in ["hookinj"]
-        for glen in [3]
-        for l in [3]
-        for df in [13]
-    ]
-    
-    res = sinter.collect(tasks=gs_tasks, 
-                    num_workers=1, 
-                    decoders = ['pymatching-gap'],
-                    custom_decoders=sinter_samplers(),
-                     max_shots=80_000_000,  # Set a reasonable default
-                     max_errors=10_000_000 ,   # Set a reasonable default
-                     save_resume_filepath ="your_outfile_here.csv"
-                     )
-    print(res)
+    grid = sweep_grid(ps=[0.001],
+                      preps=["hookinj"],
+                      ghz_sizes=[3],
+                      latter_rounds=[3],
+                      dfinals=[13],
+                      ps_on_d3s=[1])
+
+    def metadata(point: SweepPoint) -> dict:
+        df, l, prep, glen = point.dfinal, point.latter_rounds, point.prep, point.ghz_size
+        return {'p': point.p, 'b':'Y', 'noise':'uniform', 'd2':df,
+                'c':f'e2e-Y-{prep}-g{glen}-3ps1-stab{df}x{l}',
+                'ghz_size':glen, 'latter_rounds': l}
 
+    #circuits are built on every core, and sampled in batches as they come
+    #out (points whose circuit repeats an earlier one are left out, with a
+    #warning)
+    res = collect_grid(grid,
+                       tasks_per_collect=4,
+                       json_metadata=metadata,
+                       build_workers=os.cpu_count(),
+                       verify=True,
+                       num_workers=1,
+                       decoders = ['pymatching-gap'],
+                       custom_decoders=sinter_samplers(),
+                       max_shots=80_000_000,  # Set a reasonable default
+                       max_errors=10_000_000 ,   # Set a reasonable default
+                       save_resume_filepath ="your_outfile_here.csv"
+                       )
+    print(res)
@@ -1,7 +1,11 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+import json
+from typing import List, Optional
 import stim
+from full_clifford_sim.circuit_text import CircuitText
 from full_clifford_sim._layer_translate import to_z_basis_interaction_circuit, to_optimized_circuit
 from full_clifford_sim._noise import GidneyNoiseModel
+from full_clifford_sim.qubit_map import used_qubits
 
 
 def set_unique(llst):
@@ -14,6 +18,30 @@ def set_unique(llst):
     return (set(flat))  # unique elements
 
 
+def _active_qubits(circuit: stim.Circuit) -> list:
+    "The targets of each instruction, looking inside REPEAT blocks"
+    active_qubits = []
+    for lin in circuit:
+        if isinstance(lin, stim.CircuitRepeatBlock):
+            active_qubits += _active_qubits(lin.body_copy())
+        else:
+            active_qubits.append([i.qubit_value for i in lin.targets_copy()])
+    return active_qubits
+
+
+def _unrolled(circuit: stim.Circuit) -> stim.Circuit:
+    "The circuit with its REPEAT blocks written out, but coordinates left as they are"
+    unrolled = stim.Circuit()
+    for lin in circuit:
+        if isinstance(lin, stim.CircuitRepeatBlock):
+            body = _unrolled(lin.body_copy())
+            for _ in range(lin.repeat_count):
+                unrolled += body
+        else:
+            unrolled.append(lin)
+    return unrolled
+
+
 def insert_circuit_errs(orig_circ : stim.Circuit, 
                         p: float,
                         valid: bool=1,
@@ -25,9 +53,7 @@ def insert_circuit_errs(orig_circ : stim.Circuit,
     if not valid:
         return orig_circ  
 
-    active_qubits = []
-    for lin in orig_circ:
-        active_qubits.append([i.qubit_value for i in lin.targets_copy()])
+    active_qubits = _active_qubits(orig_circ)
 
     if cirq:
         model = GidneyNoiseModel.cirq_uniform_depolarizing(p)
@@ -36,7 +62,8 @@ def insert_circuit_errs(orig_circ : stim.Circuit,
         return mc
 
     if convert_nac:
-        orig_circ = to_z_basis_interaction_circuit(orig_circ)
+        #the translation optimizes across moments, which a REPEAT boundary would block
+        orig_circ = to_z_basis_interaction_circuit(_unrolled(orig_circ))
         model = GidneyNoiseModel.neutralatom(p)
         mc = model.noisy_circuit(orig_circ, system_qubits=set_unique(active_qubits))
         return mc
@@ -46,3 +73,120 @@ def insert_circuit_errs(orig_circ : stim.Circuit,
         mc = model.noisy_circuit(orig_circ, system_qubits=set_unique(active_qubits))
         mc.append("TICK")
         return mc
+
+
+def _noise_model(p: float, convert_nac: bool, cirq: bool) -> GidneyNoiseModel:
+    if cirq:
+        return GidneyNoiseModel.cirq_uniform_depolarizing(p)
+    if convert_nac:
+        return GidneyNoiseModel.neutralatom(p)
+    return GidneyNoiseModel.uniform_depolarizing(p)
+
+
+# Starts each segment of a saved SegmentedCircuit, followed by the segment's tags as JSON.
+_SEGMENT_MARKER = '# segment '
+
+
+@dataclass
+class Segment:
+    "A noiseless piece of a circuit, tagged with the noise it gets"
+    circuit: stim.Circuit
+    component: Optional[int] = None  # index into component_array, None to never add noise
+    scale: float = 1  # the noise strength, as a multiple of nm
+    neutral_atom_scale: float = 1  # the same, for neutral atom noise
+    system_qubits: set = field(default_factory=set)
+
+
+class SegmentedCircuit:
+    """A noiseless circuit recorded as tagged segments, which can be made noisy in one pass.
+
+    Does what calling insert_circuit_errs on every segment and adding up the
+    results does, but each segment's qubits are found once, one noise model is
+    made per noise strength, and the whole circuit is written out as text and
+    parsed a single time. Nothing in it depends on the noise, so the same
+    segments can be made noisy at any strength.
+    """
+
+    def __init__(self):
+        self.segments: List[Segment] = []
+
+    def append(self,
+               circuit: stim.Circuit,
+               component: Optional[int] = None,
+               scale: float = 1,
+               neutral_atom_scale: Optional[float] = None) -> None:
+        """Records a segment.
+
+        Args:
+            circuit: The noiseless segment.
+            component: Which entry of component_array says whether to add noise
+                to the segment. None for segments that are always noiseless.
+            scale: The segment's noise strength is nm * scale.
+            neutral_atom_scale: The scale to use with neutral atom noise.
+                Defaults to scale.
+        """
+        self.segments.append(Segment(
+            circuit=circuit,
+            component=component,
+            scale=scale,
+            neutral_atom_scale=scale if neutral_atom_scale is None else neutral_atom_scale,
+            system_qubits=set() if component is None else used_qubits(circuit),
+        ))
+
+    def noisy_circuit(self,
+                      nm: float,
+                      component_array: List,
+                      convert_nac: bool = False,
+                      cirq: bool = False) -> stim.Circuit:
+        """The segments joined up, with the noise of each inserted.
+
+        Args:
+            nm: The noise strength.
+            component_array: Whether to add noise to the segments of each component.
+            convert_nac: Use neutral atom noise, on circuits translated to CZ gates.
+            cirq: Use uniform depolarizing noise without measurement errors.
+        """
+        models = {}
+        out = CircuitText()
+        for seg in self.segments:
+            if seg.component is None or not component_array[seg.component]:
+                out.append_text(str(seg.circuit))
+                continue
+            p = nm * (seg.neutral_atom_scale if convert_nac and not cirq else seg.scale)
+            if p not in models:
+                models[p] = _noise_model(p, convert_nac, cirq)
+            circuit = seg.circuit
+            if convert_nac and not cirq:
+                circuit = to_z_basis_interaction_circuit(_unrolled(circuit))
+            models[p].append_noisy_lines(circuit, out, system_qubits=seg.system_qubits)
+            if cirq or not convert_nac:
+                out.append('TICK')
+        return out.to_circuit()
+
+    def to_text(self) -> str:
+        """Writes the segments as a stim file, with the tags of each in a comment before it.
+
+        Read by from_text. Stim itself reads it as the noiseless circuit.
+        """
+        out = []
+        for seg in self.segments:
+            tags = {'component': seg.component, 'scale': seg.scale, 'neutral_atom_scale': seg.neutral_atom_scale}
+            out.append(_SEGMENT_MARKER + json.dumps(tags))
+            out.append(str(seg.circuit))
+        return '\n'.join(out) + '\n'
+
+    @staticmethod
+    def from_text(text: str) -> 'SegmentedCircuit':
+        "Reads segments written by to_text"
+        result = SegmentedCircuit()
+        tags = None
+        lines = []
+        for line in text.splitlines() + [_SEGMENT_MARKER + 'null']:
+            if not line.startswith(_SEGMENT_MARKER):
+                lines.append(line)
+                continue
+            if tags is not None:
+                result.append(stim.Circuit('\n'.join(lines)), **tags)
+            tags = json.loads(line[len(_SEGMENT_MARKER):])
+            lines = []
+        return result
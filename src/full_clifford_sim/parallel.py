@@ -0,0 +1,17 @@
+import concurrent.futures
+import contextlib
+import multiprocessing
+
+
+@contextlib.contextmanager
+def process_pool(num_workers: int):
+    """A pool of num_workers processes, or None to do the work in this process.
+
+    Daemonic processes can't start children, so inside one the work is also
+    done in process.
+    """
+    if num_workers <= 1 or multiprocessing.current_process().daemon:
+        yield None
+    else:
+        with concurrent.futures.ProcessPoolExecutor(num_workers) as executor:
+            yield executor
@@ -0,0 +1,207 @@
+import math
+import re
+from typing import Any, Callable, Iterable
+
+import numpy as np
+import sinter
+import stim
+
+
+# Noise whose flips all happen independently with the instruction's argument.
+_FLIP_GATES = {
+    'X_ERROR', 'Y_ERROR', 'Z_ERROR', 'E',
+    'M', 'MX', 'MY', 'MR', 'MRX', 'MRY', 'MPP', 'MXX', 'MYY', 'MZZ', 'MPAD',
+}
+
+# Stim splits depolarizing noise into independent Pauli components, each with
+# probability q such that 1 - 2q is a fixed power of 1 - (4/3 or 16/15) * p.
+# log(1 - 2q) of one component of each family of noise, given its argument.
+_LOG_FACTORS: dict[str, Callable[[float], float]] = {
+    'flip': lambda a: math.log1p(-2 * a),
+    'DEPOLARIZE1': lambda a: math.log1p(-4 * a / 3) / 2,
+    'DEPOLARIZE2': lambda a: math.log1p(-16 * a / 15) / 8,
+}
+
+# How much weaker the other noise classes are made while probing one of them.
+_PROBE_SCALE = 1e-9
+
+_INSTRUCTION = re.compile(r'^(\s*)([A-Z_0-9]+)(\[[^\]]*\])?\(([^)]*)\)(.*)$')
+_ERROR = re.compile(r'^(\s*)error\(([^)]*)\)(.*)$')
+
+
+def _noise_family(name: str) -> str | None:
+    "The _LOG_FACTORS family of an instruction, or None if it adds no noise"
+    name = stim.gate_data(name).name
+    if name in _FLIP_GATES:
+        return 'flip'
+    if name in _LOG_FACTORS:
+        return name
+    if stim.gate_data(name).is_noisy_gate:
+        raise ValueError(f"{name} noise can't be made parametric.")
+    return None
+
+
+def _noise_template(circuit: stim.Circuit) -> tuple[list[str], list[tuple[int, str, float]]]:
+    """Splits a circuit's text into lines and the noisy lines' (index, family, argument).
+
+    Noisy lines are left with a '{}' where their argument goes.
+    """
+    lines = str(circuit).splitlines()
+    noise = []
+    for k, line in enumerate(lines):
+        m = _INSTRUCTION.match(line)
+        if m is None:
+            continue
+        family = _noise_family(m[2])
+        if family is None:
+            continue
+        indent, name, tag, arg, rest = m.groups()
+        lines[k] = f'{indent}{name}{tag or ""}({{}}){rest}'
+        noise.append((k, family, float(arg)))
+    return lines, noise
+
+
+class ParametricDem:
+    """A detector error model whose error probabilities are functions of the noise strength p.
+
+    Every noise instruction of the circuit is put in a class by its family
+    (bit flips, DEPOLARIZE1 or DEPOLARIZE2) and its argument, which is taken
+    to be a fixed multiple of p. Because stim combines independent components
+    by xor, 1 - 2q for an error of the model is a product over classes of
+    1 - 2q_class(argument), each raised to the number of components of that
+    class leading to the error. These counts are found from one stim detector
+    error model per class, computed with the other classes made negligibly
+    weak (but present, so that every model has the same errors and
+    decompositions). After that, the model at any p is a small matrix product.
+    """
+
+    def __init__(self,
+                 circuit: stim.Circuit,
+                 p: float,
+                 *,
+                 decompose_errors: bool = True):
+        """
+        Args:
+            circuit: A noisy circuit, built with noise strength p.
+            p: The noise strength the circuit was built with.
+            decompose_errors: Passed on to stim.Circuit.detector_error_model.
+        """
+        self.p = p
+        self.decompose_errors = decompose_errors
+        self._circuit_lines, noise = _noise_template(circuit)
+        self._noise_lines = [k for k, _, _ in noise]
+        self._noise_args = np.array([arg for _, _, arg in noise])
+
+        # Noise classes are (family, argument / p). Arguments of 0 add no errors.
+        classes: dict[tuple[str, float], int] = {}
+        for _, family, arg in noise:
+            if arg:
+                classes.setdefault((family, arg), len(classes))
+        self._noise_classes = np.array([classes.get((family, arg), -1) for _, family, arg in noise], dtype=np.int64)
+        self.noise_classes = [(family, arg / p) for family, arg in classes]
+        self._class_args = [(family, arg) for family, arg in classes]
+
+        template = None
+        counts = []
+        for k, (family, arg) in enumerate(classes):
+            weak = self._noise_args * _PROBE_SCALE
+            probe = self._circuit_with_args(np.where(self._noise_classes == k, self._noise_args, weak))
+            lines = str(probe.detector_error_model(
+                decompose_errors=decompose_errors,
+                approximate_disjoint_errors=True,
+            )).splitlines()
+            probabilities = []
+            for j, line in enumerate(lines):
+                m = _ERROR.match(line)
+                if m is not None:
+                    probabilities.append(float(m[2]))
+                    lines[j] = (m[1], m[3])
+            if template is None:
+                template = lines
+            elif lines != template:
+                raise ValueError("Probing the noise classes gave differently shaped error models.")
+            n = np.log1p(-2 * np.array(probabilities)) / _LOG_FACTORS[family](arg)
+            if np.any(np.abs(n - np.rint(n)) > 1e-3):
+                raise ValueError(f"The errors from {family}({arg}) are not made of whole components.")
+            counts.append(np.rint(n))
+        if template is None:
+            template = str(circuit.detector_error_model()).splitlines()
+
+        # The model's text, with a format field for each error probability.
+        self._dem_template = '\n'.join(
+            line.replace('{', '{{').replace('}', '}}') if isinstance(line, str) else f'{line[0]}error({{!r}}){line[1]}'
+            for line in template
+        )
+        # counts[e, k] is how many components of noise class k lead to error e.
+        self.counts = np.array(counts, dtype=np.int64).T if counts else np.zeros((0, 0), dtype=np.int64)
+
+    def _circuit_with_args(self, args: np.ndarray) -> stim.Circuit:
+        lines = list(self._circuit_lines)
+        for k, a in zip(self._noise_lines, args.tolist()):
+            lines[k] = lines[k].format(a)
+        return stim.Circuit('\n'.join(lines))
+
+    def circuit(self, p: float) -> stim.Circuit:
+        "The circuit built with noise strength p"
+        return self._circuit_with_args(self._noise_args * (p / self.p))
+
+    def probabilities(self, p: float) -> np.ndarray:
+        "The probability of each error of the model at noise strength p, in order"
+        log_factors = np.array([
+            _LOG_FACTORS[family](arg * (p / self.p))
+            for family, arg in self._class_args
+        ])
+        return -np.expm1(self.counts @ log_factors) / 2
+
+    def at(self, p: float) -> stim.DetectorErrorModel:
+        "The detector error model of the circuit built with noise strength p"
+        return stim.DetectorErrorModel(self._dem_template.format(*self.probabilities(p).tolist()))
+
+
+def sweep_tasks(circuit: stim.Circuit,
+                p: float,
+                ps: Iterable[float],
+                *,
+                json_metadata: Callable[[float], Any] | None = None,
+                decompose_errors: bool | None = None) -> list[sinter.Task]:
+    """Makes sinter tasks for a circuit at several noise strengths, deriving the DEM once.
+
+    The circuits and detector error models of every noise strength are
+    instantiated from one ParametricDem, so stim only analyzes the circuit
+    once per noise class instead of once per noise strength. Each task still
+    carries its own DEM, which the samplers compress and match separately.
+    iter_grid_tasks(parametric=True) uses this for the p sweeps of a grid.
+
+    Args:
+        circuit: A noisy circuit, built with noise strength p.
+        p: The noise strength the circuit was built with.
+        ps: The noise strengths to make tasks for.
+        json_metadata: Makes each task's metadata from its noise strength.
+        decompose_errors: Whether the DEMs have decomposed errors. None
+            decomposes them if stim can, and otherwise doesn't, which is what
+            sinter does when it makes a task's DEM itself.
+
+    Returns:
+        One task per noise strength, in order.
+
+    Raises:
+        ValueError: The circuit has noise other than bit flips, measurement
+            flips, DEPOLARIZE1 and DEPOLARIZE2 (e.g. PAULI_CHANNEL_1), which
+            can't be scaled with p this way, or decompose_errors is True and
+            stim can't decompose its errors.
+    """
+    if decompose_errors is None:
+        try:
+            parametric = ParametricDem(circuit, p, decompose_errors=True)
+        except ValueError:
+            parametric = ParametricDem(circuit, p, decompose_errors=False)
+    else:
+        parametric = ParametricDem(circuit, p, decompose_errors=decompose_errors)
+    return [
+        sinter.Task(
+            circuit=parametric.circuit(q),
+            detector_error_model=parametric.at(q),
+            json_metadata=None if json_metadata is None else json_metadata(q),
+        )
+        for q in ps
+    ]
@@ -0,0 +1,54 @@
+import re
+
+import numpy as np
+import pytest
+import stim
+
+from full_clifford_sim.main_complied_fxns import full_circuit
+from full_clifford_sim.parametric_dem import ParametricDem, sweep_tasks
+
+_ERROR = re.compile(r'^error\(([^)]*)\)(.*)$')
+
+
+def _split(dem: stim.DetectorErrorModel) -> tuple[list[str], np.ndarray]:
+    "The DEM's lines with error probabilities blanked out, and the probabilities"
+    lines = []
+    probabilities = []
+    for line in str(dem).splitlines():
+        m = _ERROR.match(line)
+        if m is not None:
+            probabilities.append(float(m[1]))
+            line = f'error(){m[2]}'
+        lines.append(line)
+    return lines, np.array(probabilities)
+
+
+def test_at_matches_stim_line_by_line():
+    parametric = ParametricDem(full_circuit(0.001, 5, 'hookinj', verify=False), 0.001, decompose_errors=False)
+    for q in [0.0005, 0.001, 0.003]:
+        circuit = full_circuit(q, 5, 'hookinj', verify=False)
+        assert parametric.circuit(q).approx_equals(circuit, atol=1e-15)
+        lines, probabilities = _split(circuit.detector_error_model(approximate_disjoint_errors=True))
+        actual_lines, actual_probabilities = _split(parametric.at(q))
+        assert actual_lines == lines
+        np.testing.assert_allclose(actual_probabilities, probabilities, rtol=1e-9)
+
+
+def test_unsupported_noise_is_refused():
+    circuit = stim.Circuit('''
+        PAULI_CHANNEL_1(0.001, 0.002, 0.003) 0
+        M 0
+        DETECTOR rec[-1]
+    ''')
+    with pytest.raises(ValueError):
+        ParametricDem(circuit, 0.001)
+
+
+def test_sweep_tasks_decomposes_like_sinter():
+    circuit = full_circuit(0.001, 5, 'hookinj', verify=False)
+    # stim can't decompose this circuit's errors, so sinter wouldn't either.
+    with pytest.raises(ValueError):
+        sweep_tasks(circuit, 0.001, [0.002], decompose_errors=True)
+    [task] = sweep_tasks(circuit, 0.001, [0.002])
+    expected = full_circuit(0.002, 5, 'hookinj', verify=False).detector_error_model(approximate_disjoint_errors=True)
+    assert task.detector_error_model.approx_equals(expected, atol=1e-12)
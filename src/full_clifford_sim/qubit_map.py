@@ -0,0 +1,66 @@
+import numpy as np
+import stim
+
+
+def _has_qubit(t: stim.GateTarget) -> bool:
+    return t.is_qubit_target or t.is_x_target or t.is_y_target or t.is_z_target
+
+
+def used_qubits(circuit: stim.Circuit, used: set | None = None) -> set:
+    "The qubits targeted by a circuit, including inside REPEAT blocks, added to used"
+    if used is None:
+        used = set()
+    for inst in circuit:
+        if isinstance(inst, stim.CircuitRepeatBlock):
+            used_qubits(inst.body_copy(), used)
+        else:
+            used.update(t.value for t in inst.targets_copy() if _has_qubit(t))
+    return used
+
+
+def relabeled_target(t: stim.GateTarget, relabel) -> stim.GateTarget:
+    "The target with its qubit, if it has one, replaced by relabel[qubit]"
+    if t.is_qubit_target:
+        q = relabel[t.value]
+        return stim.target_inv(q) if t.is_inverted_result_target else stim.GateTarget(q)
+    if t.is_x_target:
+        return stim.target_x(relabel[t.value], t.is_inverted_result_target)
+    if t.is_y_target:
+        return stim.target_y(relabel[t.value], t.is_inverted_result_target)
+    if t.is_z_target:
+        return stim.target_z(relabel[t.value], t.is_inverted_result_target)
+    return t
+
+
+def _relabeled(circuit: stim.Circuit, relabel: list[int]) -> stim.Circuit:
+    result = stim.Circuit()
+    for inst in circuit:
+        if isinstance(inst, stim.CircuitRepeatBlock):
+            result.append(stim.CircuitRepeatBlock(inst.repeat_count, _relabeled(inst.body_copy(), relabel)))
+        else:
+            result.append(stim.CircuitInstruction(
+                inst.name,
+                [relabeled_target(t, relabel) for t in inst.targets_copy()],
+                inst.gate_args_copy(),
+                tag=inst.tag,
+            ))
+    return result
+
+
+def compact_qubits(circuit: stim.Circuit) -> tuple[stim.Circuit, np.ndarray]:
+    """Renumbers a circuit's qubits densely, keeping their order.
+
+    Stim simulators size their state by num_qubits, so the indices the code
+    layouts leave unused (invalid ancilla sites, the gap before the GHZ
+    qubits) cost memory and time on every shot. QUBIT_COORDS, detector
+    coordinates, measurement records and REPEAT blocks are kept as they are.
+
+    Returns:
+        A (compact, qubits) tuple. qubits[k] is the original index of qubit
+        k of compact.
+    """
+    qubits = np.array(sorted(used_qubits(circuit)), dtype=np.int64)
+    relabel = [-1] * circuit.num_qubits
+    for k, q in enumerate(qubits.tolist()):
+        relabel[q] = k
+    return _relabeled(circuit, relabel), qubits
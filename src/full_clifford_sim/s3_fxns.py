@@ -1,5 +1,6 @@
 from dataclasses import dataclass
 import stim
+from full_clifford_sim.circuit_text import CircuitText
 from full_clifford_sim.coords import *
 import json
 from itertools import chain
@@ -466,8 +467,10 @@ class CultStage:
                 smcirc.append("M", [firstanc - 2 + 2*self.dx, firstanc+2 + 2*self.dx, firstanc+6+ 2*self.dx])
         smcirc.append("TICK")
 
+        detectors = CircuitText()
         for k in range(12):
-            smcirc.append("DETECTOR", stim.target_rec(-1-k))
+            detectors.append('DETECTOR', f'rec[{-1-k}]')
+        smcirc += detectors.to_circuit()
 
         return smcirc
     
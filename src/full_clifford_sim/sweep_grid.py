@@ -0,0 +1,227 @@
+import collections
+import concurrent.futures
+import contextlib
+import dataclasses
+import io
+import itertools
+import pathlib
+from typing import Any, Callable, Iterable, Iterator
+
+import sinter
+import stim
+
+from full_clifford_sim.parallel import process_pool
+from full_clifford_sim.main_complied_fxns import full_circuit
+from full_clifford_sim.parametric_dem import sweep_tasks
+from full_clifford_sim.verification import circuit_hash
+
+
+@dataclasses.dataclass(frozen=True)
+class SweepPoint:
+    "The full_circuit arguments of one point of a sweep grid"
+    p: float
+    prep: str
+    dfinal: int
+    ghz_size: int = 3
+    latter_rounds: int = 3
+    ps_on_d3: int = 0
+    neutralatom: bool = False
+    component_array: tuple = (1, 1, 1, 1, 1, 1)
+
+    def json_metadata(self) -> dict[str, Any]:
+        "The point's arguments, as sinter task metadata"
+        metadata = dataclasses.asdict(self)
+        metadata['component_array'] = list(self.component_array)
+        return metadata
+
+
+def sweep_grid(*,
+               ps: Iterable[float],
+               preps: Iterable[str],
+               dfinals: Iterable[int],
+               ghz_sizes: Iterable[int] = (3,),
+               latter_rounds: Iterable[int] = (3,),
+               ps_on_d3s: Iterable[int] = (0,),
+               neutralatoms: Iterable[bool] = (False,),
+               component_arrays: Iterable[Iterable[int]] = ((1, 1, 1, 1, 1, 1),)) -> list[SweepPoint]:
+    """Every combination of the given arguments, without repeats.
+
+    p varies fastest, so points sharing a noiseless skeleton are next to each
+    other.
+    """
+    points = {}
+    for prep, ghz_size, rounds, dfinal, ps_on_d3, neutralatom, components, p in itertools.product(
+            preps, ghz_sizes, latter_rounds, dfinals, ps_on_d3s, neutralatoms,
+            [tuple(c) for c in component_arrays], ps):
+        point = SweepPoint(p=p, prep=prep, dfinal=dfinal, ghz_size=ghz_size,
+                           latter_rounds=rounds, ps_on_d3=ps_on_d3,
+                           neutralatom=neutralatom, component_array=components)
+        points[point] = None
+    return list(points)
+
+
+def _build_point(point: SweepPoint,
+                 skeleton_dir: str | pathlib.Path | None,
+                 verify: bool) -> tuple[str, str, str]:
+    "Builds a point's circuit, returning its text, hash and what full_circuit printed"
+    printed = io.StringIO()
+    with contextlib.redirect_stdout(printed):
+        circuit = full_circuit(point.p,
+                               dfinal=point.dfinal,
+                               prep=point.prep,
+                               latter_rounds=point.latter_rounds,
+                               ghz_size=point.ghz_size,
+                               component_array=list(point.component_array),
+                               ps_on_d3=point.ps_on_d3,
+                               neutralatom=point.neutralatom,
+                               skeleton_dir=skeleton_dir,
+                               verify=verify)
+    text = str(circuit)
+    return text, circuit_hash(circuit), printed.getvalue()
+
+
+def _build_points(points: list[SweepPoint],
+                  skeleton_dir: str | pathlib.Path | None,
+                  verify: bool) -> list[tuple[SweepPoint, str, str | None, str, str]]:
+    """Builds points differing only in p, returning (point, circuit text, DEM text, hash, printed) for each.
+
+    A single point is built by full_circuit, with no DEM text. Several are
+    instantiated from a ParametricDem of the circuit at the largest p, which
+    is the only one verified. If its noise can't be made parametric, the
+    points are built one by one instead.
+    """
+    base = max(points, key=lambda point: point.p)
+    text, key, printed = _build_point(base, skeleton_dir, verify)
+    if len(points) == 1:
+        return [(base, text, None, key, printed)]
+    try:
+        tasks = sweep_tasks(stim.Circuit(text), base.p, [point.p for point in points])
+    except ValueError as ex:
+        printed += f"WARNING: building the p sweep of {base} point by point, its noise isn't parametric: {ex}\n"
+        built = {base: (text, key, printed)}
+        for point in points:
+            if point != base:
+                built[point] = _build_point(point, skeleton_dir, False)
+        return [(point, text, None, key, printed) for point, (text, key, printed) in built.items()]
+    return [
+        (point, str(task.circuit), str(task.detector_error_model), circuit_hash(task.circuit),
+         printed if point == base else '')
+        for point, task in zip(points, tasks)
+    ]
+
+
+def iter_grid_tasks(points: Iterable[SweepPoint],
+                    *,
+                    json_metadata: Callable[[SweepPoint], Any] | None = None,
+                    num_workers: int = 1,
+                    skeleton_dir: str | pathlib.Path | None = None,
+                    verify: bool = False,
+                    parametric: bool = False,
+                    report: dict[SweepPoint, SweepPoint] | None = None) -> Iterator[sinter.Task]:
+    """Builds the circuits of a sweep grid in a process pool, yielding tasks as they are ready.
+
+    Tasks come out in the order their circuits finish, not the order of
+    points. sinter.collect lists all of its tasks before it starts, so pass
+    the grid to collect_grid to sample while the rest is still building. A point whose circuit is identical to one already yielded (e.g.
+    one whose noisy components are all switched off) is skipped, since
+    sampling it again would only repeat that task's statistics. A warning
+    names the point whose task holds its results, and if report is given,
+    report[skipped point] is set to that point.
+
+    Args:
+        points: The grid, e.g. from sweep_grid.
+        json_metadata: Makes each task's metadata from its point. Defaults to
+            SweepPoint.json_metadata.
+        num_workers: Number of processes to build circuits with.
+        skeleton_dir: Shares noiseless skeletons between the workers, see
+            full_circuit_skeleton.
+        verify: Check each circuit's shortest graphlike error in its worker,
+            printing the length as full_circuit does.
+        parametric: Build each p sweep (the nonzero ps of points that differ
+            only in p) from one circuit with sweep_tasks, so its DEM is only
+            derived once. The tasks then carry their DEMs, and their circuits
+            are the largest p's with the noise arguments rescaled, which can
+            differ from full_circuit's in the last digits. Only the largest
+            p's circuit is verified.
+        report: Filled in with the skipped points.
+    """
+    if json_metadata is None:
+        json_metadata = SweepPoint.json_metadata
+    points = list(dict.fromkeys(points))
+    if parametric:
+        sweeps = collections.defaultdict(list)
+        for point in points:
+            sweeps[dataclasses.replace(point, p=0) if point.p else point].append(point)
+        groups = list(sweeps.values())
+    else:
+        groups = [[point] for point in points]
+    yielded = {}
+    with process_pool(min(num_workers, len(groups))) as executor:
+        if executor is None:
+            futures = {}
+            ready = (_build_points(group, skeleton_dir, verify) for group in groups)
+        else:
+            futures = {executor.submit(_build_points, group, skeleton_dir, verify) for group in groups}
+            ready = (f.result() for f in concurrent.futures.as_completed(futures))
+        try:
+            for point, text, dem_text, key, printed in itertools.chain.from_iterable(ready):
+                print(printed, end='')
+                if key in yielded:
+                    print(f"WARNING: skipping {point}, its circuit is the same as {yielded[key]}'s")
+                    if report is not None:
+                        report[point] = yielded[key]
+                    continue
+                yielded[key] = point
+                yield sinter.Task(
+                    circuit=stim.Circuit(text),
+                    detector_error_model=None if dem_text is None else stim.DetectorErrorModel(dem_text),
+                    json_metadata=json_metadata(point),
+                )
+        finally:
+            #don't wait for the rest of the grid if the caller stops early
+            for future in futures:
+                future.cancel()
+
+
+def collect_grid(points: Iterable[SweepPoint],
+                 *,
+                 tasks_per_collect: int,
+                 json_metadata: Callable[[SweepPoint], Any] | None = None,
+                 build_workers: int = 1,
+                 skeleton_dir: str | pathlib.Path | None = None,
+                 verify: bool = False,
+                 parametric: bool = False,
+                 report: dict[SweepPoint, SweepPoint] | None = None,
+                 **collect_kwargs) -> list[sinter.TaskStats]:
+    """Samples a sweep grid with sinter, starting before all its circuits are built.
+
+    The tasks of iter_grid_tasks are handed to sinter.collect in batches of
+    tasks_per_collect, as they come out of the pool, which keeps building the
+    rest of the grid meanwhile. Each batch is a separate collect call, so
+    sinter's workers restart between batches. Pass save_resume_filepath to
+    write every batch's results to the same file.
+
+    Args:
+        points: The grid, e.g. from sweep_grid.
+        tasks_per_collect: Number of tasks per collect call.
+        json_metadata, skeleton_dir, verify, parametric, report: See
+            iter_grid_tasks.
+        build_workers: Number of processes to build circuits with.
+        **collect_kwargs: Passed on to each sinter.collect call.
+
+    Returns:
+        The stats of every task, batch by batch.
+    """
+    tasks = iter_grid_tasks(points,
+                            json_metadata=json_metadata,
+                            num_workers=build_workers,
+                            skeleton_dir=skeleton_dir,
+                            verify=verify,
+                            parametric=parametric,
+                            report=report)
+    results = {}
+    while batch := list(itertools.islice(tasks, tasks_per_collect)):
+        #with a resume file, collect also returns the earlier batches' stats
+        for stats in sinter.collect(tasks=batch, **collect_kwargs):
+            results[stats.strong_id] = stats
+    return list(results.values())
@@ -0,0 +1,57 @@
+import sinter
+
+from full_clifford_sim.main_complied_fxns import full_circuit
+from full_clifford_sim.sweep_grid import SweepPoint, collect_grid, iter_grid_tasks, sweep_grid
+
+
+def test_sweep_grid():
+    grid = sweep_grid(ps=[0.001, 0.002, 0.001], preps=['hookinj'], dfinals=[5, 7])
+    assert grid == [SweepPoint(p=p, prep='hookinj', dfinal=d) for d in [5, 7] for p in [0.001, 0.002]]
+
+
+def test_tasks_match_full_circuit_and_report_merged_points():
+    grid = sweep_grid(ps=[0.001, 0.002], preps=['hookinj', 'unitstab'], dfinals=[5],
+                      component_arrays=[[1] * 6, [0] * 6])
+    report = {}
+    tasks = list(iter_grid_tasks(grid, num_workers=2, report=report))
+
+    # With all components off, the noise strength makes no difference.
+    assert len(tasks) == 6
+    assert len(report) == 2
+    for skipped, kept in report.items():
+        assert skipped.component_array == kept.component_array == (0,) * 6
+        assert skipped.prep == kept.prep
+        assert {skipped.p, kept.p} == {0.001, 0.002}
+    points = {SweepPoint(**{**t.json_metadata, 'component_array': tuple(t.json_metadata['component_array'])})
+              for t in tasks}
+    assert points | set(report) == set(grid)
+    for task in tasks:
+        m = task.json_metadata
+        assert task.circuit == full_circuit(m['p'], m['dfinal'], m['prep'],
+                                            component_array=m['component_array'], verify=False)
+
+
+def test_parametric_sweeps_match_full_circuit():
+    grid = sweep_grid(ps=[0.001, 0.002, 0.003], preps=['hookinj'], dfinals=[5],
+                      component_arrays=[[1] * 6, [0] * 6])
+    report = {}
+    tasks = list(iter_grid_tasks(grid, num_workers=2, parametric=True, report=report))
+    assert len(tasks) == 4
+    assert len(report) == 2
+    for task in tasks:
+        m = task.json_metadata
+        circuit = full_circuit(m['p'], m['dfinal'], m['prep'], component_array=m['component_array'], verify=False)
+        assert task.circuit.approx_equals(circuit, atol=1e-15)
+        if any(m['component_array']):
+            expected = circuit.detector_error_model(approximate_disjoint_errors=True)
+            assert task.detector_error_model.approx_equals(expected, atol=1e-12)
+
+
+def test_collect_grid_in_batches(tmp_path):
+    grid = sweep_grid(ps=[0.001, 0.002, 0.003], preps=['hookinj'], dfinals=[5])
+    path = tmp_path / 'stats.csv'
+    stats = collect_grid(grid, tasks_per_collect=2, build_workers=2, num_workers=1,
+                         decoders=['pymatching'], max_shots=100, save_resume_filepath=path)
+    assert sorted(s.json_metadata['p'] for s in stats) == [0.001, 0.002, 0.003]
+    assert all(s.shots == 100 for s in stats)
+    assert len(sinter.read_stats_from_csv_files(path)) == 3
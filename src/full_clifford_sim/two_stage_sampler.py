@@ -0,0 +1,185 @@
+import numpy as np
+import stim
+
+
+def split_after_last_detector(circuit: stim.Circuit,
+                              detector_mask: np.ndarray) -> tuple[stim.Circuit, stim.Circuit]:
+    """Splits a circuit into a prefix holding every masked detector, and the rest.
+
+    The cut is placed right after the top level instruction (or REPEAT block)
+    that declares the last detector selected by detector_mask, so that
+    prefix + suffix == circuit.
+
+    Args:
+        circuit: The circuit to split.
+        detector_mask: A boolean array over the circuit's detectors.
+
+    Returns:
+        A (prefix, suffix) tuple of circuits.
+    """
+    selected = np.flatnonzero(detector_mask)
+    if not len(selected):
+        return stim.Circuit(), circuit.copy()
+    last = selected[-1]
+
+    num_dets = 0
+    for k, inst in enumerate(circuit):
+        if isinstance(inst, stim.CircuitRepeatBlock):
+            num_dets += inst.body_copy().num_detectors * inst.repeat_count
+        elif inst.name == 'DETECTOR':
+            num_dets += 1
+        if num_dets > last:
+            return circuit[:k + 1], circuit[k + 1:]
+    raise ValueError(f"{circuit.num_detectors=} <= {last=}")
+
+
+def _measurement_lookback(circuit: stim.Circuit) -> int:
+    "How many measurements from before the circuit its record targets reach back into"
+    depth = 0
+    num_measurements = 0
+    for inst in circuit.flattened():
+        for t in inst.targets_copy():
+            if t.is_measurement_record_target:
+                depth = max(depth, -t.value - num_measurements)
+        num_measurements += inst.num_measurements
+    return depth
+
+
+class TwoStageDetectorSampler:
+    """Samples detection events, only simulating a circuit's tail for kept shots.
+
+    The circuit is split after its last postselected detector. Every shot runs
+    through the prefix in a stim.FlipSimulator. Shots that fire a postselected
+    detector are rejected, and the Pauli frames of the survivors are carried
+    into a second simulator that runs the suffix. Measurements of the prefix that
+    the suffix refers back to are replayed on scratch qubits first.
+
+    Because it is the same frame simulation split in two, the detection events
+    and observable flips of the kept shots have the same distribution as
+    sampling the whole circuit and then postselecting.
+    """
+
+    def __init__(self,
+                 circuit: stim.Circuit,
+                 postselected: np.ndarray,
+                 *,
+                 max_batch_size: int = 1 << 14,
+                 seed: int | None = None):
+        """
+        Args:
+            circuit: The noisy circuit to sample.
+            postselected: A boolean array over the circuit's detectors, marking
+                the ones that discard a shot when they fire.
+            max_batch_size: The most shots simulated at once.
+            seed: Seeds the simulators' random number generators.
+        """
+        self.num_qubits = circuit.num_qubits
+        self.num_detectors = circuit.num_detectors
+        self.num_observables = circuit.num_observables
+        self.prefix, suffix = split_after_last_detector(circuit, postselected)
+        self.num_prefix_detectors = self.prefix.num_detectors
+        self.postselected = np.asarray(postselected[:self.num_prefix_detectors], dtype=np.bool_)
+        self.max_batch_size = max_batch_size
+        self._rng = np.random.default_rng(seed)
+
+        # Replay the prefix measurements the suffix looks back at, one per scratch qubit.
+        self.lookback = _measurement_lookback(suffix)
+        if self.lookback > self.prefix.num_measurements:
+            raise ValueError("The circuit refers to measurements before its first measurement.")
+        self.scratch_qubits = self.num_qubits + np.arange(self.lookback)
+        self.suffix = stim.Circuit()
+        if self.lookback:
+            self.suffix.append('M', self.scratch_qubits)
+        self.suffix += suffix
+
+    def _sim(self, batch_size: int, *, randomize: bool) -> stim.FlipSimulator:
+        return stim.FlipSimulator(
+            batch_size=batch_size,
+            num_qubits=self.num_qubits + self.lookback,
+            disable_stabilizer_randomization=not randomize,
+            seed=int(self._rng.integers(1 << 62)),
+        )
+
+    def sample_survivors(self, shots: int, *, row_bytes: int | None = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Samples shots and returns the data of those that survive postselection.
+
+        Args:
+            shots: The number of shots to sample.
+            row_bytes: Width of the returned detector rows. Defaults to just
+                enough bytes for the circuit's detectors. Extra bytes are zero.
+
+        Returns:
+            A (kept, dets, obs) tuple. kept holds the indices (among the sampled
+            shots) of the surviving shots. dets and obs are their bit packed
+            detection events and observable flips.
+        """
+        if row_bytes is None:
+            row_bytes = (self.num_detectors + 7) // 8
+        kept_parts = []
+        det_parts = []
+        obs_parts = []
+        for start in range(0, shots, self.max_batch_size):
+            batch = min(self.max_batch_size, shots - start)
+            kept, dets, obs = self._sample_survivors_batch(batch, row_bytes)
+            kept_parts.append(kept + start)
+            det_parts.append(dets)
+            obs_parts.append(obs)
+        if not kept_parts:
+            return (np.zeros(0, dtype=np.int64),
+                    np.zeros((0, row_bytes), dtype=np.uint8),
+                    np.zeros((0, (self.num_observables + 7) // 8), dtype=np.uint8))
+        return np.concatenate(kept_parts), np.concatenate(det_parts), np.concatenate(obs_parts)
+
+    def _sample_survivors_batch(self, batch: int, row_bytes: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        sim = self._sim(batch, randomize=True)
+        sim.do(self.prefix)
+        # Bit packed outputs are (bits, ceil(batch / 8)) and avoid stim's slow bool conversion.
+        xs, zs, ms, ds, os = sim.to_numpy(
+            bit_packed=True,
+            output_xs=True,
+            output_zs=True,
+            output_measure_flips=self.lookback > 0,
+            output_detector_flips=True,
+            output_observable_flips=True,
+        )
+        rejected = np.bitwise_or.reduce(ds[self.postselected], axis=0)
+        keep = np.unpackbits(rejected, bitorder='little', count=batch) == 0
+        kept = np.flatnonzero(keep)
+        if not len(kept):
+            return (kept,
+                    np.zeros((0, row_bytes), dtype=np.uint8),
+                    np.zeros((0, (self.num_observables + 7) // 8), dtype=np.uint8))
+
+        def kept_columns(packed: np.ndarray) -> np.ndarray:
+            bits = np.unpackbits(packed, axis=1, bitorder='little', count=batch)
+            return np.compress(keep, bits, axis=1).view(np.bool_)
+
+        # The carried frames already hold the prefix's gauge, so the suffix
+        # simulator must not randomize them a second time.
+        sim = self._sim(len(kept), randomize=False)
+        x_mask = np.zeros(shape=(self.num_qubits + self.lookback, len(kept)), dtype=np.bool_)
+        x_mask[:self.num_qubits] = kept_columns(xs)
+        if self.lookback:
+            x_mask[self.scratch_qubits] = kept_columns(ms[-self.lookback:])
+        sim.broadcast_pauli_errors(pauli='X', mask=x_mask)
+        z_mask = np.zeros_like(x_mask)
+        z_mask[:self.num_qubits] = kept_columns(zs)
+        sim.broadcast_pauli_errors(pauli='Z', mask=z_mask)
+        sim.do(self.suffix)
+        _, _, _, ds2, os2 = sim.to_numpy(
+            bit_packed=True,
+            output_detector_flips=True,
+            output_observable_flips=True,
+        )
+
+        dets = np.zeros(shape=(self.num_detectors, len(kept)), dtype=np.bool_)
+        dets[:self.num_prefix_detectors] = kept_columns(ds)
+        dets[self.num_prefix_detectors:] = np.unpackbits(
+            ds2, axis=1, bitorder='little', count=len(kept)).view(np.bool_)
+        obs = np.zeros(shape=(self.num_observables, len(kept)), dtype=np.bool_)
+        obs[:os.shape[0]] ^= kept_columns(os)
+        obs[:os2.shape[0]] ^= np.unpackbits(
+            os2, axis=1, bitorder='little', count=len(kept)).view(np.bool_)
+        packed_dets = np.zeros(shape=(len(kept), row_bytes), dtype=np.uint8)
+        packed_dets[:, :(self.num_detectors + 7) // 8] = np.packbits(dets.T, axis=1, bitorder='little')
+        return kept, packed_dets, np.packbits(obs.T, axis=1, bitorder='little')
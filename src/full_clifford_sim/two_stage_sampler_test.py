@@ -0,0 +1,54 @@
+import numpy as np
+import stim
+
+from full_clifford_sim.gap_sampler import postselected_detectors
+from full_clifford_sim.main_complied_fxns import full_circuit
+from full_clifford_sim.two_stage_sampler import TwoStageDetectorSampler, split_after_last_detector
+
+
+def plain_survivors(circuit: stim.Circuit,
+                    postselected: np.ndarray,
+                    shots: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    "Samples the whole circuit and postselects, returning (keep, dets, obs) as bools"
+    dets, obs = circuit.compile_detector_sampler(seed=5).sample(shots, separate_observables=True)
+    keep = ~np.any(dets[:, postselected], axis=1)
+    return keep, dets[keep], obs[keep]
+
+
+def unpacked(packed: np.ndarray, count: int) -> np.ndarray:
+    return np.unpackbits(packed, axis=1, bitorder='little', count=count).astype(np.bool_)
+
+
+def assert_same_rate(a: np.ndarray, b: np.ndarray, *, sigmas: float = 5):
+    "Asserts two arrays of 0/1 outcomes have the same mean, within sigmas standard errors"
+    p = (a.sum() + b.sum()) / (len(a) + len(b))
+    err = np.sqrt(max(p * (1 - p), 1e-12) * (1 / len(a) + 1 / len(b)))
+    assert abs(a.mean() - b.mean()) <= sigmas * err, (a.mean(), b.mean(), err)
+
+
+def test_split_after_last_detector():
+    circuit = full_circuit(0.001, 5, 'hookinj', verify=False)
+    postselected = postselected_detectors(circuit)
+    prefix, suffix = split_after_last_detector(circuit, postselected)
+    assert prefix + suffix == circuit
+    assert prefix.num_detectors == np.flatnonzero(postselected)[-1] + 1
+
+
+def test_matches_plain_sampling():
+    circuit = full_circuit(0.002, 5, 'hookinj', verify=False)
+    postselected = postselected_detectors(circuit)
+    shots = 40_000
+    kept, dets, obs = TwoStageDetectorSampler(circuit, postselected, seed=3).sample_survivors(shots)
+    dets = unpacked(dets, circuit.num_detectors)
+    obs = unpacked(obs, circuit.num_observables)
+    plain_keep, plain_dets, plain_obs = plain_survivors(circuit, postselected, shots)
+
+    keep = np.zeros(shots, dtype=np.bool_)
+    keep[kept] = True
+    assert_same_rate(keep, plain_keep)
+    assert not np.any(dets[:, postselected])
+    # The tail, which only the second stage simulates, fires at the same rates.
+    tail = np.flatnonzero(~postselected)[-20:]
+    for d in tail:
+        assert_same_rate(dets[:, d], plain_dets[:, d])
+    assert_same_rate(obs[:, 0], plain_obs[:, 0])
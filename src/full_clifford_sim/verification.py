@@ -0,0 +1,145 @@
+import collections
+import dataclasses
+import hashlib
+import pathlib
+from typing import Iterable
+
+import stim
+
+from full_clifford_sim.artifact_cache import ArtifactCache
+from full_clifford_sim.parallel import process_pool
+
+# Bumped whenever what is stored for a circuit changes.
+FORMAT_VERSION = 1
+
+
+@dataclasses.dataclass(frozen=True)
+class HypergraphSearch:
+    "Truncation options of stim.Circuit.search_for_undetectable_logical_errors"
+    max_detection_events: int = 4
+    max_edge_degree: int = 4
+    explore_increasing_symptom_degree: bool = False
+
+
+@dataclasses.dataclass(frozen=True)
+class FaultDistance:
+    """Fault distance certificates of a circuit.
+
+    graphlike is the length of stim's shortest graphlike logical error.
+    hypergraph is the length of the shortest undetectable logical error found
+    by the truncated hypergraph search, or None if no search was asked for.
+    The search is a heuristic, so hypergraph is only an upper bound on the
+    fault distance, but it can be below graphlike.
+    """
+    graphlike: int
+    hypergraph: int | None = None
+
+
+# Certificates already known to this process, by (circuit hash, hypergraph
+# search), least recently used first. Certificates are tiny, so this keeps a
+# whole sweep's worth.
+_MEMO_SIZE = 1 << 14
+_memo: collections.OrderedDict[tuple[str, HypergraphSearch | None], FaultDistance] = collections.OrderedDict()
+
+
+def _text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf8')).hexdigest()
+
+
+def circuit_hash(circuit: stim.Circuit) -> str:
+    "A hex digest of a circuit's text, which identifies it for verification"
+    return _text_hash(str(circuit))
+
+
+def fault_distance(circuit: stim.Circuit, hypergraph: HypergraphSearch | None = None) -> FaultDistance:
+    "Computes the fault distance certificates of a circuit, without caching"
+    graphlike = len(circuit.shortest_graphlike_error())
+    if hypergraph is None:
+        return FaultDistance(graphlike=graphlike)
+    found = circuit.search_for_undetectable_logical_errors(
+        dont_explore_detection_event_sets_with_size_above=hypergraph.max_detection_events,
+        dont_explore_edges_with_degree_above=hypergraph.max_edge_degree,
+        dont_explore_edges_increasing_symptom_degree=not hypergraph.explore_increasing_symptom_degree,
+    )
+    return FaultDistance(graphlike=graphlike, hypergraph=len(found))
+
+
+def _fault_distance_of_text(text: str, hypergraph: HypergraphSearch | None) -> FaultDistance:
+    return fault_distance(stim.Circuit(text), hypergraph)
+
+
+def verify_circuits(circuits: Iterable[stim.Circuit],
+                    *,
+                    hypergraph: HypergraphSearch | None = None,
+                    num_workers: int = 1,
+                    cache_dir: str | pathlib.Path | None = None) -> list[FaultDistance]:
+    """Fault distance certificates of several circuits, checking each distinct circuit once.
+
+    Repeated circuits are only searched once, and certificates are kept in
+    memory by circuit hash, so full_circuit(verify=True) doesn't search a
+    circuit this process already verified. With cache_dir, they are also
+    stored there, so a circuit verified by any earlier process is never
+    searched again. The missing ones are computed over a pool of num_workers
+    processes.
+
+    Args:
+        circuits: The circuits to verify. Handoff circuits, whose observables
+            are not deterministic, can't be verified.
+        hypergraph: Also run stim's hypergraph search, with these truncations.
+        num_workers: Number of processes to search with.
+        cache_dir: A directory of stored certificates, shared with ArtifactCache.
+
+    Returns:
+        The certificates of the circuits, in order.
+    """
+    cache = None if cache_dir is None else ArtifactCache(cache_dir)
+    texts = {}
+    hashes = []
+    for circuit in circuits:
+        text = str(circuit)
+        h = _text_hash(text)
+        hashes.append(h)
+        texts.setdefault(h, text)
+
+    certificates = {}
+    for h in texts:
+        if (h, hypergraph) in _memo:
+            _memo.move_to_end((h, hypergraph))
+            certificates[h] = _memo[(h, hypergraph)]
+    stored_keys = {}
+    if cache is not None:
+        for h in texts:
+            if h in certificates:
+                continue
+            stored_keys[h] = ArtifactCache.key(
+                kind='fault_distance',
+                version=FORMAT_VERSION,
+                circuit=h,
+                hypergraph=None if hypergraph is None else dataclasses.asdict(hypergraph),
+            )
+            entry = cache.get(stored_keys[h])
+            if entry is not None:
+                certificates[h] = FaultDistance(
+                    graphlike=int(entry['graphlike']),
+                    hypergraph=None if int(entry['hypergraph']) < 0 else int(entry['hypergraph']),
+                )
+
+    missing = [h for h in texts if h not in certificates]
+    with process_pool(min(num_workers, len(missing))) as executor:
+        args = ([texts[h] for h in missing], [hypergraph] * len(missing))
+        results = list(map(_fault_distance_of_text, *args) if executor is None
+                       else executor.map(_fault_distance_of_text, *args))
+    for h, result in zip(missing, results):
+        certificates[h] = result
+        if cache is not None:
+            cache.get_or_build(stored_keys[h], lambda: {
+                'graphlike': result.graphlike,
+                'hypergraph': -1 if result.hypergraph is None else result.hypergraph,
+            })
+
+    for h, certificate in certificates.items():
+        _memo[(h, hypergraph)] = certificate
+        _memo.move_to_end((h, hypergraph))
+    while len(_memo) > _MEMO_SIZE:
+        _memo.popitem(last=False)
+    return [certificates[h] for h in hashes]
@@ -0,0 +1,45 @@
+import stim
+
+from full_clifford_sim import verification
+from full_clifford_sim.main_complied_fxns import full_circuit
+from full_clifford_sim.verification import FaultDistance, HypergraphSearch, verify_circuits
+
+
+def _circuits() -> list[stim.Circuit]:
+    return [full_circuit(p, 5, 'hookinj', verify=False) for p in [0.001, 0.002]]
+
+
+def test_repeated_circuits_are_searched_once(monkeypatch):
+    monkeypatch.setattr(verification, '_memo', verification.collections.OrderedDict())
+    searched = []
+    fault_distance = verification.fault_distance
+    monkeypatch.setattr(verification, 'fault_distance',
+                        lambda c, h=None: searched.append(c) or fault_distance(c, h))
+    a, b = _circuits()
+    assert verify_circuits([a, b, a]) == [FaultDistance(graphlike=3)] * 3
+    assert len(searched) == 2
+    # Later calls in the same process are answered from memory.
+    assert verify_circuits([b]) == [FaultDistance(graphlike=3)]
+    assert len(searched) == 2
+
+
+def test_full_circuit_verifies_each_circuit_once(monkeypatch):
+    monkeypatch.setattr(verification, '_memo', verification.collections.OrderedDict())
+    searched = []
+    fault_distance = verification.fault_distance
+    monkeypatch.setattr(verification, 'fault_distance',
+                        lambda c, h=None: searched.append(c) or fault_distance(c, h))
+    for _ in range(3):
+        full_circuit(0.001, 5, 'hookinj')
+    assert len(searched) == 1
+
+
+def test_cache_dir_round_trip(tmp_path, monkeypatch):
+    circuits = _circuits()
+    hypergraph = HypergraphSearch()
+    expected = verify_circuits(circuits, hypergraph=hypergraph, num_workers=2, cache_dir=tmp_path)
+    assert expected == [FaultDistance(graphlike=3, hypergraph=3)] * 2
+
+    monkeypatch.setattr(verification, 'fault_distance', None)
+    monkeypatch.setattr(verification, '_memo', verification.collections.OrderedDict())
+    assert verify_circuits(circuits, hypergraph=hypergraph, cache_dir=tmp_path) == expected